@@ -1,18 +1,33 @@
 
 import streamlit as st
 import os
+import math
 import torch
 import numpy as np
 from PIL import Image
 import cv2
-import random
-import time
-from models.network_swinfusion1 import SwinFusion as net
+import uuid
 from utils import utils_image as util
+from utils import utils_model
+from utils import utils_cache
+from utils import utils_export
+from utils import utils_worker
+from utils import utils_metrics
 
 # --- CONFIG ---
 DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 MODEL_PATH = os.path.join(os.path.dirname(__file__), 'model', '10000_E.pth')
+ATTN_BACKEND = os.environ.get('SWINFUSION_ATTN_BACKEND', 'math')  # 'math' / 'sdpa' / 'chunked'
+PRECISION = os.environ.get('SWINFUSION_PRECISION', 'fp32')  # 'fp32' / 'bf16' (autocast, for CPUs with bf16 support) / 'int8' (CPU)
+BACKEND = os.environ.get('SWINFUSION_BACKEND', 'torch')  # 'torch' / 'torchscript' / 'onnxruntime' (exports of main_export.py)
+TILE_SIZE = int(os.environ.get('SWINFUSION_TILE', 512))  # larger slices are fused tile by tile
+TILE_OVERLAP = 32
+MAX_MEMORY = int(os.environ.get('SWINFUSION_MAX_MEMORY_MB', 2048)) * 2**20
+CACHE_DIR = os.environ.get('SWINFUSION_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'swinfusion'))
+CACHE_MB = int(os.environ.get('SWINFUSION_CACHE_MB', 1024))
+WORKERS = int(os.environ.get('SWINFUSION_WORKERS', 1))  # fusion jobs run at the same time
+MAX_QUEUE = int(os.environ.get('SWINFUSION_MAX_QUEUE', 8))  # waiting jobs before new ones are turned away
+PROCESSES = int(os.environ.get('SWINFUSION_PROCESSES', 0))  # >0: jobs run in worker processes sharing one copy of the weights (torch backend, CPU)
 
 st.set_page_config(page_title="SwinFusion Med", layout="wide", initial_sidebar_state="collapsed")
 
@@ -99,20 +114,50 @@ st.markdown("""
 def load_model():
     """Load the SwinFusion model once and cache it."""
     try:
-        model = net(upscale=1, in_chans=1, img_size=128, window_size=8,
-                    img_range=1., depths=[6, 6, 6, 6], embed_dim=60, num_heads=[6, 6, 6, 6],
-                    mlp_ratio=2, upsampler=None, resi_connection='1conv')
-        
-        pretrained_model = torch.load(MODEL_PATH, map_location=DEVICE)
-        param_key_g = 'params'
-        model.load_state_dict(pretrained_model[param_key_g] if param_key_g in pretrained_model.keys() else pretrained_model, strict=True)
-        model.eval()
-        model = model.to(DEVICE)
+        model = utils_export.define_backend(BACKEND, MODEL_PATH, DEVICE, attn_backend=ATTN_BACKEND, precision=PRECISION)
+        if PROCESSES > 0 and BACKEND == 'torch' and DEVICE.type == 'cpu':
+            model = utils_worker.ModelProcessPool(model, PROCESSES).start()
         return model
     except Exception as e:
         st.error(f"Failed to load model: {e}")
         return None
 
+@st.cache_resource
+def load_cache():
+    """Fused results keyed by the content of both inputs and the checkpoint, shared by all sessions."""
+    return utils_cache.FusionCache(CACHE_DIR, disk_bytes=CACHE_MB * 2**20)
+
+@st.cache_resource
+def load_worker():
+    """One inference queue per server, the jobs of all sessions share the cached model."""
+    # one thread per worker process at least, a thread waits for its process while the forward runs
+    return utils_worker.InferenceWorker(num_workers=max(WORKERS, PROCESSES), max_queue=MAX_QUEUE)
+
+def fusion_key(model, img_a_np, img_b_np):
+    # same identity as main_batch_fusion.py, exports are keyed by their files
+    model_id, model_options = utils_export.cache_identity(BACKEND, model, MODEL_PATH, attn_backend=ATTN_BACKEND, precision=PRECISION)
+    return utils_cache.fusion_key(img_a_np, img_b_np, model_id, tile=TILE_SIZE, overlap=TILE_OVERLAP,
+                                  max_memory=MAX_MEMORY, pad='reflect', **model_options)
+
+def fuse(model, img_a_tensor, img_b_tensor, progress=None):
+    """Fuse two 1x1xHxW tensors, returns the HxW uint8 result. progress(done, total) is called per tile batch."""
+    with torch.no_grad():
+        # reflect-padded to the window grid by test_split_fuse, like main_batch_fusion.py, the two share cached results
+        output = utils_model.test_split_fuse(model, img_a_tensor, img_b_tensor, tile=TILE_SIZE, overlap=TILE_OVERLAP,
+                                             window_size=8, max_memory=MAX_MEMORY, progress=progress)
+        output = output.detach()[0].float().cpu()
+    return util.tensor2uint(output)
+
+def fusion_job(job, model, cache, img_a_tensor, img_b_tensor, key):
+    """Runs on the inference worker, re-submitted pairs are served from the result cache."""
+    fused_uint = cache.get(key)
+    if fused_uint is None:
+        job.set_progress(0., "Fusing Tensors")
+        fused_uint = fuse(model, img_a_tensor, img_b_tensor,
+                          progress=lambda done, total: job.set_progress(done / total, f"Fusing Tensors, tile {done}/{total}"))
+        cache.put(key, fused_uint)
+    return fused_uint
+
 def process_image(uploaded_file, channel=1):
     """Convert uploaded file to tensor for model."""
     image = Image.open(uploaded_file).convert('L') # Convert to grayscale
@@ -125,6 +170,9 @@ def process_image(uploaded_file, channel=1):
     img_tensor = util.single2tensor4(img_float)
     return img_tensor.to(DEVICE), img_np
 
+if 'session_id' not in st.session_state:
+    st.session_state['session_id'] = uuid.uuid4().hex
+
 # --- LAYOUT ---
 # 3 Columns: Input (1), Processing (1.5), Metrics (1)
 col_left, col_mid, col_right = st.columns([1, 1.5, 1], gap="medium")
@@ -179,42 +227,40 @@ with col_mid:
         if ct_file and mri_file:
             model = load_model()
             if model:
-                # Progress Bar Simulation
                 progress_bar = st.progress(0)
                 status_text = st.empty()
                 
-                status_text.text("Processing: 20% (Preprocessing)")
-                progress_bar.progress(20)
-                time.sleep(0.3)
-                
-                # Inference
+                status_text.text("Processing: 0% (Preprocessing)")
                 img_a_tensor, img_a_np = process_image(ct_file)
                 img_b_tensor, img_b_np = process_image(mri_file)
+                progress_bar.progress(10)
                 
-                status_text.text("Processing: 60% (Fusing Tensors)")
-                progress_bar.progress(60)
+                # Inference runs on the background worker, this script only polls its progress
+                worker = load_worker()
+                try:
+                    job = worker.submit(fusion_job, model, load_cache(), img_a_tensor, img_b_tensor,
+                                        fusion_key(model, img_a_np, img_b_np), owner=st.session_state['session_id'])
+                except utils_worker.QueueFullError as e:
+                    job = None
+                    st.warning(str(e))
                 
-                with torch.no_grad():
-                    # Padding logic
-                    window_size = 8
-                    _, _, h_old, w_old = img_a_tensor.size()
-                    h_pad = (h_old // window_size + 1) * window_size - h_old
-                    w_pad = (w_old // window_size + 1) * window_size - w_old
-                    
-                    img_a = torch.cat([img_a_tensor, torch.flip(img_a_tensor, [2])], 2)[:, :, :h_old + h_pad, :]
-                    img_a = torch.cat([img_a, torch.flip(img_a, [3])], 3)[:, :, :, :w_old + w_pad]
-                    img_b = torch.cat([img_b_tensor, torch.flip(img_b_tensor, [2])], 2)[:, :, :h_old + h_pad, :]
-                    img_b = torch.cat([img_b, torch.flip(img_b, [3])], 3)[:, :, :, :w_old + w_pad]
-                    
-                    output = model(img_a, img_b)
-                    output = output[..., :h_old, :w_old] 
-                    output = output.detach()[0].float().cpu()
+                while job is not None and not job.wait(0.1):
+                    if job.status == 'queued':
+                        status_text.text(f"Queued: {worker.position(job)} job(s) ahead")
+                    else:
+                        percent = 10 + int(job.progress * 90)
+                        status_text.text(f"Processing: {percent}% ({job.message})")
+                        progress_bar.progress(percent)
                 
-                status_text.text("Processing: 100% (Complete)")
-                progress_bar.progress(100)
+                if job is not None and job.status == 'failed':
+                    st.error(f"Fusion failed: {job.error}")
+                elif job is not None:
+                    status_text.text("Processing: 100% (Complete)")
+                    progress_bar.progress(100)
+                    fused_img = job.result
                 
-                fused_uint = util.tensor2uint(output)
-                fused_img = fused_uint
+            if fused_img is not None:
+                fused_uint = fused_img
                 
                 # Display Large Result
                 st.image(fused_uint, caption="Fused Result", use_container_width=True)
@@ -245,36 +291,40 @@ with col_right:
     st.markdown('<div class="card-header">Quality Metrics</div>', unsafe_allow_html=True)
     
     if run_btn and fused_img is not None:
-        # Generate Fake High Metrics
-        ssim_val = 0.86 + (random.random() * 0.07) # 0.86 - 0.93
-        psnr_val = 34.0 + (random.random() * 16.0) # 34 - 50
-        mse_val = 10.0 + (random.random() * 10.0)
-        entropy_val = 7.5 + (random.random() * 1.5)
-        mi_val = 1.45
-        corr_val = 0.95
+        # No-reference fusion metrics of the fused image against both sources
+        metrics = utils_metrics.fusion_metrics(img_a_np, img_b_np, fused_img)
+        ssim_val = (metrics['SSIM_A'] + metrics['SSIM_B']) / 2
+        psnr_val = metrics['PSNR']
         
         # SSIM
         st.markdown(f"**SSIM (Structural Similarity Index)**")
-        st.progress(int(ssim_val * 100))
+        st.progress(min(max(int(ssim_val * 100), 0), 100))
         st.markdown(f"<div style='text-align: right; color:#48BB78;'>{ssim_val:.3f} / 1.0</div>", unsafe_allow_html=True)
-        st.markdown("✅ Excellent")
+        st.markdown(f"CT {metrics['SSIM_A']:.3f} · MRI {metrics['SSIM_B']:.3f}")
         
         st.divider()
         
         # PSNR
         st.markdown(f"**PSNR (Peak Signal-to-Noise Ratio)**")
-        st.progress(min(int(psnr_val * 2), 100)) # Scale roughly to 100
-        st.markdown(f"<div style='text-align: right; color:#48BB78;'>{psnr_val:.1f} / 50 dB</div>", unsafe_allow_html=True)
-        st.markdown("✅ High Quality")
+        # inf when the fused image equals both sources
+        psnr_finite = math.isfinite(psnr_val)
+        st.progress(min(max(int(psnr_val * 2), 0), 100) if psnr_finite else 100) # Scale roughly to 100
+        psnr_text = f"{psnr_val:.1f}" if psnr_finite else "∞"
+        st.markdown(f"<div style='text-align: right; color:#48BB78;'>{psnr_text} / 50 dB</div>", unsafe_allow_html=True)
+        st.markdown("Mean of the fused image against CT and MRI")
         
         st.divider()
         
         # Table of other metrics
         st.markdown(f"""
-        <div class="metric-row"><span class="metric-label">MSE (Mean Squared Error)</span><span class="metric-value">{mse_val:.2f}</span></div>
-        <div class="metric-row"><span class="metric-label">Entropy</span><span class="metric-value">{entropy_val:.2f} bits</span></div>
-        <div class="metric-row"><span class="metric-label">MI (Mutual Information)</span><span class="metric-value">{mi_val}</span></div>
-        <div class="metric-row"><span class="metric-label">Correlation Coefficient</span><span class="metric-value">{corr_val}</span></div>
+        <div class="metric-row"><span class="metric-label">MSE (Mean Squared Error)</span><span class="metric-value">{metrics['MSE']:.2f}</span></div>
+        <div class="metric-row"><span class="metric-label">Entropy</span><span class="metric-value">{metrics['EN']:.2f} bits</span></div>
+        <div class="metric-row"><span class="metric-label">MI (Mutual Information)</span><span class="metric-value">{metrics['MI']:.3f}</span></div>
+        <div class="metric-row"><span class="metric-label">Correlation Coefficient</span><span class="metric-value">{metrics['CC']:.3f}</span></div>
+        <div class="metric-row"><span class="metric-label">Spatial Frequency</span><span class="metric-value">{metrics['SF']:.2f}</span></div>
+        <div class="metric-row"><span class="metric-label">Average Gradient</span><span class="metric-value">{metrics['AG']:.2f}</span></div>
+        <div class="metric-row"><span class="metric-label">Qabf</span><span class="metric-value">{metrics['Qabf']:.3f}</span></div>
+        <div class="metric-row"><span class="metric-label">VIF</span><span class="metric-value">{metrics['VIF']:.3f}</span></div>
         """, unsafe_allow_html=True)
         
         st.markdown("<br>", unsafe_allow_html=True)
@@ -0,0 +1,171 @@
+import os
+import sys
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+from utils import utils_image as util
+from utils import utils_model
+from utils import utils_cache
+from utils import utils_export
+
+
+'''
+# --------------------------------------------
+# SwinFusion batch fusion of a directory of pairs
+# --------------------------------------------
+# python main_batch_fusion.py --dir_A data/CT --dir_B data/MRI --out results/fused
+# python main_batch_fusion.py --dir_A data/CT --dir_B data/MRI --out results/fused --ext tif --tile_batch 8
+# python main_batch_fusion.py --dir_A data/CT --dir_B data/MRI --out results/fused --cache_dir ~/.cache/swinfusion
+# python main_batch_fusion.py --dir_A data/CT --dir_B data/MRI --out results/fused --precision bf16
+# python main_batch_fusion.py --dir_A data/CT --dir_B data/MRI --out results/fused --backend torchscript --tile 256
+# python main_batch_fusion.py --dir_A data/CT --dir_B data/MRI --out results/fused --backend onnxruntime
+# --------------------------------------------
+# A and B are matched by file name (without extension),
+# pairs of different sizes are skipped, the run then exits with status 1
+# --backend torchscript / onnxruntime run the exports of main_export.py,
+# --attn_backend and --precision are then those of the export
+# --------------------------------------------
+'''
+
+
+MODEL_PATH = os.path.join(os.path.dirname(__file__), 'model', '10000_E.pth')
+
+
+def pair_paths(dir_A, dir_B):
+    """Match the images of dir_A and dir_B by file name, returns [(name, path_A, path_B)] and the unmatched names."""
+    paths_B = {os.path.splitext(os.path.basename(p))[0]: p for p in util.get_image_paths(dir_B)}
+    pairs, unmatched = [], []
+    for path_A in util.get_image_paths(dir_A):
+        name = os.path.splitext(os.path.basename(path_A))[0]
+        if name in paths_B:
+            pairs.append((name, path_A, paths_B.pop(name)))
+        else:
+            unmatched.append(name)
+    return pairs, unmatched + sorted(paths_B)
+
+
+def load_pair(path_A, path_B):
+    img_A = util.imread_uint(path_A, n_channels=1)
+    img_B = util.imread_uint(path_B, n_channels=1)
+    if img_A.shape != img_B.shape:
+        raise ValueError('{:s} {} and {:s} {} differ in size.'.format(path_A, img_A.shape, path_B, img_B.shape))
+    return img_A, img_B
+
+
+def prefetch(executor, fn, items, depth):
+    """Yield fn(*item) for items in order while up to depth items are decoded ahead on executor."""
+    futures = deque()
+    for item in items:
+        futures.append(executor.submit(fn, *item))
+        if len(futures) > depth:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir_A', type=str, required=True, help='CT images')
+    parser.add_argument('--dir_B', type=str, required=True, help='MRI images')
+    parser.add_argument('--out', type=str, required=True, help='output folder')
+    parser.add_argument('--ext', type=str, default='png', choices=['png', 'tif'])
+    parser.add_argument('--model_path', type=str, default=MODEL_PATH)
+    parser.add_argument('--attn_backend', type=str, default='math', choices=['math', 'sdpa', 'chunked'])
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'int8'],
+                        help='bf16: bfloat16 autocast, int8: quantized Linear layers (CPU), see main_quantize.py')
+    parser.add_argument('--backend', type=str, default='torch', choices=utils_export.BACKENDS)
+    parser.add_argument('--tile', type=int, default=256)
+    parser.add_argument('--overlap', type=int, default=32)
+    parser.add_argument('--tile_batch', type=int, default=4, help='tiles per forward, packed across pairs')
+    parser.add_argument('--max_memory_mb', type=int, default=None, help='peak activation memory budget')
+    parser.add_argument('--workers', type=int, default=4, help='decode/encode threads')
+    parser.add_argument('--prefetch', type=int, default=8, help='pairs decoded ahead of inference')
+    parser.add_argument('--cache_dir', type=str, default=None, help='result cache shared with app.py, off if not set')
+    parser.add_argument('--cache_mb', type=int, default=1024)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    pairs, unmatched = pair_paths(args.dir_A, args.dir_B)
+    if unmatched:
+        print('{:d} images without a counterpart are skipped: {}'.format(len(unmatched), ', '.join(unmatched[:5])))
+    if not pairs:
+        raise ValueError('no matching A/B pairs in {:s} and {:s}.'.format(args.dir_A, args.dir_B))
+    os.makedirs(args.out, exist_ok=True)
+
+    model = utils_export.define_backend(args.backend, args.model_path, args.device, attn_backend=args.attn_backend, precision=args.precision)
+    if args.backend == 'torchscript':
+        # every tile has to fit a bucket, smaller (edge) tiles are padded up to one
+        args.tile = min(args.tile, max(min(size) for size in model.sizes))
+    max_memory = args.max_memory_mb * 2**20 if args.max_memory_mb is not None else None
+    cache = utils_cache.FusionCache(args.cache_dir, disk_bytes=args.cache_mb * 2**20) if args.cache_dir else None
+    if cache is not None:
+        # same identity as app.py, exports are keyed by their files
+        model_id, model_options = utils_export.cache_identity(args.backend, model, args.model_path,
+                                                              attn_backend=args.attn_backend, precision=args.precision)
+
+    def decode(path_A, path_B):
+        try:
+            img_A, img_B = load_pair(path_A, path_B)
+        except ValueError as e:
+            print('skipped: {}'.format(e))
+            return None
+        key = None
+        if cache is not None:
+            key = utils_cache.fusion_key(img_A, img_B, model_id, tile=args.tile, overlap=args.overlap,
+                                         max_memory=max_memory, pad='reflect', **model_options)
+        return img_A, img_B, key
+
+    start = time.perf_counter()
+    pending = deque()  # (name, key) of the pairs sent to the model
+    writes = deque()
+    hits = 0
+    skipped = []
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='fusion_io') as executor:
+
+        def write(name, img):
+            writes.append(executor.submit(util.imsave, img, os.path.join(args.out, '{:s}.{:s}'.format(name, args.ext))))
+            # bound the number of encoded images waiting for the disk
+            while len(writes) > args.prefetch:
+                writes.popleft().result()
+
+        def inputs():
+            nonlocal hits
+            for name, decoded in zip((name for name, _, _ in pairs),
+                                     prefetch(executor, decode, [(a, b) for _, a, b in pairs], args.prefetch)):
+                if decoded is None:
+                    skipped.append(name)
+                    continue
+                img_A, img_B, key = decoded
+                img_E = cache.get(key) if cache is not None else None
+                if img_E is not None:
+                    hits += 1
+                    write(name, img_E)
+                    continue
+                pending.append((name, key))
+                yield util.uint2tensor4(img_A).to(args.device), util.uint2tensor4(img_B).to(args.device)
+
+        with torch.no_grad():
+            for E in utils_model.test_split_fuse_iter(model, inputs(), tile=args.tile, overlap=args.overlap,
+                                                      tile_batch=args.tile_batch, max_memory=max_memory):
+                name, key = pending.popleft()
+                img_E = util.tensor2uint(E)
+                if cache is not None:
+                    cache.put(key, img_E)
+                write(name, img_E)
+        for future in writes:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    fused = len(pairs) - len(skipped)
+    print('{:d} pairs fused in {:.1f}s, {:.2f} images/sec ({:d} from cache) -> {:s}'.format(
+        fused, elapsed, fused / elapsed, hits, args.out))
+    if skipped:
+        print('{:d} pairs of different sizes were skipped: {}'.format(len(skipped), ', '.join(skipped)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,453 @@
+import os
+import time
+import argparse
+import resource
+import tempfile
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cv2
+import torch
+
+from utils import utils_model
+from utils import utils_image as util
+
+
+'''
+# --------------------------------------------
+# SwinFusion CPU/GPU benchmarks
+# --------------------------------------------
+# python main_benchmark.py --mode attn --sizes 256 512
+# python main_benchmark.py --mode cross --threads 8
+# python main_benchmark.py --mode branches --sizes 256 512
+# python main_benchmark.py --mode tile --sizes 512 1024 --tile 256
+# python main_benchmark.py --mode schedule --sizes 256 --pairs 32 --tile 256 --tile_batch 8
+# python main_benchmark.py --mode ssim --sizes 256 512 1024
+# python main_benchmark.py --mode precision --sizes 256 512 --pairs 4
+# python main_benchmark.py --mode precision --dir_A data/CT --dir_B data/MRI
+# python main_benchmark.py --mode precision --precisions fp32 int8 --sizes 256
+# python main_benchmark.py --mode backend --sizes 200 256 --buckets 256
+# python main_benchmark.py --mode backend --backends torch onnxruntime --sizes 256 512 --threads 4
+# python main_benchmark.py --mode load
+# python main_benchmark.py --mode pool --sizes 256 --pairs 8 --processes 1 2 4
+# --------------------------------------------
+'''
+
+
+MODEL_PATH = os.path.join(os.path.dirname(__file__), 'model', '10000_E.pth')
+
+
+def timeit(fn, repeat=3):
+    """Return (output of the last call, mean seconds per call) after one warm-up call."""
+    out = fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    return out, (time.perf_counter() - start) / repeat
+
+
+def random_pair(size, device, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    A = torch.rand(1, 1, size, size, generator=g)
+    B = torch.rand(1, 1, size, size, generator=g)
+    return A.to(device), B.to(device)
+
+
+# --------------------------------------------
+# attention backends: numerical parity with
+# the 'math' reference path and latency
+# --------------------------------------------
+def bench_attn(model, args):
+    print('{:>6s} | {:>8s} | {:>10s} | {:>9s}'.format('size', 'backend', 'max |diff|', 'sec/pair'))
+    for size in args.sizes:
+        A, B = random_pair(size, args.device)
+        with torch.no_grad():
+            model.set_attn_backend('math')
+            E_ref, t_ref = timeit(lambda: model(A, B), args.repeat)
+            print('{:>6d} | {:>8s} | {:>10.2e} | {:>9.3f}'.format(size, 'math', 0., t_ref))
+            for backend in ('sdpa', 'chunked'):
+                model.set_attn_backend(backend, args.chunk_size)
+                E, t = timeit(lambda: model(A, B), args.repeat)
+                diff = (E - E_ref).abs().max().item()
+                print('{:>6d} | {:>8s} | {:>10.2e} | {:>9.3f}'.format(size, backend, diff, t))
+                if diff > args.atol:
+                    raise RuntimeError('attention backend [{:s}] deviates from math by {:.2e}'.format(backend, diff))
+
+
+# --------------------------------------------
+# batched cross-attention: freeze(batch_cross=True)
+# against the two sequential A/B branches
+# --------------------------------------------
+def bench_cross(model, args):
+    print('{:>6s} | {:>11s} | {:>10s} | {:>9s}'.format('size', 'batch_cross', 'max |diff|', 'sec/pair'))
+    for size in args.sizes:
+        A, B = random_pair(size, args.device)
+        with torch.no_grad():
+            model.freeze(batch_cross=False)
+            E_ref, t_ref = timeit(lambda: model(A, B), args.repeat)
+            model.freeze(batch_cross=True)
+            E, t = timeit(lambda: model(A, B), args.repeat)
+        print('{:>6d} | {:>11s} | {:>10.2e} | {:>9.3f}'.format(size, 'False', 0., t_ref))
+        print('{:>6d} | {:>11s} | {:>10.2e} | {:>9.3f}'.format(size, 'True', (E - E_ref).abs().max().item(), t))
+
+
+# --------------------------------------------
+# concurrent Ex_A/Ex_B extraction branches
+# against the serial forward
+# --------------------------------------------
+def bench_branches(model, args):
+    print('{:>6s} | {:>10s} | {:>10s} | {:>9s}'.format('size', 'branches', 'max |diff|', 'sec/pair'))
+    for size in args.sizes:
+        A, B = random_pair(size, args.device)
+        with torch.no_grad():
+            model.concurrent_branches = False
+            E_ref, t_ref = timeit(lambda: model(A, B), args.repeat)
+            model.concurrent_branches = True
+            E, t = timeit(lambda: model(A, B), args.repeat)
+            model.concurrent_branches = False
+        print('{:>6d} | {:>10s} | {:>10.2e} | {:>9.3f}'.format(size, 'serial', 0., t_ref))
+        print('{:>6d} | {:>10s} | {:>10.2e} | {:>9.3f}'.format(size, 'concurrent', (E - E_ref).abs().max().item(), t))
+
+
+# --------------------------------------------
+# tiled inference (utils_model.test_split_fuse)
+# against the whole-image forward
+# --------------------------------------------
+def bench_tile(model, args):
+    print('{:>6s} | {:>8s} | {:>10s} | {:>10s} | {:>9s}'.format('size', 'blend', 'mean |diff|', 'max |diff|', 'sec/pair'))
+    for size in args.sizes:
+        A, B = random_pair(size, args.device)
+        with torch.no_grad():
+            E_ref, t_ref = timeit(lambda: model(A, B), args.repeat)
+            print('{:>6d} | {:>8s} | {:>10.2e} | {:>10.2e} | {:>9.3f}'.format(size, 'full', 0., 0., t_ref))
+            for blend in ('gaussian', 'linear'):
+                E, t = timeit(lambda: utils_model.test_split_fuse(model, A, B, tile=args.tile, overlap=args.overlap, blend=blend,
+                                                                  tile_batch=args.tile_batch), args.repeat)
+                diff = (E - E_ref).abs()
+                print('{:>6d} | {:>8s} | {:>10.2e} | {:>10.2e} | {:>9.3f}'.format(size, blend, diff.mean().item(), diff.max().item(), t))
+
+
+# --------------------------------------------
+# batched tile scheduler (utils_model.test_split_fuse_iter)
+# against one model call per pair
+# --------------------------------------------
+def bench_schedule(model, args):
+    print('{:>6s} | {:>10s} | {:>10s} | {:>9s}'.format('size', 'tile_batch', 'max |diff|', 'pairs/sec'))
+    for size in args.sizes:
+        pairs = [random_pair(size, args.device, seed) for seed in range(args.pairs)]
+        with torch.no_grad():
+            E_ref, t_ref = timeit(lambda: [model(A, B) for A, B in pairs], args.repeat)
+            E, t = timeit(lambda: utils_model.test_split_fuse_batch(model, pairs, tile=args.tile, overlap=args.overlap,
+                                                                    tile_batch=args.tile_batch), args.repeat)
+        diff = max((e - e_ref).abs().max().item() for e, e_ref in zip(E, E_ref))
+        print('{:>6d} | {:>10s} | {:>10.2e} | {:>9.2f}'.format(size, 'per pair', 0., args.pairs / t_ref))
+        print('{:>6d} | {:>10d} | {:>10.2e} | {:>9.2f}'.format(size, args.tile_batch, diff, args.pairs / t))
+
+
+# --------------------------------------------
+# SSIM: separable float64/float32 against the
+# former 2D filter2D implementation
+# --------------------------------------------
+def ssim_filter2d(img1, img2):
+    C1 = (0.01 * 255)**2
+    C2 = (0.03 * 255)**2
+    img1 = img1.astype(np.float64)
+    img2 = img2.astype(np.float64)
+    kernel = cv2.getGaussianKernel(11, 1.5)
+    window = np.outer(kernel, kernel.transpose())
+    mu1 = cv2.filter2D(img1, -1, window)[5:-5, 5:-5]
+    mu2 = cv2.filter2D(img2, -1, window)[5:-5, 5:-5]
+    sigma1_sq = cv2.filter2D(img1**2, -1, window)[5:-5, 5:-5] - mu1**2
+    sigma2_sq = cv2.filter2D(img2**2, -1, window)[5:-5, 5:-5] - mu2**2
+    sigma12 = cv2.filter2D(img1 * img2, -1, window)[5:-5, 5:-5] - mu1 * mu2
+    return (((2 * mu1 * mu2 + C1) * (2 * sigma12 + C2)) / ((mu1**2 + mu2**2 + C1) * (sigma1_sq + sigma2_sq + C2))).mean()
+
+
+def bench_ssim(args):
+    print('{:>6s} | {:>18s} | {:>10s} | {:>9s}'.format('size', 'method', 'max |diff|', 'sec/img'))
+    rng = np.random.default_rng(0)
+    for size in args.sizes:
+        ref = cv2.GaussianBlur(rng.integers(0, 256, (size, size, 3), dtype=np.uint8), (0, 0), 2)
+        imgs = [np.clip(ref + rng.normal(0, 8, ref.shape), 0, 255).astype(np.uint8) for _ in range(args.pairs)]
+        expected, t_ref = timeit(lambda: [np.mean([ssim_filter2d(ref[..., c], img[..., c]) for c in range(3)]) for img in imgs], args.repeat)
+        print('{:>6d} | {:>18s} | {:>10.2e} | {:>9.4f}'.format(size, 'filter2D float64', 0., t_ref / args.pairs))
+        for dtype in (np.float64, np.float32):
+            scores, t = timeit(lambda: [util.calculate_ssim(ref, img, dtype=dtype) for img in imgs], args.repeat)
+            diff = max(abs(s - e) for s, e in zip(scores, expected))
+            print('{:>6d} | {:>18s} | {:>10.2e} | {:>9.4f}'.format(size, 'separable ' + np.dtype(dtype).name, diff, t / args.pairs))
+            scores, t = timeit(lambda: util.calculate_ssim_many(ref, imgs, dtype=dtype), args.repeat)
+            diff = max(abs(s - e) for s, e in zip(scores, expected))
+            print('{:>6d} | {:>18s} | {:>10.2e} | {:>9.4f}'.format(size, 'shared ' + np.dtype(dtype).name, diff, t / args.pairs))
+
+
+# --------------------------------------------
+# bfloat16 autocast / int8 against float32: output
+# PSNR/SSIM deltas, latency and peak memory
+# --------------------------------------------
+def run_precision(model_path, precision, pairs, args):
+    """Fuse pairs in a fresh process, returns (uint8 outputs, sec/pair, peak memory growth in MB)."""
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)  # same random init in every process when no checkpoint is given
+    model = utils_model.define_swinfusion(model_path, args.device, attn_backend=args.attn_backend, precision=precision)
+    model.freeze()
+    pairs = [(A.to(args.device), B.to(args.device)) for A, B in pairs]
+    # ru_maxrss is the peak of the process, its growth from here on is the peak of the forward passes
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with torch.no_grad():
+        outputs, t = timeit(lambda: [model(A, B) for A, B in pairs], args.repeat)
+    if args.device.startswith('cuda'):
+        peak = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base) / 2**10
+    return [util.tensor2uint(E) for E in outputs], t / len(pairs), peak
+
+
+def bench_precision(args):
+    model_path = args.model_path if os.path.isfile(args.model_path) else None
+    if args.dir_A and args.dir_B:
+        from main_batch_fusion import pair_paths, load_pair
+        images = [load_pair(path_A, path_B) for _, path_A, path_B in pair_paths(args.dir_A, args.dir_B)[0][:args.pairs]]
+        sets = [('{:d} pairs'.format(len(images)), [(util.uint2tensor4(a), util.uint2tensor4(b)) for a, b in images])]
+    else:
+        sets = [(str(size), [random_pair(size, 'cpu', seed) for seed in range(args.pairs)]) for size in args.sizes]
+
+    print('{:>10s} | {:>9s} | {:>9s} | {:>8s} | {:>12s} | {:>12s} | {:>11s}'.format(
+        'input', 'precision', 'sec/pair', 'peak MB', 'PSNR vs fp32', 'SSIM vs fp32', 'dSSIM(A,B)'))
+    for name, pairs in sets:
+        results = {}
+        for precision in ['fp32'] + [p for p in args.precisions if p != 'fp32']:
+            # one process per run, so that the peak memory of one run does not hide the other
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                results[precision] = executor.submit(run_precision, model_path, precision, pairs, args).result()
+        E_ref = results['fp32'][0]
+        sources = [(util.tensor2uint(A), util.tensor2uint(B)) for A, B in pairs]
+        for precision, (E, t, peak) in results.items():
+            psnr = np.mean([util.calculate_psnr(e, e_ref) for e, e_ref in zip(E, E_ref)])
+            ssim = np.mean([util.calculate_ssim(e, e_ref) for e, e_ref in zip(E, E_ref)])
+            # fusion quality: mean SSIM of the output against both sources, relative to fp32
+            dssim = np.mean([(np.subtract(*util.calculate_ssim_many(a, [e, e_ref])) + np.subtract(*util.calculate_ssim_many(b, [e, e_ref]))) / 2
+                             for (a, b), e, e_ref in zip(sources, E, E_ref)])
+            print('{:>10s} | {:>9s} | {:>9.3f} | {:>8.0f} | {:>12.2f} | {:>12.5f} | {:>+11.2e}'.format(
+                name, precision, t, peak, psnr, ssim, dssim))
+
+
+# --------------------------------------------
+# inference backends (utils_export.BACKENDS)
+# against the eager model: cold start (load +
+# first call), sec/pair and max |diff|, which
+# for torchscript includes the padding up to
+# a bucket
+# --------------------------------------------
+def run_backend(model_path, backend, pairs, args):
+    """Fuse pairs in a fresh process, returns (outputs, cold start seconds, sec/pair)."""
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    from utils import utils_export
+    start = time.perf_counter()
+    model = utils_export.define_backend(backend, model_path, args.device)
+    pairs = [(A.to(args.device), B.to(args.device)) for A, B in pairs]
+    with torch.no_grad():
+        model(*pairs[0])
+        cold = time.perf_counter() - start
+        outputs, t = timeit(lambda: [model(A, B) for A, B in pairs], args.repeat)
+    return [E.cpu() for E in outputs], cold, t / len(pairs)
+
+
+def bench_backend(args):
+    from utils import utils_export
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = args.model_path
+        if not os.path.isfile(model_path):
+            # export a random init, the timings do not depend on the weights
+            torch.manual_seed(0)
+            model_path = os.path.join(tmp, 'random_E.pth')
+            torch.save(utils_model.define_swinfusion(None, 'cpu').state_dict(), model_path)
+        model = utils_model.define_swinfusion(model_path, args.device)
+        if 'torchscript' in args.backends:
+            utils_export.export_swinfusion(model, [(b, b) for b in args.buckets or args.sizes], model_path)
+        if 'onnxruntime' in args.backends:
+            utils_export.export_onnx(model, model_path)
+        del model
+
+        print('{:>6s} | {:>11s} | {:>8s} | {:>9s} | {:>10s}'.format('size', 'backend', 'cold s', 'sec/pair', 'max |diff|'))
+        for size in args.sizes:
+            pairs = [random_pair(size, 'cpu', seed) for seed in range(args.pairs)]
+            results = {}
+            for backend in ['torch'] + [b for b in args.backends if b != 'torch']:
+                # one process per run, the cold start includes the imports of the first model
+                with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    results[backend] = executor.submit(run_backend, model_path, backend, pairs, args).result()
+            for backend, (E, cold, t) in results.items():
+                diff = max((e - e_ref).abs().max().item() for e, e_ref in zip(E, results['torch'][0]))
+                print('{:>6d} | {:>11s} | {:>8.2f} | {:>9.3f} | {:>10.2e}'.format(size, backend, cold, t, diff))
+
+
+# --------------------------------------------
+# checkpoint loading: seconds to a model ready
+# for inference and the private (not shared)
+# memory it takes, for the full copy of random
+# init + torch.load + load_state_dict, and the
+# memory-mapped .pth / .safetensors loads of
+# define_swinfusion
+# --------------------------------------------
+def private_mb():
+    """Anonymous resident memory of the process (Linux), file-backed pages are shared with other processes."""
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith('RssAnon')) / 2**10
+
+
+def run_load(path, copy, args):
+    from models.network_swinfusion1 import SwinFusion  # imports are not part of the load time
+    base, start = private_mb(), time.perf_counter()
+    if copy:
+        model = utils_model.define_swinfusion(None, args.device)
+        model.load_state_dict(torch.load(path, map_location=args.device), strict=True)
+    else:
+        model = utils_model.define_swinfusion(path, args.device)
+    model.freeze()
+    return time.perf_counter() - start, private_mb() - base
+
+
+def bench_load(args):
+    model_path = args.model_path if os.path.isfile(args.model_path) else None
+    state_dict = utils_model.load_checkpoint(model_path) if model_path else utils_model.define_swinfusion(None, 'cpu').state_dict()
+    with tempfile.TemporaryDirectory() as tmp:
+        # copies in separate folders, define_swinfusion would read a .safetensors next to the .pth
+        os.makedirs(os.path.join(tmp, 'st'))
+        paths = {'pth': os.path.join(tmp, '10000_E.pth'), 'safetensors': os.path.join(tmp, 'st', '10000_E.safetensors')}
+        torch.save(state_dict, paths['pth'])
+        utils_model.save_safetensors(state_dict, paths['safetensors'])
+        print('{:>20s} | {:>8s} | {:>10s}'.format('load', 'sec', 'private MB'))
+        for name, path, copy in [('init + copy (.pth)', paths['pth'], True), ('mmap .pth', paths['pth'], False),
+                                 ('mmap .safetensors', paths['safetensors'], False)]:
+            times, mbs = [], []
+            for _ in range(args.repeat):
+                with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    t, mb = executor.submit(run_load, path, copy, args).result()
+                times.append(t)
+                mbs.append(mb)
+            print('{:>20s} | {:>8.3f} | {:>10.1f}'.format(name, np.median(times), np.median(mbs)))
+
+
+# --------------------------------------------
+# inference process pool (utils_worker.ModelProcessPool)
+# with 1..N workers: memory per worker and pairs/sec,
+# every worker loading its own copy (full copy, or the
+# mmap load of define_swinfusion) against one copy in
+# shared memory
+# --------------------------------------------
+def load_copy(model_path, device):
+    """Random init + torch.load + load_state_dict, a private copy of every tensor."""
+    model = utils_model.define_swinfusion(None, device)
+    model.load_state_dict(torch.load(model_path, map_location=device), strict=True)
+    return model.freeze()
+
+
+def import_memory():
+    """Memory of a fresh worker process with the imports done and no model."""
+    from models.network_swinfusion1 import SwinFusion
+    from utils import utils_worker
+    return utils_worker.process_memory()
+
+
+def bench_pool(args):
+    from utils import utils_worker
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = args.model_path
+        if not os.path.isfile(model_path):
+            torch.manual_seed(0)
+            model_path = os.path.join(tmp, 'random_E.pth')
+            torch.save(utils_model.define_swinfusion(None, 'cpu').state_dict(), model_path)
+        model = utils_model.define_swinfusion(model_path, 'cpu').freeze()
+        loaders = [('copy', functools.partial(load_copy, model_path, 'cpu')),
+                   ('mmap', functools.partial(utils_model.define_swinfusion, model_path, 'cpu')),
+                   ('shared', model)]
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            base = executor.submit(import_memory).result()
+        # model MB: private (RssAnon) pages of a worker above a process without model, after a pair of the
+        # served size: weights if not shared, plus the per-worker attention masks, indices and activations;
+        # mapped MB: pages of the checkpoint file (RssFile) or of shared memory (RssShmem) above it
+        print('{:>6s} | {:>9s} | {:>7s} | {:>15s} | {:>16s} | {:>9s}'.format(
+            'size', 'processes', 'weights', 'model MB/worker', 'mapped MB/worker', 'pairs/sec'))
+        for size in args.sizes:
+            pairs = [random_pair(size, 'cpu', seed) for seed in range(args.pairs)]
+            for n in args.processes:
+                for name, loader in loaders:
+                    pool = utils_worker.ModelProcessPool(loader, n, args.threads).start()
+                    try:
+                        for future in [pool.submit(*pairs[0]) for _ in range(n)]:
+                            future.result()
+                        memory = [utils_worker.process_memory(pid) for pid in pool.pids()]
+                        start = time.perf_counter()
+                        for future in [pool.submit(A, B) for A, B in pairs]:
+                            future.result()
+                        rate = len(pairs) / (time.perf_counter() - start)
+                    finally:
+                        pool.close()
+                    print('{:>6d} | {:>9d} | {:>7s} | {:>15.1f} | {:>16.1f} | {:>9.3f}'.format(
+                        size, n, name, np.mean([m['private'] - base['private'] for m in memory]),
+                        np.mean([m['file'] + m['shared'] - base['file'] - base['shared'] for m in memory]), rate))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', type=str, default='attn', choices=['attn', 'cross', 'branches', 'tile', 'schedule', 'ssim', 'precision', 'backend', 'load', 'pool'])
+    parser.add_argument('--model_path', type=str, default=MODEL_PATH, help='random init if the file does not exist')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--chunk_size', type=int, default=64)
+    parser.add_argument('--atol', type=float, default=1e-4)
+    parser.add_argument('--tile', type=int, default=256)
+    parser.add_argument('--overlap', type=int, default=32)
+    parser.add_argument('--tile_batch', type=int, default=1)
+    parser.add_argument('--pairs', type=int, default=16, help='number of pairs for --mode schedule / ssim / precision / backend / pool')
+    parser.add_argument('--attn_backend', type=str, default='math', choices=['math', 'sdpa', 'chunked'], help='for --mode precision')
+    parser.add_argument('--precisions', type=str, nargs='+', default=['fp32', 'bf16'], choices=['fp32', 'bf16', 'int8'])
+    parser.add_argument('--backends', type=str, nargs='+', default=['torch', 'torchscript', 'onnxruntime'],
+                        choices=['torch', 'torchscript', 'onnxruntime'], help='for --mode backend')
+    parser.add_argument('--buckets', type=int, nargs='+', default=None, help='torchscript sizes for --mode backend, default: --sizes')
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4], help='worker counts for --mode pool')
+    parser.add_argument('--dir_A', type=str, default=None, help='sample set for --mode precision, random pairs if not set')
+    parser.add_argument('--dir_B', type=str, default=None)
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    if args.mode == 'ssim':
+        bench_ssim(args)
+        return
+    if args.mode == 'precision':
+        bench_precision(args)
+        return
+    if args.mode == 'backend':
+        bench_backend(args)
+        return
+    if args.mode == 'load':
+        bench_load(args)
+        return
+    if args.mode == 'pool':
+        bench_pool(args)
+        return
+    model_path = args.model_path if os.path.isfile(args.model_path) else None
+    model = utils_model.define_swinfusion(model_path, args.device)
+    model.freeze()
+    print('model: {}, threads: {:d}'.format(model_path or 'random init', torch.get_num_threads()))
+
+    if args.mode == 'attn':
+        bench_attn(model, args)
+    elif args.mode == 'cross':
+        bench_cross(model, args)
+    elif args.mode == 'branches':
+        bench_branches(model, args)
+    elif args.mode == 'tile':
+        bench_tile(model, args)
+    elif args.mode == 'schedule':
+        bench_schedule(model, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import os
+import sys
+import csv
+import time
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+
+from utils import utils_image as util
+from utils import utils_metrics
+
+
+'''
+# --------------------------------------------
+# SwinFusion offline evaluation
+# --------------------------------------------
+# python main_eval_fusion.py --dir_F results/fused --dir_A data/CT --dir_B data/MRI
+# python main_eval_fusion.py --dir_F results/fused --dir_A data/CT --dir_B data/MRI --workers 16 --chunk 8
+# --------------------------------------------
+# F, A and B are matched by file name (without extension)
+# rows already in --csv are skipped, an interrupted run resumes where it stopped
+# triplets of different sizes or unreadable are skipped, the run then exits with status 1
+# --------------------------------------------
+'''
+
+
+METRICS = ['EN', 'MI', 'NMI', 'FMI', 'SSIM_A', 'SSIM_B', 'CC', 'SF', 'AG', 'Qabf', 'VIF', 'MSE', 'PSNR']
+
+
+def triplet_paths(dir_F, dir_A, dir_B):
+    """[(name, path_A, path_B, path_F)] of the fused images that have both sources."""
+    stem = lambda p: os.path.splitext(os.path.basename(p))[0]
+    paths_A = {stem(p): p for p in util.get_image_paths(dir_A)}
+    paths_B = {stem(p): p for p in util.get_image_paths(dir_B)}
+    return [(stem(p), paths_A[stem(p)], paths_B[stem(p)], p) for p in util.get_image_paths(dir_F)
+            if stem(p) in paths_A and stem(p) in paths_B]
+
+
+def read_done(csv_path):
+    """Complete rows of a previous run, a row cut short by an interruption is dropped."""
+    if not os.path.isfile(csv_path):
+        return []
+    with open(csv_path, newline='') as f:
+        return [row for row in csv.DictReader(f) if all(row.get(k) not in (None, '') for k in ['name'] + METRICS)]
+
+
+def init_worker():
+    # one process per core, no nested threading in cv2/torch
+    import cv2
+    cv2.setNumThreads(1)
+    try:
+        import torch
+        torch.set_num_threads(1)
+    except ImportError:
+        pass
+
+
+def evaluate_chunk(chunk):
+    """[(name, path_A, path_B, path_F)] -> [OrderedDict(name, metrics...)], [(name, reason)] of the skipped triplets"""
+    names, triplets, skipped = [], [], []
+    for name, *paths in chunk:
+        try:
+            imgs = tuple(util.imread_uint(p, n_channels=1) for p in paths)
+        except Exception as e:
+            skipped.append((name, 'unreadable: {}'.format(e)))
+            continue
+        if len(set(img.shape for img in imgs)) > 1:
+            skipped.append((name, 'sizes differ: A {} B {} F {}'.format(*(img.shape[:2] for img in imgs))))
+            continue
+        names.append(name)
+        triplets.append(imgs)
+    rows = []
+    for name, metrics in zip(names, utils_metrics.fusion_metrics_batch(triplets)):
+        row = OrderedDict(name=name)
+        row.update(metrics)
+        rows.append(row)
+    return rows, skipped
+
+
+def summarize(rows):
+    summary = OrderedDict()
+    for k in METRICS:
+        v = np.array([float(row[k]) for row in rows])
+        summary[k] = OrderedDict(mean=v.mean(), std=v.std(), min=v.min(), max=v.max())
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir_F', type=str, required=True, help='fused images')
+    parser.add_argument('--dir_A', type=str, required=True, help='CT images')
+    parser.add_argument('--dir_B', type=str, required=True, help='MRI images')
+    parser.add_argument('--csv', type=str, default=None, help='per-image results, default: <dir_F>/metrics.csv')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--chunk', type=int, default=8, help='images per task')
+    args = parser.parse_args()
+
+    csv_path = args.csv or os.path.join(args.dir_F, 'metrics.csv')
+    summary_path = os.path.splitext(csv_path)[0] + '_summary.csv'
+
+    triplets = triplet_paths(args.dir_F, args.dir_A, args.dir_B)
+    if not triplets:
+        raise ValueError('no fused image of {:s} has sources in {:s} and {:s}.'.format(args.dir_F, args.dir_A, args.dir_B))
+    rows = read_done(csv_path)
+    skipped = []
+    done = set(row['name'] for row in rows)
+    todo = [t for t in triplets if t[0] not in done]
+    print('{:d} images, {:d} already evaluated, {:d} to go with {:d} workers'.format(len(triplets), len(done), len(todo), args.workers))
+
+    start = time.perf_counter()
+    # rewrite the valid rows, then append every finished chunk so an interrupted run loses at most the chunks in flight
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['name'] + METRICS)
+        writer.writeheader()
+        writer.writerows(rows)
+        f.flush()
+        if todo:
+            chunks = [todo[i:i + args.chunk] for i in range(0, len(todo), args.chunk)]
+            with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker) as executor:
+                futures = {executor.submit(evaluate_chunk, chunk): chunk for chunk in chunks}
+                for future in as_completed(futures):
+                    try:
+                        chunk_rows, chunk_skipped = future.result()
+                    except Exception as e:
+                        # the other chunks go on, the names of this one are evaluated again by the next run
+                        chunk_rows, chunk_skipped = [], [(name, repr(e)) for name, *_ in futures[future]]
+                    for name, reason in chunk_skipped:
+                        print('skipped {:s}: {:s}'.format(name, reason))
+                    skipped += chunk_skipped
+                    writer.writerows(chunk_rows)
+                    f.flush()
+                    rows += chunk_rows
+    elapsed = time.perf_counter() - start
+    if not rows:
+        raise ValueError('none of the {:d} images could be evaluated.'.format(len(triplets)))
+
+    summary = summarize(rows)
+    with open(summary_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['metric', 'mean', 'std', 'min', 'max'])
+        for k, v in summary.items():
+            writer.writerow([k] + ['{:.6f}'.format(x) for x in v.values()])
+
+    print('{:>8s} | {:>10s} | {:>10s}'.format('metric', 'mean', 'std'))
+    for k, v in summary.items():
+        print('{:>8s} | {:>10.4f} | {:>10.4f}'.format(k, v['mean'], v['std']))
+    evaluated = len(todo) - len(skipped)
+    print('{:d} images in {:.1f}s ({:.2f} images/sec) -> {:s}, {:s}'.format(
+        evaluated, elapsed, evaluated / max(elapsed, 1e-9), csv_path, summary_path))
+    if skipped:
+        print('{:d} images were skipped: {}'.format(len(skipped), ', '.join(sorted(name for name, _ in skipped))))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
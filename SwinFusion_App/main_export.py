@@ -0,0 +1,90 @@
+import os
+import time
+import argparse
+import torch
+
+from utils import utils_model
+from utils import utils_export
+from utils import utils_swin
+
+
+'''
+# --------------------------------------------
+# SwinFusion TorchScript / ONNX / safetensors export
+# --------------------------------------------
+# python main_export.py --sizes 256 512
+# python main_export.py --sizes 256 512x384 --attn_backend sdpa
+# python main_export.py --sizes 128 --fuse_mask
+# python main_export.py --format onnx --sizes 128 256x192
+# python main_export.py --format safetensors
+# --------------------------------------------
+# torchscript: writes model/10000_E.<H>x<W>.ts next to the checkpoint, one per size,
+# inputs are padded up to the smallest bucket that holds them, so list the
+# sizes of your data; exporting a size again replaces its file, all the sizes
+# have to be exported with the same --attn_backend, --precision and --fuse_mask
+# onnx: writes model/10000_E.onnx, any batch size and any H, W; --sizes are
+# only checked against the eager model (128 if not given)
+# used by main_batch_fusion.py --backend torchscript / onnxruntime and
+# SWINFUSION_BACKEND in app.py
+# safetensors: writes model/10000_E.safetensors, the same weights as one flat
+# buffer that loads memory-mapped without unpickling; every script loading
+# model/10000_E.pth reads it instead while it is not older than the .pth;
+# --sizes as for onnx
+# --------------------------------------------
+'''
+
+
+MODEL_PATH = os.path.join(os.path.dirname(__file__), 'model', '10000_E.pth')
+
+
+def parse_size(s):
+    """'256' -> (256, 256), '512x384' -> (512, 384)"""
+    h, _, w = s.partition('x')
+    return int(h), int(w or h)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--format', type=str, default='torchscript', choices=['torchscript', 'onnx', 'safetensors'])
+    parser.add_argument('--sizes', type=parse_size, nargs='+', default=None,
+                        help='buckets, H or HxW, required for torchscript; onnx / safetensors: sizes checked')
+    parser.add_argument('--model_path', type=str, default=MODEL_PATH)
+    parser.add_argument('--attn_backend', type=str, default='math', choices=['math', 'sdpa', 'chunked'])
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'int8'])
+    parser.add_argument('--fuse_mask', action='store_true', help='bake the bias+mask sums, ~350 MB per bucket at 128x128')
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+    if args.sizes is None:
+        if args.format == 'torchscript':
+            parser.error('--sizes is required for --format torchscript')
+        args.sizes = [(128, 128)]
+
+    model = utils_model.define_swinfusion(args.model_path, args.device, attn_backend=args.attn_backend, precision=args.precision)
+    if args.format == 'onnx':
+        start = time.perf_counter()
+        path = utils_export.export_onnx(model, args.model_path)
+        print('{:s}: {:.1f} MB in {:.1f}s'.format(path, os.path.getsize(path) / 2**20, time.perf_counter() - start))
+        exported = utils_export.OnnxSwinFusion(args.model_path, args.device)
+    elif args.format == 'safetensors':
+        path = utils_model.safetensors_path(args.model_path)
+        utils_model.save_safetensors(utils_swin.strip_shared_buffers(utils_model.load_checkpoint(args.model_path)), path)
+        exported = utils_model.define_swinfusion(path, args.device, attn_backend=args.attn_backend, precision=args.precision).freeze()
+
+    print('{:>10s} | {:>8s} | {:>10s} | {:>10s}'.format('size', 'MB', 'export s', 'max |diff|'))
+    for size in args.sizes:
+        elapsed = '-'
+        if args.format == 'torchscript':
+            start = time.perf_counter()
+            path = utils_export.export_swinfusion(model, [size], args.model_path, fuse_mask=args.fuse_mask)[size]
+            elapsed = '{:.1f}'.format(time.perf_counter() - start)
+            exported = utils_export.load_exported(path, args.device)[0]
+        # the artifact must reproduce the eager model at its own size
+        A, B = torch.rand(2, 1, 1, *size, device=args.device)
+        with torch.no_grad():
+            diff = (exported(A, B) - model.freeze()(A, B)).abs().max().item()
+        print('{:>10s} | {:>8.1f} | {:>10s} | {:>10.2e}'.format(
+            '{:d}x{:d}'.format(*size), os.path.getsize(path) / 2**20, elapsed, diff))
+
+
+if __name__ == '__main__':
+    main()
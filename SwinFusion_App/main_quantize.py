@@ -0,0 +1,71 @@
+import os
+import time
+import argparse
+import numpy as np
+import torch
+
+from utils import utils_image as util
+from utils import utils_model
+from utils import utils_quant
+from main_batch_fusion import pair_paths, load_pair
+
+
+'''
+# --------------------------------------------
+# SwinFusion post-training int8 quantization
+# --------------------------------------------
+# python main_quantize.py --dir_A data/CT --dir_B data/MRI
+# python main_quantize.py --dir_A data/CT --dir_B data/MRI --conv --pairs 32
+# --------------------------------------------
+# writes model/10000_E.int8.pth next to the float checkpoint, used by
+# main_batch_fusion.py --precision int8 and SWINFUSION_PRECISION=int8 in app.py
+# the sample pairs calibrate the conv layers (--conv) and measure the
+# accuracy against the float model
+# --------------------------------------------
+'''
+
+
+MODEL_PATH = os.path.join(os.path.dirname(__file__), 'model', '10000_E.pth')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir_A', type=str, required=True, help='sample CT images')
+    parser.add_argument('--dir_B', type=str, required=True, help='sample MRI images')
+    parser.add_argument('--model_path', type=str, default=MODEL_PATH)
+    parser.add_argument('--out', type=str, default=None, help='default: <model_path without .pth>.int8.pth')
+    parser.add_argument('--conv', action='store_true', help='also quantize the conv layers (static, calibrated)')
+    parser.add_argument('--pairs', type=int, default=16, help='number of sample pairs')
+    parser.add_argument('--engine', type=str, default=torch.backends.quantized.engine,
+                        choices=torch.backends.quantized.supported_engines)
+    args = parser.parse_args()
+
+    pairs = [load_pair(path_A, path_B) for _, path_A, path_B in pair_paths(args.dir_A, args.dir_B)[0][:args.pairs]]
+    if not pairs:
+        raise ValueError('no matching A/B pairs in {:s} and {:s}.'.format(args.dir_A, args.dir_B))
+    pairs = [(util.uint2tensor4(img_A), util.uint2tensor4(img_B)) for img_A, img_B in pairs]
+    torch.backends.quantized.engine = args.engine
+
+    model = utils_model.define_swinfusion(args.model_path, 'cpu')
+    model.freeze()
+    with torch.no_grad():
+        start = time.perf_counter()
+        E_ref = [util.tensor2uint(model(A, B)) for A, B in pairs]
+        t_ref = (time.perf_counter() - start) / len(pairs)
+
+        utils_quant.quantize_swinfusion(model, conv=args.conv, calibration=pairs)
+        start = time.perf_counter()
+        E = [util.tensor2uint(model(A, B)) for A, B in pairs]
+        t = (time.perf_counter() - start) / len(pairs)
+
+    out = args.out or utils_quant.quantized_path(args.model_path)
+    utils_quant.save_quantized(model, out, args.model_path)
+
+    psnr = np.mean([util.calculate_psnr(e, e_ref) for e, e_ref in zip(E, E_ref)])
+    ssim = np.mean([util.calculate_ssim(e, e_ref) for e, e_ref in zip(E, E_ref)])
+    print('{:d} pairs, int8 {:s}: PSNR {:.2f} dB, SSIM {:.5f} against float, {:.3f} -> {:.3f} sec/pair -> {:s}'.format(
+        len(pairs), 'linear+conv' if args.conv else 'linear', psnr, ssim, t_ref, t, out))
+
+
+if __name__ == '__main__':
+    main()
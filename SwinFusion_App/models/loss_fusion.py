@@ -0,0 +1,121 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from models.loss_ssim import ssim_pair
+
+
+"""
+# ============================================
+# fusion losses of all tasks
+# --------------------------------------------
+# intensity + gradient + SSIM (+ TV) terms,
+# weighted per task in FUSION_LOSSES; the Sobel
+# gradients of A, B and F are computed once per
+# step and shared by the gradient term and the
+# SSIM weights
+# ============================================
+"""
+
+
+FUSION_LOSSES = {
+    # intensity: target of the L1 term, 'max' / 'mean' of A and B or the 'gt' image
+    # grad_y: gradient term on the first (Y) channel only
+    # ssim_weights: 'equal' or 'gradient' (by mean Sobel magnitude of A and B)
+    'med': dict(intensity='max', w_intensity=20, w_grad=100, grad_y=True, w_ssim=50, ssim_weights='equal'),
+    'vif': dict(intensity='max', w_intensity=20, w_grad=20, grad_y=False, w_ssim=10, ssim_weights='gradient'),
+    'mef': dict(intensity='mean', w_intensity=20, w_grad=20, grad_y=True, w_ssim=10, ssim_weights='equal'),
+    'mff': dict(intensity='mean', w_intensity=20, w_grad=20, grad_y=False, w_ssim=10, ssim_weights='gradient'),
+    'nir': dict(intensity='mean', w_intensity=20, w_grad=20, grad_y=True, w_ssim=10, ssim_weights='gradient'),
+    'gt': dict(intensity='gt', w_intensity=20, w_grad=10, grad_y=True, w_ssim=0, w_tv=5),
+}
+
+
+class Sobelxy(nn.Module):
+    """|Sobel_x| + |Sobel_y| per channel, the kernels are buffers and follow .to(device)."""
+
+    def __init__(self):
+        super(Sobelxy, self).__init__()
+        kernelx = [[-1, 0, 1],
+                   [-2, 0, 2],
+                   [-1, 0, 1]]
+        kernely = [[1, 2, 1],
+                   [0, 0, 0],
+                   [-1, -2, -1]]
+        self.register_buffer('weight', torch.FloatTensor([kernelx, kernely]).unsqueeze(1), persistent=False)
+
+    def forward(self, x):
+        b, c, h, w = x.shape
+        sobel = F.conv2d(x, self.weight.to(x.dtype).repeat(c, 1, 1, 1), padding=1, groups=c)
+        return sobel.abs().view(b, c, 2, h, w).sum(2)
+
+
+def tv_loss(GT, fused):
+    x1 = fused - GT
+    temp1 = torch.cat((x1[:, :, 1:, :], x1[:, :, -1, :].unsqueeze(2)), 2)
+    temp2 = torch.cat((x1[:, :, :, 1:], x1[:, :, :, -1].unsqueeze(3)), 3)
+    return torch.mean((x1 - temp1)**2 + (x1 - temp2)**2)
+
+
+class FusionLoss(nn.Module):
+    """Weighted sum of the fusion loss terms, see FUSION_LOSSES for the settings of each task.
+
+    forward(image_A, image_B, image_fused, image_GT=None) returns
+    (fusion_loss, loss_gradient, loss_l1, loss_SSIM, loss_TV), disabled terms are 0.
+    """
+
+    def __init__(self, intensity='max', w_intensity=20, w_grad=20, grad_y=False, w_ssim=10, ssim_weights='equal', w_tv=0):
+        super(FusionLoss, self).__init__()
+        if intensity not in ('max', 'mean', 'gt'):
+            raise NotImplementedError('Intensity target [{:s}] is not found.'.format(intensity))
+        if ssim_weights not in ('equal', 'gradient'):
+            raise NotImplementedError('SSIM weights [{:s}] are not found.'.format(ssim_weights))
+        self.intensity, self.grad_y, self.ssim_weights = intensity, grad_y, ssim_weights
+        self.w_intensity, self.w_grad, self.w_ssim, self.w_tv = w_intensity, w_grad, w_ssim, w_tv
+        self.sobelconv = Sobelxy()
+
+    def forward(self, image_A, image_B, image_fused, image_GT=None):
+        zero = image_fused.new_zeros(())
+        # Sobel of A and B in one conv, F on its own so that backward only runs through F;
+        # reused by every term below
+        gradient_A, gradient_B = self.sobelconv(torch.cat([image_A, image_B])).split(image_A.shape[0])
+        gradient_fused = self.sobelconv(image_fused)
+
+        if self.intensity == 'gt':
+            intensity_joint = image_GT
+        elif self.intensity == 'max':
+            intensity_joint = torch.max(image_A, image_B)
+        else:
+            intensity_joint = (image_A + image_B) / 2
+        loss_l1 = self.w_intensity * F.l1_loss(image_fused, intensity_joint)
+
+        loss_gradient = zero
+        if self.w_grad:
+            if self.grad_y:
+                gradient_joint = torch.max(gradient_A[:, :1], gradient_B[:, :1])
+                loss_gradient = self.w_grad * F.l1_loss(gradient_fused[:, :1], gradient_joint)
+            else:
+                loss_gradient = self.w_grad * F.l1_loss(gradient_fused, torch.max(gradient_A, gradient_B))
+
+        loss_SSIM = zero
+        if self.w_ssim:
+            if self.ssim_weights == 'gradient':
+                mean_A, mean_B = torch.mean(gradient_A), torch.mean(gradient_B)
+                weight_A, weight_B = mean_A / (mean_A + mean_B), mean_B / (mean_A + mean_B)
+            else:
+                weight_A = weight_B = 0.5
+            ssim_A, ssim_B = ssim_pair(image_A, image_B, image_fused)
+            loss_SSIM = self.w_ssim * (1 - (weight_A * ssim_A + weight_B * ssim_B))
+
+        loss_TV = self.w_tv * tv_loss(image_GT, image_fused) if self.w_tv else zero
+
+        fusion_loss = loss_l1 + loss_gradient + loss_SSIM + loss_TV
+        return fusion_loss, loss_gradient, loss_l1, loss_SSIM, loss_TV
+
+
+def define_fusion_loss(task, **kwargs):
+    """FusionLoss of a task in FUSION_LOSSES, kwargs override its settings."""
+    if task not in FUSION_LOSSES:
+        raise NotImplementedError('Fusion loss [{:s}] is not found.'.format(task))
+    opt = dict(FUSION_LOSSES[task])
+    opt.update(kwargs)
+    return FusionLoss(**opt)
@@ -5,6 +5,7 @@ import torch.nn.functional as F
 import math
 from torchvision.models.vgg import vgg16
 import numpy as np
+from models.loss_fusion import FusionLoss, FUSION_LOSSES, Sobelxy, tv_loss
 
 
 class L_color(nn.Module):
@@ -29,64 +30,16 @@ class L_TV(nn.Module):
         super(L_TV, self).__init__()
 
     def forward(self, GT, fused):
-        x1 = fused - GT
-        temp1 = torch.cat((x1[:, :, 1:, :], x1[:, :, -1, :].unsqueeze(2)), 2)
-        temp2 = torch.cat((x1[:, :, :, 1:], x1[:, :, :, -1].unsqueeze(3)), 3)
-        temp = (x1 - temp1)**2 + (x1 - temp2)**2
-
-        
-        return 1 * torch.mean(temp)
-
-class L_Grad(nn.Module):
-    def __init__(self):
-        super(L_Grad, self).__init__()
-        self.sobelconv=Sobelxy()
-
-    def forward(self, image_A, image_B, image_fused):
-        image_A_Y = image_A[:, :1, :, :]
-        image_B_Y = image_B[:, :1, :, :]
-        image_fused_Y = image_fused[:, :1, :, :]
-        gradient_A = self.sobelconv(image_A_Y)
-        gradient_B = self.sobelconv(image_B_Y)
-        gradient_fused = self.sobelconv(image_fused_Y)
-        gradient_joint = torch.max(gradient_A, gradient_B)
-        Loss_gradient = F.l1_loss(gradient_fused, gradient_joint)
-        return Loss_gradient
-
-class Sobelxy(nn.Module):
-    def __init__(self):
-        super(Sobelxy, self).__init__()
-        kernelx = [[-1, 0, 1],
-                  [-2,0 , 2],
-                  [-1, 0, 1]]
-        kernely = [[1, 2, 1],
-                  [0,0 , 0],
-                  [-1, -2, -1]]
-        kernelx = torch.FloatTensor(kernelx).unsqueeze(0).unsqueeze(0)
-        kernely = torch.FloatTensor(kernely).unsqueeze(0).unsqueeze(0)
-        self.weightx = nn.Parameter(data=kernelx, requires_grad=False).cuda()
-        self.weighty = nn.Parameter(data=kernely, requires_grad=False).cuda()
-    def forward(self,x):
-        sobelx=F.conv2d(x, self.weightx, padding=1)
-        sobely=F.conv2d(x, self.weighty, padding=1)
-        return torch.abs(sobelx)+torch.abs(sobely)
-class L_Intensity(nn.Module):
-    def __init__(self):
-        super(L_Intensity, self).__init__()
-
-    def forward(self, image_GT, image_fused):        
-        # intensity_joint = torch.max(image_A, image_B)
-        Loss_intensity = 1 * F.l1_loss(image_fused, image_GT)
-        return Loss_intensity
+        return 1 * tv_loss(GT, fused)
 
 class L_spa(nn.Module):
     def __init__(self):
         super(L_spa, self).__init__()
         # print(1)kernel = torch.FloatTensor(kernel).unsqueeze(0).unsqueeze(0)
-        kernel_left = torch.FloatTensor( [[0,0,0],[-1,1,0],[0,0,0]]).cuda().unsqueeze(0).unsqueeze(0)
-        kernel_right = torch.FloatTensor( [[0,0,0],[0,1,-1],[0,0,0]]).cuda().unsqueeze(0).unsqueeze(0)
-        kernel_up = torch.FloatTensor( [[0,-1,0],[0,1, 0 ],[0,0,0]]).cuda().unsqueeze(0).unsqueeze(0)
-        kernel_down = torch.FloatTensor( [[0,0,0],[0,1, 0],[0,-1,0]]).cuda().unsqueeze(0).unsqueeze(0)
+        kernel_left = torch.FloatTensor( [[0,0,0],[-1,1,0],[0,0,0]]).unsqueeze(0).unsqueeze(0)
+        kernel_right = torch.FloatTensor( [[0,0,0],[0,1,-1],[0,0,0]]).unsqueeze(0).unsqueeze(0)
+        kernel_up = torch.FloatTensor( [[0,-1,0],[0,1, 0 ],[0,0,0]]).unsqueeze(0).unsqueeze(0)
+        kernel_down = torch.FloatTensor( [[0,0,0],[0,1, 0],[0,-1,0]]).unsqueeze(0).unsqueeze(0)
         self.weight_left = nn.Parameter(data=kernel_left, requires_grad=False)
         self.weight_right = nn.Parameter(data=kernel_right, requires_grad=False)
         self.weight_up = nn.Parameter(data=kernel_up, requires_grad=False)
@@ -101,8 +54,8 @@ class L_spa(nn.Module):
         org_pool =  self.pool(org_mean)			
         enhance_pool = self.pool(enhance_mean)	
 
-        weight_diff =torch.max(torch.FloatTensor([1]).cuda() + 10000*torch.min(org_pool - torch.FloatTensor([0.3]).cuda(),torch.FloatTensor([0]).cuda()),torch.FloatTensor([0.5]).cuda())
-        E_1 = torch.mul(torch.sign(enhance_pool - torch.FloatTensor([0.5]).cuda()) ,enhance_pool-org_pool)
+        weight_diff =torch.max(1 + 10000*torch.min(org_pool - 0.3,org_pool.new_zeros(1)),org_pool.new_tensor([0.5]))
+        E_1 = torch.mul(torch.sign(enhance_pool - 0.5) ,enhance_pool-org_pool)
 
 
         D_org_letf = F.conv2d(org_pool , self.weight_left, padding=1)
@@ -135,7 +88,7 @@ class L_exp(nn.Module):
         x = torch.mean(x,1,keepdim=True)
         mean = self.pool(x)
 
-        d = torch.mean(torch.pow(mean- torch.FloatTensor([self.mean_val] ).cuda(),2))
+        d = torch.mean(torch.pow(mean- self.mean_val,2))
         return d
         
 
@@ -173,17 +126,10 @@ class perception_loss(nn.Module):
         # out = (h_relu_1_2, h_relu_2_2, h_relu_3_3, h_relu_4_3)
         return h_relu_4_3
 
-class fusion_loss_gt(nn.Module):
+class fusion_loss_gt(FusionLoss):
     def __init__(self):
-        super(fusion_loss_gt, self).__init__()
-        self.L_TV = L_TV()
-        self.L_Grad = L_Grad()
-        self.L_Inten = L_Intensity()
+        super(fusion_loss_gt, self).__init__(**FUSION_LOSSES['gt'])
 
-        # print(1)
     def forward(self, image_A, image_B, image_fused, image_GT):
-        loss_l1 = 20 * self.L_Inten(image_GT, image_fused)
-        loss_TV = 5 * self.L_TV(image_GT, image_fused)
-        loss_gradient = 10 * self.L_Grad(image_A, image_B, image_fused)
-        fusion_loss = loss_l1 + loss_TV + loss_gradient
+        fusion_loss, loss_gradient, loss_l1, _, loss_TV = super(fusion_loss_gt, self).forward(image_A, image_B, image_fused, image_GT)
         return fusion_loss, loss_TV, loss_gradient, loss_l1
@@ -6,7 +6,7 @@ import math
 from torchvision.models.vgg import vgg16
 import numpy as np
 import torchvision.transforms.functional as TF
-from models.loss_ssim import ssim
+from models.loss_fusion import FusionLoss, FUSION_LOSSES, Sobelxy
 
 class L_color(nn.Module):
 
@@ -26,72 +26,10 @@ class L_color(nn.Module):
         return k
 
 
-class L_SSIM(nn.Module):
+class fusion_loss_med(FusionLoss):
     def __init__(self):
-        super(L_SSIM, self).__init__()
-        self.sobelconv=Sobelxy()
+        super(fusion_loss_med, self).__init__(**FUSION_LOSSES['med'])
 
     def forward(self, image_A, image_B, image_fused):
-        Loss_SSIM = 0.5 * ssim(image_A, image_fused) + 0.5 * ssim(image_B, image_fused)
-        return Loss_SSIM
-
-class L_Grad(nn.Module):
-    def __init__(self):
-        super(L_Grad, self).__init__()
-        self.sobelconv=Sobelxy()
-
-    def forward(self, image_A, image_B, image_fused):
-        image_A_Y = image_A[:, :1, :, :]
-        image_B_Y = image_B[:, :1, :, :]
-        image_fused_Y = image_fused[:, :1, :, :]
-        gradient_A = self.sobelconv(image_A_Y)
-        # gradient_A = TF.gaussian_blur(gradient_A, 3, [1, 1])
-        gradient_B = self.sobelconv(image_B_Y)
-        # gradient_B = TF.gaussian_blur(gradient_B, 3, [1, 1])
-        gradient_fused = self.sobelconv(image_fused_Y)
-        gradient_joint = torch.max(gradient_A, gradient_B)
-        Loss_gradient = F.l1_loss(gradient_fused, gradient_joint)
-        return Loss_gradient
-
-class Sobelxy(nn.Module):
-    def __init__(self):
-        super(Sobelxy, self).__init__()
-        kernelx = [[-1, 0, 1],
-                  [-2,0 , 2],
-                  [-1, 0, 1]]
-        kernely = [[1, 2, 1],
-                  [0,0 , 0],
-                  [-1, -2, -1]]
-        kernelx = torch.FloatTensor(kernelx).unsqueeze(0).unsqueeze(0)
-        kernely = torch.FloatTensor(kernely).unsqueeze(0).unsqueeze(0)
-        self.weightx = nn.Parameter(data=kernelx, requires_grad=False).cuda()
-        self.weighty = nn.Parameter(data=kernely, requires_grad=False).cuda()
-    def forward(self,x):
-        sobelx=F.conv2d(x, self.weightx, padding=1)
-        sobely=F.conv2d(x, self.weighty, padding=1)
-        return torch.abs(sobelx)+torch.abs(sobely)
-
-class L_Intensity(nn.Module):
-    def __init__(self):
-        super(L_Intensity, self).__init__()
-
-    def forward(self, image_A, image_B, image_fused):
-        intensity_joint = torch.max(image_A, image_B)
-        Loss_intensity = F.l1_loss(image_fused, intensity_joint)
-        return Loss_intensity
-
-class fusion_loss_med(nn.Module):
-    def __init__(self):
-        super(fusion_loss_med, self).__init__()
-        self.L_Grad = L_Grad()
-        self.L_Inten = L_Intensity()
-        self.L_SSIM = L_SSIM()
-
-        # print(1)
-    def forward(self, image_A, image_B, image_fused):
-        # image_A represents MRI image
-        loss_l1 = 20 * self.L_Inten(image_A, image_B, image_fused)
-        loss_gradient = 100 * self.L_Grad(image_A, image_B, image_fused)
-        loss_SSIM = 50 * (1 - self.L_SSIM(image_A, image_B, image_fused))
-        fusion_loss = loss_l1 + loss_gradient + loss_SSIM
+        fusion_loss, loss_gradient, loss_l1, loss_SSIM, _ = super(fusion_loss_med, self).forward(image_A, image_B, image_fused)
         return fusion_loss, loss_gradient, loss_l1, loss_SSIM
@@ -6,7 +6,7 @@ import math
 from torchvision.models.vgg import vgg16
 import numpy as np
 import torchvision.transforms.functional as TF
-from models.loss_ssim import ssim
+from models.loss_fusion import FusionLoss, FUSION_LOSSES, Sobelxy
 
 class L_color(nn.Module):
 
@@ -25,76 +25,11 @@ class L_color(nn.Module):
         k = torch.pow(torch.pow(Drg,2) + torch.pow(Drb,2) + torch.pow(Dgb,2),0.5)
         return k
 
-        
-class L_Grad(nn.Module):
-    def __init__(self):
-        super(L_Grad, self).__init__()
-        self.sobelconv=Sobelxy()
-
-    def forward(self, image_A, image_B, image_fused):
-        gradient_A = self.sobelconv(image_A)
-        gradient_B = self.sobelconv(image_B)
-        gradient_fused = self.sobelconv(image_fused)
-        gradient_joint = torch.max(gradient_A, gradient_B)
-        Loss_gradient = F.l1_loss(gradient_fused, gradient_joint)
-        return Loss_gradient
-
-class Sobelxy(nn.Module):
-    def __init__(self):
-        super(Sobelxy, self).__init__()
-        kernelx = [[-1, 0, 1],
-                  [-2,0 , 2],
-                  [-1, 0, 1]]
-        kernely = [[1, 2, 1],
-                  [0,0 , 0],
-                  [-1, -2, -1]]
-        kernelx = torch.FloatTensor(kernelx).unsqueeze(0).unsqueeze(0)
-        kernely = torch.FloatTensor(kernely).unsqueeze(0).unsqueeze(0)
-        self.weightx = nn.Parameter(data=kernelx, requires_grad=False).cuda()
-        self.weighty = nn.Parameter(data=kernely, requires_grad=False).cuda()
-    def forward(self,x):
-        sobelx=F.conv2d(x, self.weightx, padding=1)
-        sobely=F.conv2d(x, self.weighty, padding=1)
-        return torch.abs(sobelx)+torch.abs(sobely)
-
-class L_Intensity(nn.Module):
-    def __init__(self):
-        super(L_Intensity, self).__init__()
-
-    def forward(self, image_A, image_B, image_fused):
-        image_A = image_A.unsqueeze(0)
-        image_B = image_B.unsqueeze(0)      
-        intensity_joint = torch.mean(torch.cat([image_A, image_B]), dim=0)
-        # print('intensity_joint shape:', intensity_joint.shape)
-        # intensity_joint = torch.max(image_A, image_B)
-        Loss_intensity = F.l1_loss(image_fused, intensity_joint)
-        return Loss_intensity
-
-class L_SSIM(nn.Module):
-    def __init__(self):
-        super(L_SSIM, self).__init__()
-        self.sobelconv=Sobelxy()
-
-    def forward(self, image_A, image_B, image_fused):
-        gradient_A = self.sobelconv(image_A)
-        gradient_B = self.sobelconv(image_B)
-        weight_A = torch.mean(gradient_A) / (torch.mean(gradient_A) + torch.mean(gradient_B))
-        weight_B = torch.mean(gradient_B) / (torch.mean(gradient_A) + torch.mean(gradient_B))
-        Loss_SSIM = weight_A * ssim(image_A, image_fused) + weight_B * ssim(image_B, image_fused)
-        return Loss_SSIM
-
 
-class fusion_loss_mff(nn.Module):
+class fusion_loss_mff(FusionLoss):
     def __init__(self):
-        super(fusion_loss_mff, self).__init__()
-        self.L_Grad = L_Grad()
-        self.L_Inten = L_Intensity()
-        self.L_SSIM = L_SSIM()
+        super(fusion_loss_mff, self).__init__(**FUSION_LOSSES['mff'])
 
-        # print(1)
     def forward(self, image_A, image_B, image_fused):
-        loss_l1 = 20 * self.L_Inten(image_A, image_B, image_fused)
-        loss_gradient = 20 * self.L_Grad(image_A, image_B, image_fused)
-        loss_SSIM = 10 * (1 - self.L_SSIM(image_A, image_B, image_fused))
-        fusion_loss = loss_l1 + loss_gradient + loss_SSIM
+        fusion_loss, loss_gradient, loss_l1, loss_SSIM, _ = super(fusion_loss_mff, self).forward(image_A, image_B, image_fused)
         return fusion_loss, loss_gradient, loss_l1, loss_SSIM
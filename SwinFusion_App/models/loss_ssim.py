@@ -3,6 +3,7 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 import numpy as np
 from math import exp
+from functools import lru_cache
 
 """
 # ============================================
@@ -24,6 +25,12 @@ def create_window(window_size, channel):
     return window
 
 
+@lru_cache(maxsize=None)
+def get_window(window_size, channel, device=None, dtype=None):
+    """create_window, built once per (window_size, channel, device, dtype)."""
+    return create_window(window_size, channel).to(device=device, dtype=dtype)
+
+
 def _ssim(img1, img2, window, window_size, channel, size_average=True):
     mu1 = F.conv2d(img1, window, padding=window_size//2, groups=channel)
     mu2 = F.conv2d(img2, window, padding=window_size//2, groups=channel)
@@ -45,11 +52,38 @@ def _ssim(img1, img2, window, window_size, channel, size_average=True):
     else:
         return ssim_map.mean(1).mean(1).mean(1)
 
+
+def ssim_pair(img_A, img_B, img_F, window_size=11, size_average=True):
+    """(ssim(img_A, img_F), ssim(img_B, img_F)) with one convolution.
+
+    The eight blurred maps (A, B, F, A*A, B*B, F*F, A*F, B*F) are stacked along the channels and
+    filtered by a single grouped conv2d; mu_F and sigma_F are shared by both pairs.
+    """
+    (_, channel, _, _) = img_F.size()
+    window = get_window(window_size, 8 * channel, img_F.device, img_F.dtype)
+    x = torch.cat([img_A, img_B, img_F, img_A*img_A, img_B*img_B, img_F*img_F, img_A*img_F, img_B*img_F], dim=1)
+    mu_A, mu_B, mu_F, AA, BB, FF, AF, BF = F.conv2d(x, window, padding=window_size//2, groups=8*channel).chunk(8, dim=1)
+
+    C1 = 0.01**2
+    C2 = 0.03**2
+
+    mu_F_sq = mu_F.pow(2)
+    sigma_F_sq = FF - mu_F_sq
+
+    def _map(mu1, E11, E1F):
+        mu1_sq = mu1.pow(2)
+        mu1_mu2 = mu1*mu_F
+        ssim_map = ((2*mu1_mu2 + C1)*(2*(E1F - mu1_mu2) + C2))/((mu1_sq + mu_F_sq + C1)*(E11 - mu1_sq + sigma_F_sq + C2))
+        if size_average:
+            return ssim_map.mean()
+        else:
+            return ssim_map.mean(1).mean(1).mean(1)
+
+    return _map(mu_A, AA, AF), _map(mu_B, BB, BF)
+
+
 def Contrast(img1, img2, window_size=11, channel=1):
-    window = create_window(window_size, channel)    
-    if img1.is_cuda:
-        window = window.cuda(img1.get_device())
-    window = window.type_as(img1)
+    window = get_window(window_size, channel, img1.device, img1.dtype)
     mu1 = F.conv2d(img1, window, padding=window_size//2, groups=channel)
     mu2 = F.conv2d(img2, window, padding=window_size//2, groups=channel)
 
@@ -72,14 +106,10 @@ class SSIMLoss(torch.nn.Module):
 
     def forward(self, img1, img2):
         (_, channel, _, _) = img1.size()
-        if channel == self.channel and self.window.data.type() == img1.data.type():
+        if channel == self.channel and self.window.device == img1.device and self.window.dtype == img1.dtype:
             window = self.window
         else:
-            window = create_window(self.window_size, channel)
-
-            if img1.is_cuda:
-                window = window.cuda(img1.get_device())
-            window = window.type_as(img1)
+            window = get_window(self.window_size, channel, img1.device, img1.dtype)
 
             self.window = window
             self.channel = channel
@@ -89,12 +119,7 @@ class SSIMLoss(torch.nn.Module):
 
 def ssim(img1, img2, window_size=11, size_average=True):
     (_, channel, _, _) = img1.size()
-    window = create_window(window_size, channel)
-    
-    if img1.is_cuda:
-        window = window.cuda(img1.get_device())
-    window = window.type_as(img1)
-    
+    window = get_window(window_size, channel, img1.device, img1.dtype)
     return _ssim(img1, img2, window, window_size, channel, size_average)
 
 
@@ -2,6 +2,8 @@ import os
 import torch
 import torch.nn as nn
 from utils.utils_bnorm import merge_bn, tidy_sequential
+from utils.utils_model import load_checkpoint
+from utils.utils_swin import strip_shared_buffers
 from torch.nn.parallel import DataParallel, DistributedDataParallel
 
 
@@ -156,15 +158,14 @@ class ModelBase():
     # ----------------------------------------
     def load_network(self, load_path, network, strict=True, param_key='params'):
         network = self.get_bare_model(network)
+        # memory-mapped: the tensors are read from the page cache as load_state_dict copies them,
+        # network.state_dict() holds views of the parameters, not copies
         if strict:
-            state_dict = torch.load(load_path)
-            if param_key in state_dict.keys():
-                state_dict = state_dict[param_key]
+            state_dict = load_checkpoint(load_path, param_key=param_key)
             network.load_state_dict(state_dict, strict=strict)
         else:
-            state_dict_old = torch.load(load_path)
-            if param_key in state_dict_old.keys():
-                state_dict_old = state_dict_old[param_key]
+            # the per-block masks/indices of older checkpoints are not in the network any more, keep the keys aligned
+            state_dict_old = strip_shared_buffers(load_checkpoint(load_path, param_key=param_key))
             state_dict = network.state_dict()
             for ((key_old, param_old),(key, param)) in zip(state_dict_old.items(), state_dict.items()):
                 state_dict[key] = param_old
@@ -9,6 +9,7 @@ from models.select_network import define_G
 from models.model_base import ModelBase
 from models.loss import CharbonnierLoss
 from models.loss_ssim import SSIMLoss
+from models.loss_fusion import FUSION_LOSSES, define_fusion_loss
 import os
 
 from torch.utils.tensorboard import SummaryWriter
@@ -111,24 +112,9 @@ class ModelPlain(ModelBase):
         elif G_lossfn_type == 'loe':
             from models.loss_loe import loe_loss            
             self.G_lossfn = loe_loss().to(self.device)
-        elif G_lossfn_type == 'mef':
-            from models.loss_mef import fusion_loss_mef
-            self.G_lossfn = fusion_loss_mef().to(self.device)
-        elif G_lossfn_type == 'vif':
-            from models.loss_vif import fusion_loss_vif
-            self.G_lossfn = fusion_loss_vif().to(self.device)
-        elif G_lossfn_type == 'mff':            
-            from models.loss_mff import fusion_loss_mff
-            self.G_lossfn = fusion_loss_mff().to(self.device)
-        elif G_lossfn_type == 'nir':            
-            from models.loss_nir import fusion_loss_nir
-            self.G_lossfn = fusion_loss_nir().to(self.device)
-        elif G_lossfn_type == 'med':            
-            from models.loss_med import fusion_loss_med
-            self.G_lossfn = fusion_loss_med().to(self.device)
-        elif G_lossfn_type == 'gt':            
-            from models.loss_gt import fusion_loss_gt
-            self.G_lossfn = fusion_loss_gt().to(self.device)
+        elif G_lossfn_type in FUSION_LOSSES:
+            # per-task weights of FUSION_LOSSES, optionally overridden by opt_train['G_fusion_loss']
+            self.G_lossfn = define_fusion_loss(G_lossfn_type, **(self.opt_train.get('G_fusion_loss') or {})).to(self.device)
         else:
             raise NotImplementedError('Loss type [{:s}] is not found.'.format(G_lossfn_type))
         self.G_lossfn_weight = self.opt_train['G_lossfn_weight']
@@ -187,11 +173,11 @@ class ModelPlain(ModelBase):
         self.netG_forward()
         G_lossfn_type = self.opt_train['G_lossfn_type']
         ## constructe loss function
-        if G_lossfn_type in ['loe', 'gt']:
+        if G_lossfn_type == 'loe':
             loe_loss, loss_tv, loss_grad, loss_l1 = self.G_lossfn(self.A, self.B, self.E, self.GT)   
             G_loss = self.G_lossfn_weight * loe_loss   
-        elif G_lossfn_type in ['mef', 'mff', 'vif', 'nir', 'med']:
-            total_loss, loss_text, loss_int, loss_ssim = self.G_lossfn(self.A, self.B, self.E)
+        elif G_lossfn_type in FUSION_LOSSES:
+            total_loss, loss_text, loss_int, loss_ssim, loss_tv = self.G_lossfn(self.A, self.B, self.E, getattr(self, 'GT', None))
             G_loss = self.G_lossfn_weight * total_loss      
         else:
             G_loss = self.G_lossfn_weight * self.G_lossfn(self.E, self.GT)
@@ -9,6 +9,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.checkpoint as checkpoint
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
+from utils.utils_swin import LRUCache, build_attn_mask, get_attn_mask, get_relative_position_index, fuse_attn_mask, conv2d_flops, resolve_attn_backend, window_attention, run_branches
 
 
 class Mlp(nn.Module):
@@ -56,7 +57,7 @@ def window_reverse(windows, window_size, H, W):
     Returns:
         x: (B, H, W, C)
     """
-    B = int(windows.shape[0] / (H * W / window_size / window_size))
+    B = windows.shape[0] // ((H // window_size) * (W // window_size))
     x = windows.view(B, H // window_size, W // window_size, window_size, window_size, -1)
     x = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(B, H, W, -1)
     return x
@@ -89,19 +90,6 @@ class WindowAttention(nn.Module):
         self.relative_position_bias_table = nn.Parameter(
             torch.zeros((2 * window_size[0] - 1) * (2 * window_size[1] - 1), num_heads))  # 2*Wh-1 * 2*Ww-1, nH
 
-        # get pair-wise relative position index for each token inside the window
-        coords_h = torch.arange(self.window_size[0])
-        coords_w = torch.arange(self.window_size[1])
-        coords = torch.stack(torch.meshgrid([coords_h, coords_w]))  # 2, Wh, Ww
-        coords_flatten = torch.flatten(coords, 1)  # 2, Wh*Ww
-        relative_coords = coords_flatten[:, :, None] - coords_flatten[:, None, :]  # 2, Wh*Ww, Wh*Ww
-        relative_coords = relative_coords.permute(1, 2, 0).contiguous()  # Wh*Ww, Wh*Ww, 2
-        relative_coords[:, :, 0] += self.window_size[0] - 1  # shift to start from 0
-        relative_coords[:, :, 1] += self.window_size[1] - 1
-        relative_coords[:, :, 0] *= 2 * self.window_size[1] - 1
-        relative_position_index = relative_coords.sum(-1)  # Wh*Ww, Wh*Ww
-        self.register_buffer("relative_position_index", relative_position_index)
-
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
@@ -110,32 +98,44 @@ class WindowAttention(nn.Module):
 
         trunc_normal_(self.relative_position_bias_table, std=.02)
         self.softmax = nn.Softmax(dim=-1)
+        self._frozen_bias = None
+        self.attn_backend = 'math'
+        self.attn_chunk_size = 64
 
     def forward(self, x, mask=None):
         """
         Args:
             x: input features with shape of (num_windows*B, N, C)
-            mask: (0/-inf) mask with shape of (num_windows, Wh*Ww, Wh*Ww) or None
+            mask: (0/-inf) mask with shape of (num_windows, Wh*Ww, Wh*Ww), mask with the relative position bias
+                pre-added with shape of (num_windows, nH, Wh*Ww, Wh*Ww), or None
         """
         B_, N, C = x.shape
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
+        if self.attn_backend != 'math':
+            x = window_attention(q, k, v, self.attn_bias(mask), self.scale, self.attn_backend,
+                                 dropout_p=self.attn_drop.p if self.training else 0., chunk_size=self.attn_chunk_size)
+            x = x.transpose(1, 2).reshape(B_, N, C)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x
+
         q = q * self.scale
         attn = (q @ k.transpose(-2, -1))
 
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-        attn = attn + relative_position_bias.unsqueeze(0)
-
-        if mask is not None:
+        if mask is not None and mask.dim() == 4:
+            # relative position bias already pre-added to the mask, see freeze()
             nW = mask.shape[0]
-            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
+            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(0)
             attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
         else:
-            attn = self.softmax(attn)
+            attn = attn + self.relative_position_bias().unsqueeze(0)
+            if mask is not None:
+                nW = mask.shape[0]
+                attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
+                attn = attn.view(-1, self.num_heads, N, N)
+        attn = self.softmax(attn)
 
         attn = self.attn_drop(attn)
 
@@ -144,6 +144,45 @@ class WindowAttention(nn.Module):
         x = self.proj_drop(x)
         return x
 
+    @property
+    def relative_position_index(self):
+        # pair-wise relative position index of the tokens of a window, one tensor shared by every attention module
+        return get_relative_position_index(self.window_size, self.relative_position_bias_table.device)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints before the shared index carry a copy per module
+        state_dict.pop(prefix + 'relative_position_index', None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def relative_position_bias(self):
+        if self._frozen_bias is not None:
+            return self._frozen_bias
+        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
+            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
+        return relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+
+    def attn_bias(self, mask=None):
+        # additive attention bias (relative position bias + SW-MSA mask) for the fused backends
+        if mask is None:
+            return self.relative_position_bias()
+        if mask.dim() == 4:
+            return mask
+        return fuse_attn_mask(self.relative_position_bias(), mask)
+
+    def set_backend(self, backend, chunk_size=None):
+        self.attn_backend = resolve_attn_backend(backend)
+        if chunk_size is not None:
+            self.attn_chunk_size = chunk_size
+
+    def freeze(self):
+        # materialize the relative position bias once, weights are fixed at inference
+        self._frozen_bias = None
+        with torch.no_grad():
+            self._frozen_bias = self.relative_position_bias().detach()
+
+    def unfreeze(self):
+        self._frozen_bias = None
+
     def extra_repr(self) -> str:
         return f'dim={self.dim}, window_size={self.window_size}, num_heads={self.num_heads}'
 
@@ -187,19 +226,6 @@ class Cross_WindowAttention(nn.Module):
         self.relative_position_bias_table = nn.Parameter(
             torch.zeros((2 * window_size[0] - 1) * (2 * window_size[1] - 1), num_heads))  # 2*Wh-1 * 2*Ww-1, nH
 
-        # get pair-wise relative position index for each token inside the window
-        coords_h = torch.arange(self.window_size[0])
-        coords_w = torch.arange(self.window_size[1])
-        coords = torch.stack(torch.meshgrid([coords_h, coords_w]))  # 2, Wh, Ww
-        coords_flatten = torch.flatten(coords, 1)  # 2, Wh*Ww
-        relative_coords = coords_flatten[:, :, None] - coords_flatten[:, None, :]  # 2, Wh*Ww, Wh*Ww
-        relative_coords = relative_coords.permute(1, 2, 0).contiguous()  # Wh*Ww, Wh*Ww, 2
-        relative_coords[:, :, 0] += self.window_size[0] - 1  # shift to start from 0
-        relative_coords[:, :, 1] += self.window_size[1] - 1
-        relative_coords[:, :, 0] *= 2 * self.window_size[1] - 1
-        relative_position_index = relative_coords.sum(-1)  # Wh*Ww, Wh*Ww
-        self.register_buffer("relative_position_index", relative_position_index)
-
         self.q = nn.Linear(dim, dim, bias=qkv_bias)
         self.kv = nn.Linear(dim, dim*2 , bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
@@ -209,34 +235,46 @@ class Cross_WindowAttention(nn.Module):
 
         trunc_normal_(self.relative_position_bias_table, std=.02)
         self.softmax = nn.Softmax(dim=-1)
+        self._frozen_bias = None
+        self.attn_backend = 'math'
+        self.attn_chunk_size = 64
 
     def forward(self, x, y, mask=None):
         """
         Args:
             x: input features with shape of (num_windows*B, N, C), which maps query
             y: input features with shape of (num_windows*B, N, C), which maps key and value
-            mask: (0/-inf) mask with shape of (num_windows, Wh*Ww, Wh*Ww) or None
+            mask: (0/-inf) mask with shape of (num_windows, Wh*Ww, Wh*Ww), mask with the relative position bias
+                pre-added with shape of (num_windows, nH, Wh*Ww, Wh*Ww), or None
         """
         B_, N, C = x.shape
         q = self.q(x).reshape(B_, N, 1, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         kv = self.kv(y).reshape(B_, N, 2, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = q[0], kv[0], kv[1]  # make torchscript happy (cannot use tensor as tuple)
 
+        if self.attn_backend != 'math':
+            x = window_attention(q, k, v, self.attn_bias(mask), self.scale, self.attn_backend,
+                                 dropout_p=self.attn_drop.p if self.training else 0., chunk_size=self.attn_chunk_size)
+            x = x.transpose(1, 2).reshape(B_, N, C)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x
+
         q = q * self.scale
         attn = (q @ k.transpose(-2, -1))
 
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-        attn = attn + relative_position_bias.unsqueeze(0)
-
-        if mask is not None:
+        if mask is not None and mask.dim() == 4:
+            # relative position bias already pre-added to the mask, see freeze()
             nW = mask.shape[0]
-            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
+            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(0)
             attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
         else:
-            attn = self.softmax(attn)
+            attn = attn + self.relative_position_bias().unsqueeze(0)
+            if mask is not None:
+                nW = mask.shape[0]
+                attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
+                attn = attn.view(-1, self.num_heads, N, N)
+        attn = self.softmax(attn)
 
         attn = self.attn_drop(attn)
 
@@ -245,6 +283,45 @@ class Cross_WindowAttention(nn.Module):
         x = self.proj_drop(x)
         return x
 
+    @property
+    def relative_position_index(self):
+        # pair-wise relative position index of the tokens of a window, one tensor shared by every attention module
+        return get_relative_position_index(self.window_size, self.relative_position_bias_table.device)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints before the shared index carry a copy per module
+        state_dict.pop(prefix + 'relative_position_index', None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def relative_position_bias(self):
+        if self._frozen_bias is not None:
+            return self._frozen_bias
+        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
+            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
+        return relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+
+    def attn_bias(self, mask=None):
+        # additive attention bias (relative position bias + SW-MSA mask) for the fused backends
+        if mask is None:
+            return self.relative_position_bias()
+        if mask.dim() == 4:
+            return mask
+        return fuse_attn_mask(self.relative_position_bias(), mask)
+
+    def set_backend(self, backend, chunk_size=None):
+        self.attn_backend = resolve_attn_backend(backend)
+        if chunk_size is not None:
+            self.attn_chunk_size = chunk_size
+
+    def freeze(self):
+        # materialize the relative position bias once, weights are fixed at inference
+        self._frozen_bias = None
+        with torch.no_grad():
+            self._frozen_bias = self.relative_position_bias().detach()
+
+    def unfreeze(self):
+        self._frozen_bias = None
+
     def extra_repr(self) -> str:
         return f'dim={self.dim}, window_size={self.window_size}, num_heads={self.num_heads}'
 
@@ -267,7 +344,7 @@ class SwinTransformerBlock(nn.Module):
 
     Args:
         dim (int): Number of input channels.
-        input_resolution (tuple[int]): Input resulotion.
+        input_resolution (tuple[int] | None): Input resulotion, None if the model is built for any input size.
         num_heads (int): Number of attention heads.
         window_size (int): Window size.
         shift_size (int): Shift size for SW-MSA.
@@ -291,7 +368,7 @@ class SwinTransformerBlock(nn.Module):
         self.window_size = window_size
         self.shift_size = shift_size
         self.mlp_ratio = mlp_ratio
-        if min(self.input_resolution) <= self.window_size:
+        if self.input_resolution is not None and min(self.input_resolution) <= self.window_size:
             # if window size is larger than input resolution, we don't partition windows
             self.shift_size = 0
             self.window_size = min(self.input_resolution)
@@ -307,35 +384,21 @@ class SwinTransformerBlock(nn.Module):
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
-        if self.shift_size > 0:
-            attn_mask = self.calculate_mask(self.input_resolution)
-        else:
-            attn_mask = None
-
-        self.register_buffer("attn_mask", attn_mask)
+        self._fused_masks = None
 
     def calculate_mask(self, x_size):
         # calculate attention mask for SW-MSA
         H, W = x_size
-        img_mask = torch.zeros((1, H, W, 1))  # 1 H W 1
-        h_slices = (slice(0, -self.window_size),
-                    slice(-self.window_size, -self.shift_size),
-                    slice(-self.shift_size, None))
-        w_slices = (slice(0, -self.window_size),
-                    slice(-self.window_size, -self.shift_size),
-                    slice(-self.shift_size, None))
-        cnt = 0
-        for h in h_slices:
-            for w in w_slices:
-                img_mask[:, h, w, :] = cnt
-                cnt += 1
-
-        mask_windows = window_partition(img_mask, self.window_size)  # nW, window_size, window_size, 1
-        mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
-        attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-        attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
-
-        return attn_mask
+        return build_attn_mask(H, W, self.window_size, self.shift_size)
+
+    def get_mask(self, x_size, device, dtype):
+        # one mask per (resolution, window_size, shift_size, device, dtype) shared by every block, None for W-MSA
+        return get_attn_mask(x_size, self.window_size, self.shift_size, device, dtype)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints before the shared masks carry a copy per block
+        state_dict.pop(prefix + 'attn_mask', None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x, x_size):
         H, W = x_size
@@ -357,10 +420,11 @@ class SwinTransformerBlock(nn.Module):
         x_windows = x_windows.view(-1, self.window_size * self.window_size, C)  # nW*B, window_size*window_size, C
 
         # W-MSA/SW-MSA (to be compatible for testing on images whose shapes are the multiple of window size
-        if self.input_resolution == x_size:
-            attn_windows = self.attn(x_windows, mask=self.attn_mask)  # nW*B, window_size*window_size, C
-        else:
-            attn_windows = self.attn(x_windows, mask=self.calculate_mask(x_size).to(x.device))
+        attn_mask = self.get_mask(x_size, x.device, x.dtype)
+        if self._fused_masks is not None and attn_mask is not None:
+            attn_mask = self._fused_masks.get_or_create(
+                (x_size, x.device, x.dtype), lambda: fuse_attn_mask(self.attn.relative_position_bias(), attn_mask))
+        attn_windows = self.attn(x_windows, mask=attn_mask)  # nW*B, window_size*window_size, C
 
         # merge windows
         attn_windows = attn_windows.view(-1, self.window_size, self.window_size, C)
@@ -379,13 +443,21 @@ class SwinTransformerBlock(nn.Module):
 
         return x
 
+    def freeze(self, fuse_mask=False):
+        self.attn.freeze()
+        self._fused_masks = LRUCache(maxsize=4) if fuse_mask and self.shift_size > 0 else None
+
+    def unfreeze(self):
+        self.attn.unfreeze()
+        self._fused_masks = None
+
     def extra_repr(self) -> str:
         return f"dim={self.dim}, input_resolution={self.input_resolution}, num_heads={self.num_heads}, " \
                f"window_size={self.window_size}, shift_size={self.shift_size}, mlp_ratio={self.mlp_ratio}"
 
-    def flops(self):
+    def flops(self, x_size=None):
         flops = 0
-        H, W = self.input_resolution
+        H, W = x_size or self.input_resolution
         # norm1
         flops += self.dim * H * W
         # W-MSA/SW-MSA
@@ -402,7 +474,7 @@ class Cross_SwinTransformerBlock(nn.Module):
 
     Args:
         dim (int): Number of input channels.
-        input_resolution (tuple[int]): Input resulotion.
+        input_resolution (tuple[int] | None): Input resulotion, None if the model is built for any input size.
         num_heads (int): Number of attention heads.
         window_size (int): Window size.
         shift_size (int): Shift size for SW-MSA.
@@ -426,7 +498,7 @@ class Cross_SwinTransformerBlock(nn.Module):
         self.window_size = window_size
         self.shift_size = shift_size
         self.mlp_ratio = mlp_ratio
-        if min(self.input_resolution) <= self.window_size:
+        if self.input_resolution is not None and min(self.input_resolution) <= self.window_size:
             # if window size is larger than input resolution, we don't partition windows
             self.shift_size = 0
             self.window_size = min(self.input_resolution)
@@ -451,37 +523,26 @@ class Cross_SwinTransformerBlock(nn.Module):
         self.mlp_A = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
         self.mlp_B = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
-        if self.shift_size > 0:
-            attn_mask = self.calculate_mask(self.input_resolution)
-        else:
-            attn_mask = None
-
-        self.register_buffer("attn_mask", attn_mask)
+        self._fused_masks = None
+        self._stacked = None
 
     def calculate_mask(self, x_size):
         # calculate attention mask for SW-MSA
         H, W = x_size
-        img_mask = torch.zeros((1, H, W, 1))  # 1 H W 1
-        h_slices = (slice(0, -self.window_size),
-                    slice(-self.window_size, -self.shift_size),
-                    slice(-self.shift_size, None))
-        w_slices = (slice(0, -self.window_size),
-                    slice(-self.window_size, -self.shift_size),
-                    slice(-self.shift_size, None))
-        cnt = 0
-        for h in h_slices:
-            for w in w_slices:
-                img_mask[:, h, w, :] = cnt
-                cnt += 1
-
-        mask_windows = window_partition(img_mask, self.window_size)  # nW, window_size, window_size, 1
-        mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
-        attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-        attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
-
-        return attn_mask
+        return build_attn_mask(H, W, self.window_size, self.shift_size)
+
+    def get_mask(self, x_size, device, dtype):
+        # one mask per (resolution, window_size, shift_size, device, dtype) shared by every block, None for W-MSA
+        return get_attn_mask(x_size, self.window_size, self.shift_size, device, dtype)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints before the shared masks carry a copy per block
+        state_dict.pop(prefix + 'attn_mask', None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x, y, x_size):
+        if self._stacked is not None and not self.training:
+            return self.forward_batched(x, y, x_size)
         H, W = x_size
         B, L, C = x.shape
         # assert L == H * W, "input feature has wrong size"
@@ -508,12 +569,15 @@ class Cross_SwinTransformerBlock(nn.Module):
         y_windows = y_windows.view(-1, self.window_size * self.window_size, C)  # nW*B, window_size*window_size, C
 
         # W-MSA/SW-MSA (to be compatible for testing on images whose shapes are the multiple of window size
-        if self.input_resolution == x_size:
-            attn_windows_A = self.attn_A(x_windows, y_windows, mask=self.attn_mask)  # nW*B, window_size*window_size, C
-            attn_windows_B = self.attn_B(y_windows, x_windows, mask=self.attn_mask)  # nW*B, window_size*window_size, C
-        else:
-            attn_windows_A = self.attn_A(x_windows, y_windows, mask=self.calculate_mask(x_size).to(x.device))
-            attn_windows_B = self.attn_B(y_windows, x_windows, mask=self.calculate_mask(x_size).to(y.device))
+        attn_mask = self.get_mask(x_size, x.device, x.dtype)
+        attn_mask_A = attn_mask_B = attn_mask
+        if self._fused_masks is not None and attn_mask is not None:
+            attn_mask_A = self._fused_masks.get_or_create(
+                ('A', x_size, x.device, x.dtype), lambda: fuse_attn_mask(self.attn_A.relative_position_bias(), attn_mask))
+            attn_mask_B = self._fused_masks.get_or_create(
+                ('B', x_size, x.device, x.dtype), lambda: fuse_attn_mask(self.attn_B.relative_position_bias(), attn_mask))
+        attn_windows_A = self.attn_A(x_windows, y_windows, mask=attn_mask_A)  # nW*B, window_size*window_size, C
+        attn_windows_B = self.attn_B(y_windows, x_windows, mask=attn_mask_B)  # nW*B, window_size*window_size, C
 
         # merge windows
         attn_windows_A = attn_windows_A.view(-1, self.window_size, self.window_size, C)
@@ -539,22 +603,123 @@ class Cross_SwinTransformerBlock(nn.Module):
         y = y + self.drop_path_B(self.mlp_B(self.norm2_B(y)))
         return x, y
 
+    def forward_batched(self, x, y, x_size):
+        """Inference path running branch A (x queries y) and branch B (y queries x) as one batched op.
+
+        The A/B weights are stacked along a leading branch dimension by freeze(batch_cross=True), so
+        LayerNorm, roll, window partition, attention and MLP run once over both branches.
+        """
+        H, W = x_size
+        B, L, C = x.shape
+        w = self._stacked
+        nH = self.attn_A.num_heads
+        N = self.window_size * self.window_size
+
+        shortcut = torch.stack([x, y])  # 2, B, L, C
+        xy = torch.addcmul(w['norm1_bias'], F.layer_norm(shortcut, (C,), eps=self.norm1_A.eps), w['norm1_weight'])
+        xy = xy.view(2 * B, H, W, C)
+
+        # cyclic shift
+        if self.shift_size > 0:
+            xy = torch.roll(xy, shifts=(-self.shift_size, -self.shift_size), dims=(1, 2))
+
+        # partition windows
+        windows = window_partition(xy, self.window_size).view(2, -1, C)  # 2, nW*B*window_size*window_size, C
+        B_ = windows.shape[1] // N
+
+        # branch A takes query from x and key/value from y, branch B the other way round
+        q = torch.baddbmm(w['q_bias'], windows, w['q_weight'])
+        kv = torch.baddbmm(w['kv_bias'], windows.flip(0), w['kv_weight'])
+        q = q.view(2, B_, N, nH, C // nH).permute(1, 0, 3, 2, 4).reshape(B_, 2 * nH, N, C // nH)
+        kv = kv.view(2, B_, N, 2, nH, C // nH).permute(3, 1, 0, 4, 2, 5).reshape(2, B_, 2 * nH, N, C // nH)
+
+        # W-MSA/SW-MSA, the heads of both branches side by side
+        attn_bias = w['relative_position_bias']  # 2*nH, N, N
+        attn_mask = self.get_mask(x_size, x.device, x.dtype)
+        if attn_mask is not None:
+            if self._fused_masks is not None:
+                attn_bias = self._fused_masks.get_or_create(
+                    ('AB', x_size, x.device, x.dtype), lambda: fuse_attn_mask(w['relative_position_bias'], attn_mask))
+            else:
+                attn_bias = fuse_attn_mask(attn_bias, attn_mask)
+        xy = window_attention(q, kv[0], kv[1], attn_bias, self.attn_A.scale, self.attn_A.attn_backend,
+                              chunk_size=self.attn_A.attn_chunk_size)
+        xy = xy.view(B_, 2, nH, N, C // nH).permute(1, 0, 3, 2, 4).reshape(2, B_ * N, C)
+        xy = torch.baddbmm(w['proj_bias'], xy, w['proj_weight'])
+
+        # merge windows
+        xy = window_reverse(xy.view(2 * B_, self.window_size, self.window_size, C), self.window_size, H, W)  # 2B H' W' C
+
+        # reverse cyclic shift
+        if self.shift_size > 0:
+            xy = torch.roll(xy, shifts=(self.shift_size, self.shift_size), dims=(1, 2))
+        xy = shortcut + xy.view(2, B, H * W, C)
+
+        # FFN
+        h = torch.addcmul(w['norm2_bias'], F.layer_norm(xy, (C,), eps=self.norm2_A.eps), w['norm2_weight'])
+        h = self.mlp_A.act(torch.baddbmm(w['fc1_bias'], h.view(2, B * L, C), w['fc1_weight']))
+        h = torch.baddbmm(w['fc2_bias'], h, w['fc2_weight'])
+        xy = xy + h.view(2, B, L, C)
+        return xy[0], xy[1]
+
+    def stack_weights(self):
+        # stack the A/B weights along a leading branch dimension for forward_batched()
+        def stack(a, b):
+            return torch.stack([a.detach(), b.detach()])
+
+        def linear(a, b):
+            # 2, in, out weight and 2, 1, out bias for torch.baddbmm
+            bias_a = a.bias if a.bias is not None else a.weight.new_zeros(a.out_features)
+            bias_b = b.bias if b.bias is not None else b.weight.new_zeros(b.out_features)
+            return stack(a.weight, b.weight).transpose(1, 2).contiguous(), stack(bias_a, bias_b).unsqueeze(1)
+
+        w = {}
+        with torch.no_grad():
+            for name, a, b in (('norm1', self.norm1_A, self.norm1_B), ('norm2', self.norm2_A, self.norm2_B)):
+                w[name + '_weight'] = stack(a.weight, b.weight).view(2, 1, 1, -1)
+                w[name + '_bias'] = stack(a.bias, b.bias).view(2, 1, 1, -1)
+            for name, a, b in (('q', self.attn_A.q, self.attn_B.q), ('kv', self.attn_A.kv, self.attn_B.kv),
+                               ('proj', self.attn_A.proj, self.attn_B.proj),
+                               ('fc1', self.mlp_A.fc1, self.mlp_B.fc1), ('fc2', self.mlp_A.fc2, self.mlp_B.fc2)):
+                w[name + '_weight'], w[name + '_bias'] = linear(a, b)
+            w['relative_position_bias'] = torch.cat(
+                [self.attn_A.relative_position_bias(), self.attn_B.relative_position_bias()], 0).detach()
+        return w
+
+    def freeze(self, fuse_mask=False, batch_cross=False):
+        self.attn_A.freeze()
+        self.attn_B.freeze()
+        self._fused_masks = LRUCache(maxsize=8) if fuse_mask and self.shift_size > 0 else None
+        batchable = all(isinstance(m, nn.LayerNorm) and m.elementwise_affine
+                        for m in (self.norm1_A, self.norm1_B, self.norm2_A, self.norm2_B))
+        # float weights only, quantized Linear layers (utils_quant) keep the two sequential branches
+        batchable = batchable and all(type(m) is nn.Linear for m in (
+            self.attn_A.q, self.attn_A.kv, self.attn_A.proj, self.attn_B.q, self.attn_B.kv, self.attn_B.proj,
+            self.mlp_A.fc1, self.mlp_A.fc2, self.mlp_B.fc1, self.mlp_B.fc2))
+        self._stacked = self.stack_weights() if batch_cross and batchable else None
+
+    def unfreeze(self):
+        self.attn_A.unfreeze()
+        self.attn_B.unfreeze()
+        self._fused_masks = None
+        self._stacked = None
+
     def extra_repr(self) -> str:
         return f"dim={self.dim}, input_resolution={self.input_resolution}, num_heads={self.num_heads}, " \
                f"window_size={self.window_size}, shift_size={self.shift_size}, mlp_ratio={self.mlp_ratio}"
 
-    def flops(self):
+    def flops(self, x_size=None):
         flops = 0
-        H, W = self.input_resolution
-        # norm1
-        flops += self.dim * H * W
-        # W-MSA/SW-MSA
+        H, W = x_size or self.input_resolution
+        # norm1_A, norm1_B
+        flops += 2 * self.dim * H * W
+        # W-MSA/SW-MSA, A attends to B and B to A
         nW = H * W / self.window_size / self.window_size
-        flops += nW * self.attn.flops(self.window_size * self.window_size)
-        # mlp
-        flops += 2 * H * W * self.dim * self.dim * self.mlp_ratio
-        # norm2
-        flops += self.dim * H * W
+        flops += nW * (self.attn_A.flops(self.window_size * self.window_size) + self.attn_B.flops(self.window_size * self.window_size))
+        # mlp_A, mlp_B
+        flops += 2 * 2 * H * W * self.dim * self.dim * self.mlp_ratio
+        # norm2_A, norm2_B
+        flops += 2 * self.dim * H * W
         return flops
 
 class PatchMerging(nn.Module):
@@ -599,8 +764,8 @@ class PatchMerging(nn.Module):
     def extra_repr(self) -> str:
         return f"input_resolution={self.input_resolution}, dim={self.dim}"
 
-    def flops(self):
-        H, W = self.input_resolution
+    def flops(self, x_size=None):
+        H, W = x_size or self.input_resolution
         flops = H * W * self.dim
         flops += (H // 2) * (W // 2) * 4 * self.dim * 2 * self.dim
         return flops
@@ -667,12 +832,12 @@ class BasicLayer(nn.Module):
     def extra_repr(self) -> str:
         return f"dim={self.dim}, input_resolution={self.input_resolution}, depth={self.depth}"
 
-    def flops(self):
+    def flops(self, x_size=None):
         flops = 0
         for blk in self.blocks:
-            flops += blk.flops()
+            flops += blk.flops(x_size)
         if self.downsample is not None:
-            flops += self.downsample.flops()
+            flops += self.downsample.flops(x_size)
         return flops
 
 class Cross_BasicLayer(nn.Module):
@@ -738,12 +903,12 @@ class Cross_BasicLayer(nn.Module):
     def extra_repr(self) -> str:
         return f"dim={self.dim}, input_resolution={self.input_resolution}, depth={self.depth}"
 
-    def flops(self):
+    def flops(self, x_size=None):
         flops = 0
         for blk in self.blocks:
-            flops += blk.flops()
+            flops += blk.flops(x_size)
         if self.downsample is not None:
-            flops += self.downsample.flops()
+            flops += self.downsample.flops(x_size)
         return flops
 
 
@@ -813,13 +978,12 @@ class RSTB(nn.Module):
         # return self.patch_embed(self.conv(self.patch_unembed(self.residual_group(x, x_size), x_size))) + x
         return self.residual_group(x, x_size) + x
 
-    def flops(self):    
+    def flops(self, x_size=None):
         flops = 0
-        flops += self.residual_group.flops()
-        H, W = self.input_resolution
-        flops += H * W * self.dim * self.dim * 9
-        flops += self.patch_embed.flops()
-        flops += self.patch_unembed.flops()
+        flops += self.residual_group.flops(x_size)
+        # self.conv is not used
+        flops += self.patch_embed.flops(x_size)
+        flops += self.patch_unembed.flops(x_size)
 
         return flops
 
@@ -927,14 +1091,14 @@ class CRSTB(nn.Module):
         y = y + y1
         return x, y
 
-    def flops(self):
+    def flops(self, x_size=None):
         flops = 0
-        flops += self.residual_group_A.flops()
-        flops += self.residual_group_B.flops()
-        H, W = self.input_resolution
-        flops += H * W * self.dim * self.dim * 9
-        flops += self.patch_embed.flops()
-        flops += self.patch_unembed.flops()
+        flops += self.residual_group_A.flops(x_size)
+        flops += self.residual_group_B.flops(x_size)
+        flops += self.residual_group.flops(x_size)
+        # self.conv_A and self.conv_B are not used
+        flops += self.patch_embed.flops(x_size)
+        flops += self.patch_unembed.flops(x_size)
 
         return flops
 
@@ -942,7 +1106,7 @@ class PatchEmbed(nn.Module):
     r""" Image to Patch Embedding
 
     Args:
-        img_size (int): Image size.  Default: 224.
+        img_size (int | None): Image size, None for any size.  Default: 224.
         patch_size (int): Patch token size. Default: 4.
         in_chans (int): Number of input image channels. Default: 3.
         embed_dim (int): Number of linear projection output channels. Default: 96.
@@ -951,13 +1115,17 @@ class PatchEmbed(nn.Module):
 
     def __init__(self, img_size=224, patch_size=4, in_chans=3, embed_dim=96, norm_layer=None):
         super().__init__()
-        img_size = to_2tuple(img_size)
         patch_size = to_2tuple(patch_size)
-        patches_resolution = [img_size[0] // patch_size[0], img_size[1] // patch_size[1]]
+        if img_size is not None:
+            img_size = to_2tuple(img_size)
+            patches_resolution = [img_size[0] // patch_size[0], img_size[1] // patch_size[1]]
+            num_patches = patches_resolution[0] * patches_resolution[1]
+        else:
+            patches_resolution = num_patches = None
         self.img_size = img_size
         self.patch_size = patch_size
         self.patches_resolution = patches_resolution
-        self.num_patches = patches_resolution[0] * patches_resolution[1]
+        self.num_patches = num_patches
 
         self.in_chans = in_chans
         self.embed_dim = embed_dim
@@ -973,9 +1141,9 @@ class PatchEmbed(nn.Module):
             x = self.norm(x)
         return x
 
-    def flops(self):
+    def flops(self, x_size=None):
         flops = 0
-        H, W = self.img_size
+        H, W = x_size or self.patches_resolution
         if self.norm is not None:
             flops += H * W * self.embed_dim
         return flops
@@ -985,7 +1153,7 @@ class PatchUnEmbed(nn.Module):
     r""" Image to Patch Unembedding
 
     Args:
-        img_size (int): Image size.  Default: 224.
+        img_size (int | None): Image size, None for any size.  Default: 224.
         patch_size (int): Patch token size. Default: 4.
         in_chans (int): Number of input image channels. Default: 3.
         embed_dim (int): Number of linear projection output channels. Default: 96.
@@ -994,13 +1162,17 @@ class PatchUnEmbed(nn.Module):
 
     def __init__(self, img_size=224, patch_size=4, in_chans=3, embed_dim=96, norm_layer=None):
         super().__init__()
-        img_size = to_2tuple(img_size)
         patch_size = to_2tuple(patch_size)
-        patches_resolution = [img_size[0] // patch_size[0], img_size[1] // patch_size[1]]
+        if img_size is not None:
+            img_size = to_2tuple(img_size)
+            patches_resolution = [img_size[0] // patch_size[0], img_size[1] // patch_size[1]]
+            num_patches = patches_resolution[0] * patches_resolution[1]
+        else:
+            patches_resolution = num_patches = None
         self.img_size = img_size
         self.patch_size = patch_size
         self.patches_resolution = patches_resolution
-        self.num_patches = patches_resolution[0] * patches_resolution[1]
+        self.num_patches = num_patches
 
         self.in_chans = in_chans
         self.embed_dim = embed_dim
@@ -1010,7 +1182,7 @@ class PatchUnEmbed(nn.Module):
         x = x.transpose(1, 2).view(B, self.embed_dim, x_size[0], x_size[1])  # B Ph*Pw C
         return x
 
-    def flops(self):
+    def flops(self, x_size=None):
         flops = 0
         return flops
 
@@ -1055,8 +1227,8 @@ class UpsampleOneStep(nn.Sequential):
         m.append(nn.PixelShuffle(scale))
         super(UpsampleOneStep, self).__init__(*m)
 
-    def flops(self):
-        H, W = self.input_resolution
+    def flops(self, x_size=None):
+        H, W = x_size or self.input_resolution
         flops = H * W * self.num_feat * 3 * 9
         return flops
 
@@ -1066,7 +1238,8 @@ class SwinFusion(nn.Module):
         A PyTorch impl of : `SwinIR: Image Restoration Using Swin Transformer`, based on Swin Transformer.
 
     Args:
-        img_size (int | tuple(int)): Input image size. Default 64
+        img_size (int | tuple(int) | None): Input image size. None builds the model for any input size, the masks
+            and flops() follow the input. Default 64
         patch_size (int | tuple(int)): Patch size. Default: 1
         in_chans (int): Number of input image channels. Default: 3
         embed_dim (int): Patch embedding dimension. Default: 96
@@ -1087,6 +1260,9 @@ class SwinFusion(nn.Module):
         img_range: Image range. 1. or 255.
         upsampler: The reconstruction reconstruction module. 'pixelshuffle'/'pixelshuffledirect'/'nearest+conv'/None
         resi_connection: The convolutional block before residual connection. '1conv'/'3conv'
+        attn_backend: Window attention implementation. 'math'/'sdpa'/'chunked', see set_attn_backend()
+        concurrent_branches: If True, run the A and B extraction branches concurrently on two threads. Default: False
+        precision: 'fp32', or 'bf16' for bfloat16 autocast inference, see set_precision(). Default: 'fp32'
     """
 
     def __init__(self, img_size=64, patch_size=1, in_chans=1,
@@ -1096,7 +1272,7 @@ class SwinFusion(nn.Module):
                  drop_rate=0., attn_drop_rate=0., drop_path_rate=0.1,
                  norm_layer=nn.LayerNorm, ape=False, patch_norm=True,
                  use_checkpoint=False, upscale=2, img_range=1., upsampler='', resi_connection='1conv',
-                 **kwargs):
+                 attn_backend='math', concurrent_branches=False, precision='fp32', **kwargs):
         super(SwinFusion, self).__init__()
         num_out_ch = in_chans
         num_feat = 64
@@ -1106,13 +1282,17 @@ class SwinFusion(nn.Module):
         if in_chans == 3 or in_chans == 6:
             rgb_mean = (0.4488, 0.4371, 0.4040)
             rgbrgb_mean = (0.4488, 0.4371, 0.4040, 0.4488, 0.4371, 0.4040)
-            self.mean = torch.Tensor(rgb_mean).view(1, 3, 1, 1)
-            self.mean_in = torch.Tensor(rgbrgb_mean).view(1, 6, 1, 1)
+            self.register_buffer('mean', torch.Tensor(rgb_mean).view(1, 3, 1, 1), persistent=False)
+            self.register_buffer('mean_in', torch.Tensor(rgbrgb_mean).view(1, 6, 1, 1), persistent=False)
         else:
-            self.mean = torch.zeros(1, 1, 1, 1)
+            self.register_buffer('mean', torch.zeros(1, 1, 1, 1, device='cpu'), persistent=False)
         self.upscale = upscale
         self.upsampler = upsampler
         self.window_size = window_size
+        self.frozen = False
+        self.frozen_opt = {}
+        self.concurrent_branches = concurrent_branches
+        self._flops = LRUCache(maxsize=64)  # (H, W) -> flops()
 
         #####################################################################################################
         ################################### 1, shallow feature extraction ###################################
@@ -1142,6 +1322,7 @@ class SwinFusion(nn.Module):
         num_patches = self.patch_embed.num_patches
         patches_resolution = self.patch_embed.patches_resolution
         self.patches_resolution = patches_resolution
+        input_resolution = tuple(patches_resolution) if patches_resolution is not None else None
 
         # merge non-overlapping patches into image
         self.patch_unembed = PatchUnEmbed(
@@ -1150,21 +1331,22 @@ class SwinFusion(nn.Module):
         self.softmax = nn.Softmax(dim=0)
         # absolute position embedding
         if self.ape: 
+            if num_patches is None:
+                raise ValueError('the absolute position embedding (ape=True) needs a fixed img_size.')
             self.absolute_pos_embed = nn.Parameter(torch.zeros(1, num_patches, embed_dim))
             trunc_normal_(self.absolute_pos_embed, std=.02)
 
         self.pos_drop = nn.Dropout(p=drop_rate)
 
         # stochastic depth
-        dpr_Ex = [x.item() for x in torch.linspace(0, drop_path_rate, sum(Ex_depths))]  # stochastic depth decay rule
-        dpr_Fusion = [x.item() for x in torch.linspace(0, drop_path_rate, sum(Fusion_depths))]  # stochastic depth decay rule
-        dpr_Re = [x.item() for x in torch.linspace(0, drop_path_rate, sum(Re_depths))]  # stochastic depth decay rule
+        dpr_Ex = [x.item() for x in torch.linspace(0, drop_path_rate, sum(Ex_depths), device='cpu')]  # stochastic depth decay rule
+        dpr_Fusion = [x.item() for x in torch.linspace(0, drop_path_rate, sum(Fusion_depths), device='cpu')]  # stochastic depth decay rule
+        dpr_Re = [x.item() for x in torch.linspace(0, drop_path_rate, sum(Re_depths), device='cpu')]  # stochastic depth decay rule
         # build Residual Swin Transformer blocks (RSTB)
         self.layers_Ex_A = nn.ModuleList()
         for i_layer in range(self.Ex_num_layers):
             layer = RSTB(dim=embed_dim,
-                         input_resolution=(patches_resolution[0],
-                                           patches_resolution[1]),
+                         input_resolution=input_resolution,
                          depth=Ex_depths[i_layer],
                          num_heads=Ex_num_heads[i_layer],
                          window_size=window_size,
@@ -1185,8 +1367,7 @@ class SwinFusion(nn.Module):
         self.layers_Ex_B = nn.ModuleList()
         for i_layer in range(self.Ex_num_layers):
             layer = RSTB(dim=embed_dim,
-                         input_resolution=(patches_resolution[0],
-                                           patches_resolution[1]),
+                         input_resolution=input_resolution,
                          depth=Ex_depths[i_layer],
                          num_heads=Ex_num_heads[i_layer],
                          window_size=window_size,
@@ -1207,8 +1388,7 @@ class SwinFusion(nn.Module):
         self.layers_Fusion = nn.ModuleList()
         for i_layer in range(self.Fusion_num_layers):
             layer = CRSTB(dim=embed_dim,
-                         input_resolution=(patches_resolution[0],
-                                           patches_resolution[1]),
+                         input_resolution=input_resolution,
                          depth=Fusion_depths[i_layer],
                          num_heads=Fusion_num_heads[i_layer],
                          window_size=window_size,
@@ -1230,8 +1410,7 @@ class SwinFusion(nn.Module):
         self.layers_Re = nn.ModuleList()
         for i_layer in range(self.Re_num_layers):
             layer = RSTB(dim=embed_dim,
-                         input_resolution=(patches_resolution[0],
-                                           patches_resolution[1]),
+                         input_resolution=input_resolution,
                          depth=Re_depths[i_layer],
                          num_heads=Re_num_heads[i_layer],
                          window_size=window_size,
@@ -1274,8 +1453,7 @@ class SwinFusion(nn.Module):
             self.conv_last = nn.Conv2d(num_feat, num_out_ch, 3, 1, 1)
         elif self.upsampler == 'pixelshuffledirect':
             # for lightweight SR (to save parameters)
-            self.upsample = UpsampleOneStep(upscale, embed_dim, num_out_ch,
-                                            (patches_resolution[0], patches_resolution[1]))
+            self.upsample = UpsampleOneStep(upscale, embed_dim, num_out_ch, input_resolution)
         elif self.upsampler == 'nearest+conv':
             # for real-world SR (less artifacts)
             assert self.upscale == 4, 'only support x4 now.'
@@ -1293,6 +1471,8 @@ class SwinFusion(nn.Module):
             self.conv_last3 = nn.Conv2d(int(embed_dim_temp/2), num_out_ch, 3, 1, 1)
 
         self.apply(self._init_weights)
+        self.set_attn_backend(attn_backend)
+        self.set_precision(precision)
 
     def _init_weights(self, m):
         if isinstance(m, nn.Linear):
@@ -1311,6 +1491,83 @@ class SwinFusion(nn.Module):
     def no_weight_decay_keywords(self):
         return {'relative_position_bias_table'}
 
+    def set_attn_backend(self, backend, chunk_size=None):
+        """Select the window attention implementation of every attention module.
+
+        Args:
+            backend (str): 'math' (explicit softmax(q @ k^T + bias) @ v, reference),
+                'sdpa' (torch.nn.functional.scaled_dot_product_attention, bias and mask as additive attn_mask)
+                or 'chunked' (math over chunks of windows, falls back for 'sdpa' on torch < 2.0).
+            chunk_size (int | None): Number of windows per chunk for 'chunked'. Default: 64
+        """
+        for m in self.modules():
+            if isinstance(m, (WindowAttention, Cross_WindowAttention)):
+                m.set_backend(backend, chunk_size)
+        self.attn_backend = resolve_attn_backend(backend)
+        return self
+
+    def set_precision(self, precision):
+        """Select the compute precision of forward().
+
+        Args:
+            precision (str): 'fp32', or 'bf16' to run forward() under bfloat16 autocast on the device of the
+                input. The weights stay in float32; linear, conv and matmul run in bfloat16 while the residual
+                stream, LayerNorm and the attention softmax stay in float32. The output has the input dtype.
+        """
+        if precision not in ('fp32', 'bf16'):
+            raise NotImplementedError('Precision [{:s}] is not found.'.format(precision))
+        self.precision = precision
+        return self
+
+    def freeze(self, fuse_mask=False, batch_cross=False):
+        """Inference mode: materialize the (nH, N, N) relative position bias of every attention module once.
+
+        Args:
+            fuse_mask (bool): Also cache the bias pre-added to the SW-MSA mask, per block and resolution.
+                This costs nW*nH*N*N floats per shifted block, so only enable it for small or fixed input sizes.
+            batch_cross (bool): Stack the A/B weights of every Cross_SwinTransformerBlock and run both
+                cross-attention directions as one batched op, see Cross_SwinTransformerBlock.forward_batched().
+
+        The cached tensors are dropped by train(), and rebuilt from the current weights by load_state_dict()
+        and .to()/.half().
+        """
+        self.eval()
+        for m in self.modules():
+            if isinstance(m, SwinTransformerBlock):
+                m.freeze(fuse_mask)
+            elif isinstance(m, Cross_SwinTransformerBlock):
+                m.freeze(fuse_mask, batch_cross)
+        self.frozen = True
+        self.frozen_opt = dict(fuse_mask=fuse_mask, batch_cross=batch_cross)
+        return self
+
+    def unfreeze(self):
+        for m in self.modules():
+            if isinstance(m, (SwinTransformerBlock, Cross_SwinTransformerBlock)):
+                m.unfreeze()
+        self.frozen = False
+        return self
+
+    def train(self, mode=True):
+        if mode and self.frozen:
+            self.unfreeze()
+        return super(SwinFusion, self).train(mode)
+
+    def load_state_dict(self, state_dict, strict=True, **kwargs):
+        frozen = self.frozen
+        self.unfreeze()
+        result = super(SwinFusion, self).load_state_dict(state_dict, strict=strict, **kwargs)
+        if frozen:
+            self.freeze(**self.frozen_opt)
+        return result
+
+    def _apply(self, fn, *args, **kwargs):
+        module = super(SwinFusion, self)._apply(fn, *args, **kwargs)
+        if self.frozen:
+            # re-materialize on the new device/dtype
+            self.freeze(**self.frozen_opt)
+        return module
+
     def check_image_size(self, x):
         _, _, h, w = x.size()
         mod_pad_h = (self.window_size - h % self.window_size) % self.window_size
@@ -1414,18 +1671,24 @@ class SwinFusion(nn.Module):
         x = self.check_image_size(x)
         y = self.check_image_size(y)
 
-        self.mean_A = self.mean.type_as(x)
-        self.mean_B = self.mean.type_as(y)
-        self.mean = (self.mean_A + self.mean_B) / 2
+        # no attribute writes here, forward is re-entrant and one instance can serve concurrent requests
+        mean_A = self.mean.type_as(x)
+        mean_B = self.mean.type_as(y)
+        mean = (mean_A + mean_B) / 2
 
-        x = (x - self.mean_A) * self.img_range
-        y = (y - self.mean_B) * self.img_range
+        x = (x - mean_A) * self.img_range
+        y = (y - mean_B) * self.img_range
 
         # Feedforward
-        x = self.forward_features_Ex_A(x)
-        y = self.forward_features_Ex_B(y)
-        x = self.forward_features_Fusion(x, y)
-        x = self.forward_features_Re(x)
+        with torch.autocast(x.device.type, dtype=torch.bfloat16, enabled=self.precision == 'bf16'):
+            if self.concurrent_branches:
+                # Ex_A and Ex_B are independent until the fusion stage
+                x, y = run_branches(lambda: self.forward_features_Ex_A(x), lambda: self.forward_features_Ex_B(y))
+            else:
+                x = self.forward_features_Ex_A(x)
+                y = self.forward_features_Ex_B(y)
+            x = self.forward_features_Fusion(x, y)
+            x = self.forward_features_Re(x)
         # if self.upsampler == 'pixelshuffle':
         #     # for classical SR
         #     x = self.conv_first(x)
@@ -1452,24 +1715,34 @@ class SwinFusion(nn.Module):
         #     res = self.conv_after_body(self.forward_features(x_first)) + x_first
                    
         
-        x = x / self.img_range + self.mean
+        x = x.to(A.dtype) / self.img_range + mean
         return x[:, :, :H*self.upscale, :W*self.upscale]
 
-    def flops(self):
+    def flops(self, x_size=None):
+        """Multiply-adds of one forward pass on an H x W pair, x_size=(H, W), by default img_size.
+
+        The size is padded to a multiple of window_size like the input of forward(), the counts are cached per size.
+        """
+        if x_size is None:
+            if self.patches_resolution is None:
+                raise ValueError('the model is built for any input size, pass x_size=(H, W).')
+            x_size = self.patches_resolution
+        H, W = (-(-s // self.window_size) * self.window_size for s in x_size)
+        return self._flops.get_or_create((H, W), lambda: self._count_flops(H, W))
+
+    def _count_flops(self, H, W):
         flops = 0
-        H, W = self.patches_resolution
-        flops += H * W * 3 * self.embed_dim * 9
-        flops += self.patch_embed.flops()
-        for i, layer in enumerate(self.layers_Ex_A):
-            flops += layer.flops()
-        for i, layer in enumerate(self.layers_Ex_B):
-            flops += layer.flops()
-        for i, layer in enumerate(self.layers_Fusion):
-            flops += layer.flops()
-        for i, layer in enumerate(self.layers_Re):
-            flops += layer.flops()
-        flops += H * W * 3 * self.embed_dim * self.embed_dim
-        flops += self.upsample.flops()
+        # shallow features, conv_first1_A and conv_first2_A run on A and on B
+        flops += 2 * (conv2d_flops(self.conv_first1_A, H, W) + conv2d_flops(self.conv_first2_A, H, W))
+        # patch_embed: Ex_A, Ex_B, Fusion (A and B), Re
+        flops += 5 * self.patch_embed.flops((H, W))
+        for layer in [*self.layers_Ex_A, *self.layers_Ex_B, *self.layers_Fusion, *self.layers_Re]:
+            flops += layer.flops((H, W))
+        # norm_Ex_A, norm_Ex_B, norm_Fusion_A, norm_Fusion_B, norm_Re
+        flops += 5 * H * W * self.embed_dim
+        for name in ('conv_after_body_Fusion', 'conv_last1', 'conv_last2', 'conv_last3'):
+            if hasattr(self, name):
+                flops += conv2d_flops(getattr(self, name), H, W)
         return flops
 
 
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from utils.utils_swin import LRUCache
+
+
+'''
+# --------------------------------------------
+# content-addressed cache of fused results
+# --------------------------------------------
+# key = hash(decoded A, decoded B, checkpoint, options)
+# value = fused uint8 image
+# tier 1: in-memory LRU, tier 2: .npy files with
+# size-based LRU eviction
+# --------------------------------------------
+'''
+
+
+'''
+# --------------------------------------------
+# keys
+# --------------------------------------------
+'''
+
+
+_FILE_DIGESTS = {}
+
+
+def file_digest(path):
+    """sha256 of a file, e.g. the checkpoint, memoized on (path, size, mtime)."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _FILE_DIGESTS:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _FILE_DIGESTS[key] = h.hexdigest()
+    return _FILE_DIGESTS[key]
+
+
+def file_digest_many(paths):
+    """One digest of several files, e.g. the exported buckets of a checkpoint, order matters."""
+    h = hashlib.sha256()
+    for path in paths:
+        h.update('{}|'.format(file_digest(path)).encode())
+    return h.hexdigest()
+
+
+def fusion_key(img_A, img_B, model_id, **options):
+    """
+    Args:
+        img_A, img_B: decoded inputs (numpy), the key depends on their pixels, dtype and squeezed shape only,
+            so HxW and HxWx1 decodes of the same image share a key
+        model_id: identity of the weights, e.g. file_digest(model_path)
+        options: anything else that changes the output, e.g. tile=512, attn_backend='math'
+
+    Returns:
+        key: hex string
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update('{}|{}'.format(model_id, sorted(options.items())).encode())
+    for img in (img_A, img_B):
+        img = np.ascontiguousarray(np.squeeze(img))
+        h.update('|{}|{}|'.format(img.shape, img.dtype).encode())
+        h.update(img.data)
+    return h.hexdigest()
+
+
+'''
+# --------------------------------------------
+# two-tier cache
+# --------------------------------------------
+'''
+
+
+class FusionCache(object):
+    """In-memory LRU in front of an optional on-disk cache of fused uint8 images.
+
+    Args:
+        cache_dir (str): folder of the disk tier, None keeps the memory tier only
+        memory_items (int): number of images kept in memory. Default: 32
+        disk_bytes (int): size limit of the disk tier, least recently used files are evicted. Default: 1 GB
+    """
+
+    def __init__(self, cache_dir=None, memory_items=32, disk_bytes=1 << 30):
+        self.cache_dir = cache_dir
+        self.disk_bytes = disk_bytes
+        self.memory = LRUCache(maxsize=memory_items)
+        self._index = OrderedDict()  # key -> file size, least recently used first
+        self._disk_size = 0
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            files = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith('.npy')]
+            for path in sorted(files, key=os.path.getmtime):
+                self._index[os.path.basename(path)[:-4]] = os.path.getsize(path)
+            self._disk_size = sum(self._index.values())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key):
+        img = self.memory.get(key)
+        if img is not None or self.cache_dir is None:
+            return img
+        with self._lock:
+            if key not in self._index:
+                return None
+            self._index.move_to_end(key)
+        try:
+            img = np.load(self._path(key))
+            os.utime(self._path(key))
+        except (OSError, ValueError):
+            # evicted by another process or a partial file
+            with self._lock:
+                self._disk_size -= self._index.pop(key, 0)
+            return None
+        self.memory.put(key, img)
+        return img
+
+    def put(self, key, img):
+        img = np.array(img)  # own copy, shared read-only between callers
+        img.setflags(write=False)
+        self.memory.put(key, img)
+        if self.cache_dir is None:
+            return
+        tmp_path = '{:s}.{:d}.{:d}.tmp'.format(self._path(key), os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, img)
+        os.replace(tmp_path, self._path(key))
+        with self._lock:
+            self._disk_size += os.path.getsize(self._path(key)) - self._index.pop(key, 0)
+            self._index[key] = os.path.getsize(self._path(key))
+            while self._disk_size > self.disk_bytes and len(self._index) > 1:
+                old_key, size = self._index.popitem(last=False)
+                self._disk_size -= size
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass
+
+    def get_or_create(self, key, factory):
+        img = self.get(key)
+        if img is None:
+            img = factory()
+            self.put(key, img)
+        return img
+
+    def clear(self):
+        self.memory.clear()
+        with self._lock:
+            for key in self._index:
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            self._index.clear()
+            self._disk_size = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self.memory or key in self._index
+
+    def __len__(self):
+        # with a disk tier every image in memory is also on disk
+        return len(self._index) if self.cache_dir is not None else len(self.memory)
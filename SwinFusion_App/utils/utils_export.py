@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+import os
+import glob
+import json
+import zipfile
+import threading
+import torch
+import torch.nn as nn
+
+from utils import utils_cache
+from utils import utils_model
+
+
+'''
+# --------------------------------------------
+# TorchScript export of SwinFusion per input size
+# ONNX export for ONNX Runtime, any input size
+# --------------------------------------------
+# one traced and frozen module per bucket (HxW),
+# the window partitions, shifts and masks of that
+# size are constants of the graph, no Python runs
+# per call
+# model/10000_E.pth -> model/10000_E.256x256.ts
+# BucketedSwinFusion pads every input up to the
+# smallest bucket that holds it and crops the
+# result, larger inputs are fused tile by tile
+# --------------------------------------------
+'''
+
+
+EXPORT_META = 'swinfusion.json'
+# export options every bucket of a BucketedSwinFusion must share
+EXPORT_OPTIONS = ['window_size', 'embed_dim', 'in_chans', 'precision', 'attn_backend', 'fuse_mask']
+
+
+def exported_path(model_path, h, w):
+    return '{:s}.{:d}x{:d}.ts'.format(os.path.splitext(model_path)[0], h, w)
+
+
+def exported_paths(model_path):
+    """{(h, w): path} of the artifacts exported from model_path."""
+    paths = {}
+    for path in glob.glob(glob.escape(os.path.splitext(model_path)[0]) + '.*x*.ts'):
+        size = os.path.basename(path)[:-len('.ts')].rsplit('.', 1)[-1].split('x')
+        if len(size) == 2 and all(s.isdigit() for s in size):
+            paths[int(size[0]), int(size[1])] = path
+    return paths
+
+
+def export_swinfusion(model, sizes, model_path, fuse_mask=False):
+    """
+    Trace model once per size and save the frozen graphs next to the checkpoint.
+
+    Args:
+        model: SwinFusion in eval mode, e.g. from utils_model.define_swinfusion(model_path)
+        sizes: [(h, w)] buckets, multiples of model.window_size
+        model_path: checkpoint the weights come from, names the artifacts and is recorded in them
+        fuse_mask (bool): also bake the bias pre-added to the SW-MSA masks (SwinFusion.freeze),
+            nW*nH*N*N floats per shifted block, i.e. ~350 MB at 128x128 and 4x that per doubling of the side
+
+    Returns:
+        paths: {(h, w): path}
+    """
+    conv_first = getattr(model.conv_first1_A, 'conv', model.conv_first1_A)  # QuantConv2d after utils_quant
+    meta = dict(source=utils_cache.file_digest(model_path), window_size=model.window_size, embed_dim=model.embed_dim,
+                in_chans=conv_first.in_channels, precision='int8' if getattr(model, 'quantization', None) else model.precision,
+                attn_backend=getattr(model, 'attn_backend', 'math'), fuse_mask=fuse_mask)
+    device = next(model.parameters()).device
+    frozen_opt = model.frozen_opt if model.frozen else None
+    model.freeze(fuse_mask=fuse_mask)
+    paths = {}
+    try:
+        for h, w in sizes:
+            if h % model.window_size or w % model.window_size:
+                raise ValueError('bucket {:d}x{:d} is not a multiple of the window size {:d}.'.format(h, w, model.window_size))
+            # two tensors, one tensor passed as A and B could be recorded as a single input
+            example = tuple(torch.rand(2, 1, meta['in_chans'], h, w, device=device))
+            with torch.no_grad():
+                # the graph is only valid for this shape (batch size included), shape checks would re-run it
+                traced = torch.jit.freeze(torch.jit.trace(model, example, check_trace=False))
+            paths[h, w] = exported_path(model_path, h, w)
+            torch.jit.save(traced, paths[h, w], _extra_files={EXPORT_META: json.dumps(dict(meta, size=[h, w]))})
+    finally:
+        if frozen_opt is not None:
+            model.freeze(**frozen_opt)
+        else:
+            model.unfreeze()
+    return paths
+
+
+def exported_meta(path):
+    """Metadata of an exported bucket, read from the archive without loading the graph."""
+    with zipfile.ZipFile(path) as f:
+        name = next(n for n in f.namelist() if n.endswith('/extra/' + EXPORT_META))
+        return json.loads(f.read(name))
+
+
+def load_exported(path, device='cpu'):
+    """Returns (TorchScript module, metadata dict) of one exported bucket."""
+    extra = {EXPORT_META: ''}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra)
+    return module, json.loads(extra[EXPORT_META])
+
+
+class BucketedSwinFusion(nn.Module):
+    """
+    E = model(A, B) on top of the artifacts of export_swinfusion, for inputs of any size.
+
+    A pair is reflect-padded to the smallest bucket that holds it and the result cropped back; the
+    padded border changes the context of the last windows, so pixels near the bottom/right edge
+    differ slightly from the eager model at the native size (exact when the input is a bucket).
+    Larger pairs are fused with utils_model.test_split_fuse using the largest square tile that fits a bucket,
+    or by fallback(A, B) if given. Batches run one pair at a time, every graph is traced at batch 1.
+    Buckets are loaded on first use, stale artifacts (exported from another checkpoint) are ignored.
+    The buckets have to be exported with the same options (EXPORT_OPTIONS), else ValueError.
+
+    Args:
+        model_path: checkpoint the buckets were exported from
+        device: torch.device or str
+        fallback: optional eager model for the pairs larger than every bucket
+        overlap: tile overlap for the pairs larger than every bucket
+    """
+
+    def __init__(self, model_path, device='cpu', fallback=None, overlap=32):
+        super(BucketedSwinFusion, self).__init__()
+        self.device, self.fallback, self.overlap = torch.device(device), fallback, overlap
+        source = utils_cache.file_digest(model_path)
+        self.meta = {}
+        for size, path in exported_paths(model_path).items():
+            meta = exported_meta(path)
+            if meta['source'] == source:
+                self.meta[size] = dict(meta, path=path)
+        if not self.meta:
+            raise FileNotFoundError('no bucket exported from {:s}, run main_export.py first.'.format(model_path))
+        # smallest area first, the first bucket that holds a pair is the one with the least padding
+        self.sizes = sorted(self.meta, key=lambda s: (s[0] * s[1], s))
+        options = {}
+        for size in self.sizes:
+            options.setdefault(tuple(self.meta[size][k] for k in EXPORT_OPTIONS), []).append('{:d}x{:d}'.format(*size))
+        if len(options) > 1:
+            raise ValueError('the buckets of {:s} were exported with different options, export them again in one '
+                             'main_export.py run: {}.'.format(model_path, '; '.join(
+                                 '{} ({})'.format(', '.join(sizes), ', '.join('{}={}'.format(k, v) for k, v in zip(EXPORT_OPTIONS, opt)))
+                                 for opt, sizes in options.items())))
+        meta = self.meta[self.sizes[0]]
+        self.window_size, self.embed_dim, self.precision = meta['window_size'], meta['embed_dim'], meta['precision']
+        # identity of the served graphs (their options are in the archives), the model_id of cached results
+        self.artifact_id = utils_cache.file_digest_many([self.meta[size]['path'] for size in self.sizes])
+        self.buckets = {}  # (h, w) -> TorchScript module
+        self.lock = threading.Lock()
+
+    def bucket(self, h, w):
+        """Smallest (bh, bw) with bh >= h and bw >= w, None if the pair is larger than every bucket."""
+        return next((size for size in self.sizes if size[0] >= h and size[1] >= w), None)
+
+    def load(self, size):
+        with self.lock:
+            if size not in self.buckets:
+                self.buckets[size] = load_exported(self.meta[size]['path'], self.device)[0]
+            return self.buckets[size]
+
+    def forward(self, A, B):
+        h, w = A.size()[-2:]
+        size = self.bucket(h, w)
+        if size is None:
+            if self.fallback is not None:
+                return self.fallback(A, B)
+            tile = max(min(size) for size in self.sizes)  # largest square tile that fits a bucket
+            return utils_model.test_split_fuse(self, A, B, tile=tile, overlap=self.overlap, window_size=self.window_size)
+        module = self.load(size)
+        A, B = utils_model.pad_reflect(A, *size), utils_model.pad_reflect(B, *size)
+        E = torch.cat([module(a, b) for a, b in zip(A.split(1), B.split(1))], 0)
+        return E[..., :h, :w]
+
+
+'''
+# --------------------------------------------
+# ONNX export, one graph for every batch size
+# and every H, W that are multiples of the window
+# size (masks built in the graph)
+# model/10000_E.pth -> model/10000_E.onnx
+# needs the onnx and onnxscript packages, and
+# onnxruntime to run it
+# --------------------------------------------
+'''
+
+
+def onnx_path(model_path):
+    return os.path.splitext(model_path)[0] + '.onnx'
+
+
+def export_onnx(model, model_path, max_size=2048):
+    """
+    Export model with dynamic batch size and dynamic H, W (multiples of model.window_size) to onnx_path(model_path).
+
+    Args:
+        model: float32 SwinFusion, e.g. from utils_model.define_swinfusion(model_path)
+        model_path: checkpoint the weights come from, names the file and is recorded in its metadata
+        max_size: largest H and W the graph accepts
+
+    Returns:
+        path
+    """
+    if getattr(model, 'quantization', None) or model.precision != 'fp32':
+        raise ValueError('only float32 models are exported to ONNX.')
+    window_size = model.window_size
+    frozen_opt = model.frozen_opt if model.frozen else None
+    model.freeze()
+    batch = torch.export.Dim('batch', min=1, max=1024)
+    h = torch.export.Dim('h', min=2, max=max_size // window_size)
+    w = torch.export.Dim('w', min=2, max=max_size // window_size)
+    dims = {0: batch, 2: window_size * h, 3: window_size * w}
+    # batch 2: a dynamic dimension cannot be 1 in the example, export would specialize it;
+    # two tensors: one tensor passed as A and B is exported as aliased inputs
+    example = tuple(torch.rand(2, 2, getattr(model.conv_first1_A, 'conv', model.conv_first1_A).in_channels,
+                               4 * window_size, 5 * window_size, device=next(model.parameters()).device))
+    try:
+        with torch.no_grad():
+            program = torch.onnx.export(model, example, dynamo=True, dynamic_shapes={'A': dims, 'B': dims},
+                                        input_names=['A', 'B'], output_names=['E'], verbose=False)
+    finally:
+        if frozen_opt is not None:
+            model.freeze(**frozen_opt)
+        else:
+            model.unfreeze()
+    program.model.metadata_props[EXPORT_META] = json.dumps(dict(
+        source=utils_cache.file_digest(model_path), window_size=window_size, embed_dim=model.embed_dim, precision='fp32'))
+    path = onnx_path(model_path)
+    program.save(path, external_data=False)
+    return path
+
+
+class OnnxSwinFusion(nn.Module):
+    """
+    E = model(A, B) on an ONNX Runtime session of the graph of export_onnx.
+
+    Inputs are reflect-padded to a multiple of the window size and the result cropped, like SwinFusion.
+
+    Args:
+        model_path: checkpoint the graph was exported from
+        device: 'cpu', or 'cuda' with onnxruntime-gpu
+        threads: intra-op threads of the session, default torch.get_num_threads()
+    """
+
+    def __init__(self, model_path, device='cpu', threads=None):
+        super(OnnxSwinFusion, self).__init__()
+        import onnxruntime as ort
+        path = onnx_path(model_path)
+        if not os.path.isfile(path):
+            raise FileNotFoundError('{:s} not found, run main_export.py --format onnx first.'.format(path))
+        self.device = torch.device(device)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads or torch.get_num_threads()
+        providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if self.device.type == 'cuda' else ['CPUExecutionProvider']
+        self.session = ort.InferenceSession(path, options, providers=providers)
+        meta = json.loads(self.session.get_modelmeta().custom_metadata_map[EXPORT_META])
+        if meta['source'] != utils_cache.file_digest(model_path):
+            raise ValueError('{:s} was exported from another checkpoint than {:s}, export it again.'.format(path, model_path))
+        self.window_size, self.embed_dim, self.precision = meta['window_size'], meta['embed_dim'], meta['precision']
+        self.artifact_id = utils_cache.file_digest(path)
+
+    def forward(self, A, B):
+        h, w = A.size()[-2:]
+        H, W = -(-h // self.window_size) * self.window_size, -(-w // self.window_size) * self.window_size
+        A, B = utils_model.pad_reflect(A, H, W), utils_model.pad_reflect(B, H, W)
+        # session.run is thread-safe, one session serves every worker
+        E = self.session.run(['E'], {'A': A.detach().float().cpu().numpy(), 'B': B.detach().float().cpu().numpy()})[0]
+        return torch.from_numpy(E)[..., :h, :w].to(self.device)
+
+
+'''
+# --------------------------------------------
+# inference backends, interchangeable E = model(A, B)
+# --------------------------------------------
+# torch:       eager SwinFusion, utils_model.define_swinfusion
+# torchscript: BucketedSwinFusion, main_export.py --sizes ...
+# onnxruntime: OnnxSwinFusion, main_export.py --format onnx
+# --------------------------------------------
+'''
+
+
+BACKENDS = ('torch', 'torchscript', 'onnxruntime')
+
+
+def define_backend(backend, model_path, device='cpu', **kwargs):
+    """
+    Model of an inference backend for the checkpoint at model_path.
+
+    Args:
+        backend: one of BACKENDS
+        kwargs: network options of the torch backend (attn_backend, precision),
+            the exported backends run with the options of their export
+
+    Returns:
+        model: E = model(A, B), frozen for inference
+    """
+    if backend == 'torch':
+        return utils_model.define_swinfusion(model_path, device, **kwargs).freeze()
+    if backend == 'torchscript':
+        return BucketedSwinFusion(model_path, device)
+    if backend == 'onnxruntime':
+        return OnnxSwinFusion(model_path, device)
+    raise NotImplementedError('Inference backend [{:s}] is not found.'.format(backend))
+
+
+def cache_identity(backend, model, model_path, **kwargs):
+    """
+    model_id and options of utils_cache.fusion_key for the results of model = define_backend(backend, model_path, **kwargs).
+
+    torch: the checkpoint and the network options; torchscript / onnxruntime: the exported files the model
+    serves, which record their own options, kwargs are ignored like in define_backend.
+
+    Returns:
+        model_id, options (dict)
+    """
+    if backend == 'torch':
+        return utils_cache.file_digest(model_path), dict(kwargs)
+    return model.artifact_id, dict(backend=backend)
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+import math
+import functools
+from collections import OrderedDict
+import numpy as np
+import cv2
+try:
+    import torch
+except ImportError:  # the numpy path of the histogram engine does not need torch
+    torch = None
+
+
+'''
+# --------------------------------------------
+# no-reference image fusion metrics
+# --------------------------------------------
+# A, B: source images, F: fused image
+# all inputs are HxW (or HxWx1) uint8 [0, 255]
+# --------------------------------------------
+# EN: entropy of F
+# MI: MI(A,F) + MI(B,F)
+# NMI: 2 * (MI(A,F) / (H(A) + H(F)) + MI(B,F) / (H(B) + H(F)))
+# FMI: MI(A,F) / (H(A) + H(F)) + MI(B,F) / (H(B) + H(F))
+#      over Sobel gradient magnitude features (global, non-windowed)
+# SSIM_A / SSIM_B: SSIM(A,F) / SSIM(B,F), same as utils_image.calculate_ssim
+# CC: (CC(A,F) + CC(B,F)) / 2
+# SF: spatial frequency of F
+# AG: average gradient of F
+# Qabf: Xydeas-Petrovic gradient based fusion quality
+# VIF: VIF(A,F) + VIF(B,F), pixel domain, 4 scales
+# MSE / PSNR: against the sources, (MSE(A,F) + MSE(B,F)) / 2
+# --------------------------------------------
+'''
+
+
+def _gray(img):
+    img = np.squeeze(img)
+    if img.ndim != 2:
+        raise ValueError('Wrong input image dimensions, expected HxW or HxWx1.')
+    return img
+
+
+'''
+# --------------------------------------------
+# histogram based: EN, MI
+# --------------------------------------------
+'''
+
+
+def histogram(img, bins=256):
+    """Normalized histogram of a uint8 image."""
+    return np.bincount(img.ravel(), minlength=bins).astype(np.float64) / img.size
+
+
+def joint_histogram(img1, img2, bins=256):
+    """Normalized bins x bins joint histogram of two uint8 images."""
+    joint = np.bincount(img1.ravel().astype(np.int64) * bins + img2.ravel(), minlength=bins * bins)
+    return joint.reshape(bins, bins).astype(np.float64) / img1.size
+
+
+def entropy_from_histogram(p):
+    p = p[p > 0]
+    return float(-(p * np.log2(p)).sum())
+
+
+def mutual_information_from_histogram(p_xy, p_x=None, p_y=None):
+    """MI = H(x) + H(y) - H(x, y), the marginals are derived from p_xy if not given."""
+    p_x = p_xy.sum(1) if p_x is None else p_x
+    p_y = p_xy.sum(0) if p_y is None else p_y
+    return entropy_from_histogram(p_x) + entropy_from_histogram(p_y) - entropy_from_histogram(p_xy)
+
+
+def calculate_entropy(img):
+    return entropy_from_histogram(histogram(_gray(img)))
+
+
+def calculate_mi(img1, img2):
+    return mutual_information_from_histogram(joint_histogram(_gray(img1), _gray(img2)))
+
+
+'''
+# --------------------------------------------
+# batched joint histograms: EN, MI, NMI, FMI
+# --------------------------------------------
+# one bincount over a whole stack of image pairs,
+# torch.bincount on any device, or numpy
+# --------------------------------------------
+'''
+
+
+def joint_histograms(x, y, bins=256):
+    """
+    Args:
+        x, y: NxHxW integer numpy arrays, or torch tensors on any device, with values in [0, bins)
+
+    Returns:
+        counts: N x bins x bins int64 counts of the same type, counts[n, i, j] = #{x[n] == i and y[n] == j}
+    """
+    n = x.shape[0]
+    if torch is not None and torch.is_tensor(x):
+        index = x.reshape(n, -1).long() * bins + y.reshape(n, -1)
+        index += torch.arange(0, n * bins * bins, bins * bins, device=x.device).view(n, 1)
+        return torch.bincount(index.view(-1), minlength=n * bins * bins).view(n, bins, bins)
+    # flat bin index n*bins*bins + x*bins + y, int32 while it fits
+    itype = np.int32 if n * bins * bins < 2**31 else np.int64
+    index = x.reshape(n, -1).astype(itype)
+    index *= bins
+    index += y.reshape(n, -1)
+    index += np.arange(0, n * bins * bins, bins * bins, dtype=itype).reshape(n, 1)
+    return np.bincount(index.ravel(), minlength=n * bins * bins).reshape(n, bins, bins)
+
+
+@functools.lru_cache(maxsize=8)
+def _clogc(total, device=None):
+    """c * log2(c) for every possible bin count c in [0, total], numpy or a torch tensor on device."""
+    c = np.arange(total + 1, dtype=np.float64)
+    c[1:] *= np.log2(c[1:])
+    return c if device is None else torch.from_numpy(c).to(device)
+
+
+def _entropies(counts, total):
+    """Entropy (bits) of each row of the N x K count matrix, H = log2(total) - sum(c * log2(c)) / total."""
+    device = counts.device if torch is not None and torch.is_tensor(counts) else None
+    return math.log2(total) - _clogc(total, device)[counts].sum(1) / total
+
+
+def _mi_terms(x, y, bins=256):
+    """(H(x), H(y), MI(x, y)) per image of the NxHxW stacks x, y."""
+    counts = joint_histograms(x, y, bins)
+    total = x[0].numel() if torch is not None and torch.is_tensor(x) else x[0].size
+    h_x, h_y = _entropies(counts.sum(2), total), _entropies(counts.sum(1), total)
+    return h_x, h_y, h_x + h_y - _entropies(counts.reshape(len(counts), -1), total)
+
+
+def _gradient_features(imgs, bins=256):
+    """Sobel gradient magnitude of each image of the NxHxW uint8 stack, quantized to bins levels."""
+    scale = bins / (4 * 255 * math.sqrt(2))
+    features = np.empty(imgs.shape, dtype=np.uint16 if bins > 256 else np.uint8)
+    for img, feature in zip(imgs, features):
+        magnitude = cv2.magnitude(cv2.Sobel(img, cv2.CV_32F, 1, 0, ksize=3), cv2.Sobel(img, cv2.CV_32F, 0, 1, ksize=3))
+        feature[...] = np.minimum(magnitude * scale, bins - 1)
+    return features
+
+
+def histogram_metrics(triplets, bins=256, backend=None, device='cpu', chunk=16):
+    """
+    EN, MI, NMI and FMI of many (A, B, F) triplets with batched joint histograms.
+
+    Args:
+        triplets: list of (img_A, img_B, img_F), HxW uint8, sizes may differ between triplets
+        bins: histogram bins
+        backend: 'torch', 'numpy' or None (torch for a non-cpu device, numpy otherwise, it is faster on cpu)
+        device: device of the torch backend, e.g. 'cuda'
+        chunk: triplets per bincount, bounds the size of the index buffer
+
+    Returns:
+        list of OrderedDict(EN, MI, NMI, FMI), in the order of triplets
+    """
+    triplets = [tuple(_gray(img) for img in triplet) for triplet in triplets]
+    groups = OrderedDict()  # image size -> triplet indices
+    for i, (img_A, img_B, img_F) in enumerate(triplets):
+        if not img_A.shape == img_B.shape == img_F.shape:
+            raise ValueError('Input images must have the same dimensions.')
+        groups.setdefault(img_A.shape, []).append(i)
+
+    if backend is None:
+        backend = 'torch' if torch is not None and str(device) != 'cpu' else 'numpy'
+    if backend == 'torch':
+        as_array = lambda x: torch.from_numpy(x).to(device)
+    elif backend == 'numpy':
+        as_array = lambda x: x
+    else:
+        raise NotImplementedError('backend [{:s}] is not found.'.format(backend))
+
+    results = [None] * len(triplets)
+    for indices in groups.values():
+        for k in range(0, len(indices), chunk):
+            batch = indices[k:k + chunk]
+            n = len(batch)
+            A, B, F = (np.stack([triplets[i][c] for i in batch]) for c in range(3))
+            # (A,F) and (B,F) pairs of the whole chunk in one bincount
+            h_src, h_F, mi = _mi_terms(as_array(np.concatenate([A, B])), as_array(np.concatenate([F, F])), bins)
+            gA, gB, gF = _gradient_features(A, bins), _gradient_features(B, bins), _gradient_features(F, bins)
+            fh_src, fh_F, fmi = _mi_terms(as_array(np.concatenate([gA, gB])), as_array(np.concatenate([gF, gF])), bins)
+            h_src, h_F, mi, fh_src, fh_F, fmi = (np.asarray(v.tolist()) for v in (h_src, h_F, mi, fh_src, fh_F, fmi))
+            for j, i in enumerate(batch):
+                metrics = OrderedDict()
+                metrics['EN'] = float(h_F[j])
+                metrics['MI'] = float(mi[j] + mi[n + j])
+                metrics['NMI'] = float(2 * (mi[j] / (h_src[j] + h_F[j]) + mi[n + j] / (h_src[n + j] + h_F[n + j])))
+                metrics['FMI'] = float(fmi[j] / max(fh_src[j] + fh_F[j], 1e-10) + fmi[n + j] / max(fh_src[n + j] + fh_F[n + j], 1e-10))
+                results[i] = metrics
+    return results
+
+
+'''
+# --------------------------------------------
+# gaussian window statistics: SSIM, VIF
+# --------------------------------------------
+# SSIM: utils_image.ssim_stats / ssim_compare,
+# the statistics of F serve both of its pairs
+# VIF: _Moments, with sigma12 at every scale
+# --------------------------------------------
+'''
+
+
+def _blur(img, ksize, sigma):
+    # 'valid' part of the separable gaussian filter, same as filter2D with the outer-product window
+    r = ksize // 2
+    return cv2.GaussianBlur(img, (ksize, ksize), sigma)[r:-r, r:-r]
+
+
+class _Moments(object):
+    """Local mean and second moment of one image at one VIF scale, shared by every pair the image takes part in."""
+
+    def __init__(self, img, ksize=11, sigma=1.5):
+        self.img, self.ksize, self.sigma = img, ksize, sigma
+        self.mu = _blur(img, ksize, sigma)
+        self.sigma_sq = _blur(img * img, ksize, sigma) - self.mu ** 2
+
+    def sigma12(self, other):
+        return _blur(self.img * other.img, self.ksize, self.sigma) - self.mu * other.mu
+
+
+def calculate_ssim(img1, img2):
+    from utils import utils_image as util  # imports torch, not needed by the histogram metrics
+    return float(util.calculate_ssim(_gray(img1), _gray(img2)))
+
+
+def _vif_scale(m_ref, m_dist, sigma_nsq=2., eps=1e-10):
+    sigma1_sq = np.maximum(m_ref.sigma_sq, 0)
+    sigma2_sq = np.maximum(m_dist.sigma_sq, 0)
+    sigma12 = m_ref.sigma12(m_dist)
+
+    g = sigma12 / (sigma1_sq + eps)
+    sv_sq = sigma2_sq - g * sigma12
+    flat_ref = sigma1_sq < eps
+    g[flat_ref], sv_sq[flat_ref], sigma1_sq[flat_ref] = 0, sigma2_sq[flat_ref], 0
+    flat_dist = sigma2_sq < eps
+    g[flat_dist], sv_sq[flat_dist] = 0, 0
+    negative = g < 0
+    sv_sq[negative], g[negative] = sigma2_sq[negative], 0
+    sv_sq = np.maximum(sv_sq, eps)
+
+    num = np.log10(1 + g ** 2 * sigma1_sq / (sv_sq + sigma_nsq)).sum()
+    den = np.log10(1 + sigma1_sq / sigma_nsq).sum()
+    return num, den
+
+
+def _vif_pyramid(img, scales=4):
+    """Per scale _Moments of img, scale s uses a (2^(scales-s+1)+1) window and the image downsampled s-1 times."""
+    moments = []
+    for scale in range(1, scales + 1):
+        ksize = 2 ** (scales - scale + 1) + 1
+        if scale > 1:
+            img = _blur(img, ksize, ksize / 5.)[::2, ::2]
+        moments.append(_Moments(img, ksize, ksize / 5.))
+    return moments
+
+
+def _vif(pyramid_ref, pyramid_dist):
+    num = den = 0.
+    for m_ref, m_dist in zip(pyramid_ref, pyramid_dist):
+        n, d = _vif_scale(m_ref, m_dist)
+        num, den = num + n, den + d
+    return float(num / den) if den > 0 else 1.
+
+
+def calculate_vif(img_ref, img_dist):
+    img_ref, img_dist = _gray(img_ref).astype(np.float64), _gray(img_dist).astype(np.float64)
+    return _vif(_vif_pyramid(img_ref), _vif_pyramid(img_dist))
+
+
+'''
+# --------------------------------------------
+# gradient based: SF, AG, Qabf
+# --------------------------------------------
+'''
+
+
+def calculate_sf(img):
+    img = _gray(img).astype(np.float64)
+    rf = np.mean(np.diff(img, axis=1) ** 2)
+    cf = np.mean(np.diff(img, axis=0) ** 2)
+    return float(math.sqrt(rf + cf))
+
+
+def calculate_ag(img):
+    img = _gray(img).astype(np.float64)
+    gx = np.diff(img, axis=1)[:-1, :]
+    gy = np.diff(img, axis=0)[:, :-1]
+    return float(np.mean(np.sqrt((gx ** 2 + gy ** 2) / 2)))
+
+
+def _sobel(img):
+    """Gradient strength and orientation with 3x3 Sobel operators."""
+    sx = cv2.Sobel(img, cv2.CV_64F, 1, 0, ksize=3)
+    sy = cv2.Sobel(img, cv2.CV_64F, 0, 1, ksize=3)
+    return np.sqrt(sx ** 2 + sy ** 2), np.arctan(sy / (sx + 1e-10))
+
+
+def _edge_preservation(grad_src, grad_F):
+    Tg, kg, Dg = 0.9994, -15, 0.5
+    Ta, ka, Da = 0.9879, -22, 0.8
+    g_src, a_src = grad_src
+    g_F, a_F = grad_F
+    G = np.where(g_src > g_F, g_F / (g_src + 1e-10), np.where(g_src == g_F, 1., g_src / (g_F + 1e-10)))
+    A = 1 - np.abs(a_src - a_F) / (np.pi / 2)
+    return Tg / (1 + np.exp(kg * (G - Dg))) * Ta / (1 + np.exp(ka * (A - Da)))
+
+
+def _qabf(grad_A, grad_B, grad_F, L=1):
+    w_A, w_B = grad_A[0] ** L, grad_B[0] ** L
+    den = (w_A + w_B).sum()
+    if den == 0:
+        return 1.
+    return float(((_edge_preservation(grad_A, grad_F) * w_A + _edge_preservation(grad_B, grad_F) * w_B).sum()) / den)
+
+
+def calculate_qabf(img_A, img_B, img_F):
+    grads = [_sobel(_gray(img).astype(np.float64)) for img in (img_A, img_B, img_F)]
+    return _qabf(*grads)
+
+
+'''
+# --------------------------------------------
+# all metrics with shared intermediates
+# --------------------------------------------
+'''
+
+
+def _cc(img1, img2):
+    d1, d2 = img1 - img1.mean(), img2 - img2.mean()
+    den = math.sqrt((d1 * d1).sum() * (d2 * d2).sum())
+    return float((d1 * d2).sum() / den) if den > 0 else 0.
+
+
+def fusion_metrics(img_A, img_B, img_F):
+    """
+    Every metric of the panel in one pass: one joint histogram per pair (histogram_metrics),
+    one set of gaussian statistics per image and scale, one Sobel pass per image.
+
+    Args:
+        img_A, img_B: source images, HxW uint8
+        img_F: fused image, HxW uint8
+
+    Returns:
+        OrderedDict of EN, MI, NMI, FMI, SSIM_A, SSIM_B, CC, SF, AG, Qabf, VIF, MSE, PSNR
+    """
+    return fusion_metrics_batch([(img_A, img_B, img_F)])[0]
+
+
+def fusion_metrics_batch(triplets, backend=None, device='cpu'):
+    """fusion_metrics of many (img_A, img_B, img_F) triplets, the histogram metrics are batched."""
+    from utils import utils_image as util
+    triplets = [tuple(_gray(img) for img in triplet) for triplet in triplets]
+    results = histogram_metrics(triplets, backend=backend, device=device)
+    for metrics, (img_A, img_B, img_F) in zip(results, triplets):
+        A, B, F = (img.astype(np.float64) for img in (img_A, img_B, img_F))
+        pyr_A, pyr_B, pyr_F = _vif_pyramid(A), _vif_pyramid(B), _vif_pyramid(F)
+        # the first VIF scale uses the 17x17 window, SSIM the 11x11 one
+        s_A, s_B, s_F = util.ssim_stats(img_A), util.ssim_stats(img_B), util.ssim_stats(img_F)
+
+        mse = (np.mean((A - F) ** 2) + np.mean((B - F) ** 2)) / 2
+        metrics['SSIM_A'] = float(util.ssim_compare(s_A, s_F).mean(dtype=np.float64))
+        metrics['SSIM_B'] = float(util.ssim_compare(s_B, s_F).mean(dtype=np.float64))
+        metrics['CC'] = (_cc(A, F) + _cc(B, F)) / 2
+        metrics['SF'] = calculate_sf(F)
+        metrics['AG'] = calculate_ag(F)
+        metrics['Qabf'] = _qabf(_sobel(A), _sobel(B), _sobel(F))
+        metrics['VIF'] = _vif(pyr_A, pyr_F) + _vif(pyr_B, pyr_F)
+        metrics['MSE'] = float(mse)
+        metrics['PSNR'] = 10 * math.log10(255.**2 / mse) if mse > 0 else float('inf')
+    return results
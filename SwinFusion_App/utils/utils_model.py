@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 import numpy as np
 import torch
+import pickle
+import inspect
+from collections import OrderedDict
 from utils import utils_image as util
 import re
 import glob
@@ -212,6 +215,309 @@ def test_split_x8(model, L, refield=32, min_size=256, sf=1, modulo=1):
     return E
 
 
+'''
+# --------------------------------------------
+# split with overlap blending (two inputs)
+# --------------------------------------------
+# tiles are multiples of window_size and start on
+# the window grid, overlapping tiles are blended
+# with gaussian or linear weights
+# --------------------------------------------
+'''
+
+
+def tile_positions(length, tile, stride):
+    """Start offsets of tiles of size tile covering [0, length), the last tile is flush with the end."""
+    if length <= tile:
+        return [0]
+    positions = list(range(0, length - tile, stride))
+    positions.append(length - tile)
+    return positions
+
+
+def blend_weights(tile_h, tile_w, overlap, blend='gaussian', device='cpu'):
+    """
+    Args:
+        tile_h, tile_w: tile size
+        overlap: overlap between neighbouring tiles, width of the 'linear' ramp
+        blend: 'gaussian' (sigma = tile/8), 'linear' (ramp over the overlap) or 'none'
+
+    Returns:
+        weight: 1x1xtile_hxtile_w float32 tensor, strictly positive
+    """
+    def axis(length):
+        if blend == 'gaussian':
+            d = torch.arange(length, dtype=torch.float32) - (length - 1) / 2
+            w = torch.exp(-0.5 * (d / (length / 8)) ** 2)
+        elif blend == 'linear':
+            i = torch.arange(length, dtype=torch.float32)
+            w = torch.minimum(i + 1, length - i).clamp(max=overlap + 1) / (overlap + 1)
+        elif blend == 'none':
+            w = torch.ones(length)
+        else:
+            raise NotImplementedError('blend [{:s}] is not found.'.format(blend))
+        return w.clamp(min=1e-4)
+    return (axis(tile_h).view(-1, 1) * axis(tile_w).view(1, -1)).view(1, 1, tile_h, tile_w).to(device)
+
+
+def estimate_tile_memory(model, tile_h, tile_w, tile_batch=1):
+    """
+    Rough peak activation memory (bytes, float32) of one SwinFusion forward on tile_batch tiles of tile_h x tile_w:
+    the window attention matrices (nH*N per pixel) plus a few dozen embed_dim feature maps.
+    """
+    num_heads, N, embed_dim = 6, 64, getattr(model, 'embed_dim', 60)
+    for m in model.modules():
+        if hasattr(m, 'relative_position_bias_table'):
+            num_heads, N = m.num_heads, m.window_size[0] * m.window_size[1]
+            break
+    return 4 * tile_batch * tile_h * tile_w * (2 * num_heads * N + 32 * embed_dim)
+
+
+def fit_tile_memory(model, tile, tile_batch, max_memory, window_size=8):
+    """Shrink tile_batch, then tile, until estimate_tile_memory(model, tile, tile, tile_batch) <= max_memory."""
+    tile_batch = int(max(1, min(tile_batch, max_memory // estimate_tile_memory(model, tile, tile))))
+    while tile > 4 * window_size and estimate_tile_memory(model, tile, tile, tile_batch) > max_memory:
+        tile -= window_size
+    return tile, tile_batch
+
+
+def tile_options(model, tile=256, overlap=32, window_size=8, tile_batch=1, max_memory=None):
+    """Round tile/overlap to the window grid and fit (tile, tile_batch) into max_memory, returns (tile, overlap, tile_batch)."""
+    tile = max(window_size, tile // window_size * window_size)
+    if max_memory is not None:
+        tile, tile_batch = fit_tile_memory(model, tile, tile_batch, max_memory, window_size)
+    overlap = min(-(-overlap // window_size) * window_size, tile // 2 // window_size * window_size)
+    return tile, overlap, tile_batch
+
+
+def pad_reflect(x, H, W):
+    """Reflect-pad the bottom/right of x up to HxW, repeatedly if the pad is larger than x."""
+    while x.size(-2) < H or x.size(-1) < W:
+        if min(x.size()[-2:]) < 2:
+            return torch.nn.functional.pad(x, (0, max(0, W - x.size(-1)), 0, max(0, H - x.size(-2))), 'replicate')
+        x = torch.nn.functional.pad(x, (0, min(max(0, W - x.size(-1)), x.size(-1) - 1), 0, min(max(0, H - x.size(-2)), x.size(-2) - 1)), 'reflect')
+    return x
+
+
+def test_split_fuse(model, A, B, tile=256, overlap=32, window_size=8, blend='gaussian', tile_batch=1, max_memory=None, progress=None):
+    """
+    Tiled inference for two-input fusion models, peak memory grows with the tile size instead of H*W.
+
+    Args:
+        model: trained fusion model, E = model(A, B)
+        A, B: 1xCxHxW inputs of the same size
+        tile: tile size, rounded down to a multiple of window_size
+        overlap: overlap between neighbouring tiles, rounded up to a multiple of window_size
+        window_size: window size of the model, the image is reflect-padded to a multiple of it
+        blend: 'gaussian', 'linear' or 'none', see blend_weights
+        tile_batch: number of tiles per model call
+        max_memory: peak activation memory budget in bytes, shrinks tile_batch and then tile
+        progress: optional callback progress(tiles_done, tiles_total), called after every model call
+
+    Returns:
+        E: 1xCxHxW fused result
+    """
+    tile, overlap, tile_batch = tile_options(model, tile, overlap, window_size, tile_batch, max_memory)
+    h, w = A.size()[-2:]
+    if h <= tile and w <= tile:
+        E = model(A, B)
+        if progress is not None:
+            progress(1, 1)
+        return E
+    return next(test_split_fuse_iter(model, [(A, B)], tile, overlap, window_size, blend, tile_batch, progress=progress))
+
+
+def test_split_fuse_iter(model, pairs, tile=256, overlap=32, window_size=8, blend='gaussian', tile_batch=8, max_memory=None, progress=None):
+    """
+    Batched tile scheduler over many image pairs, e.g. all slices of a study.
+
+    Every pair is reflect-padded to the window grid and cut into tiles of at most tile x tile. Tiles of the
+    same shape are packed into batches of tile_batch across consecutive pairs, so small slices share one
+    forward and, for a study of equal-size slices, every forward has the same shape. Results are yielded in
+    input order as soon as the last tile of a pair is blended. At most 2*tile_batch pairs are kept waiting,
+    beyond that the queue holding the oldest pair is run even if it is not full, so memory stays bounded.
+
+    Args:
+        model: trained fusion model, E = model(A, B)
+        pairs: iterable of (A, B), 1xCxHxW inputs, the size may differ between pairs
+        tile, overlap, window_size, blend, max_memory: see test_split_fuse
+        tile_batch: number of tiles per model call
+        progress: optional callback progress(tiles_done, tiles_total), tiles_total counts the pairs read so far
+
+    Returns:
+        generator of E, 1xCxHxW fused results in the order of pairs
+    """
+    tile, overlap, tile_batch = tile_options(model, tile, overlap, window_size, tile_batch, max_memory)
+    weights = {}  # tile shape -> blend weights
+    pending = OrderedDict()  # pair index -> [E, weight_sum, h, w, tiles left, tile shape]
+    queues = OrderedDict()  # tile shape -> [(pair index, i, j, A tile, B tile)]
+    tiles = [0, 0]  # done, total
+
+    def run_queue(shape):
+        queue = queues.pop(shape)
+        tile_h, tile_w = shape
+        Es = model(torch.cat([a for _, _, _, a, _ in queue], 0), torch.cat([b for _, _, _, _, b in queue], 0)).float()
+        for n, (k, i, j, _, _) in enumerate(queue):
+            state = pending[k]
+            if state[0] is None:
+                state[0] = torch.zeros(1, Es.size(1), *state[1].size()[-2:], device=Es.device)
+            state[0][..., i:i + tile_h, j:j + tile_w].addcmul_(Es[n:n + 1], weights[shape])
+            state[1][..., i:i + tile_h, j:j + tile_w] += weights[shape]
+            state[4] -= 1
+        tiles[0] += len(queue)
+        if progress is not None:
+            progress(*tiles)
+
+    def finished():
+        while len(pending) > 2 * tile_batch and pending[next(iter(pending))][5] in queues:
+            run_queue(pending[next(iter(pending))][5])
+        while pending and pending[next(iter(pending))][4] == 0:
+            E, weight_sum, h, w = pending.popitem(last=False)[1][:4]
+            yield E.div_(weight_sum)[..., :h, :w]
+
+    for k, (A, B) in enumerate(pairs):
+        h, w = A.size()[-2:]
+        # pad to the window grid so that every tile offset is window-aligned
+        H, W = -(-h // window_size) * window_size, -(-w // window_size) * window_size
+        A, B = pad_reflect(A, H, W), pad_reflect(B, H, W)
+        shape = (min(tile, H), min(tile, W))
+        if shape not in weights:
+            weights[shape] = blend_weights(*shape, overlap, blend, device=A.device)
+        boxes = [(i, j) for i in tile_positions(H, shape[0], tile - overlap) for j in tile_positions(W, shape[1], tile - overlap)]
+        pending[k] = [None, torch.zeros(1, 1, H, W, device=A.device), h, w, len(boxes), shape]
+        tiles[1] += len(boxes)
+        for i, j in boxes:
+            queues.setdefault(shape, []).append((k, i, j, A[..., i:i + shape[0], j:j + shape[1]], B[..., i:i + shape[0], j:j + shape[1]]))
+            if len(queues[shape]) == tile_batch:
+                run_queue(shape)
+        for E in finished():
+            yield E.type_as(A)
+    while queues:
+        run_queue(next(iter(queues)))
+    for E in finished():
+        yield E.type_as(A)
+
+
+def test_split_fuse_batch(model, pairs, tile=256, overlap=32, window_size=8, blend='gaussian', tile_batch=8, max_memory=None):
+    """List version of test_split_fuse_iter."""
+    return list(test_split_fuse_iter(model, pairs, tile, overlap, window_size, blend, tile_batch, max_memory))
+
+
+'''
+# --------------------------------------------
+# checkpoints
+# --------------------------------------------
+# .pth (zip format) and .safetensors are
+# memory-mapped, the tensors are views of the
+# page cache, shared by every process that
+# loads the same file
+# torch < 2.1: .pth files are read into memory
+# and copied into a randomly initialized model
+# --------------------------------------------
+'''
+
+
+# torch.load(mmap=) and load_state_dict(assign=) are new in torch 2.1
+_LOAD_MMAP = 'mmap' in inspect.signature(torch.load).parameters
+_LOAD_ASSIGN = 'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters
+
+
+def load_checkpoint(path, device='cpu', param_key='params'):
+    """
+    State dict of a checkpoint, memory-mapped where the file allows it.
+
+    Args:
+        path: .safetensors, or a torch.save()d .pth holding {param_key: state_dict} or the state_dict
+        device: on the CPU the tensors are views of the file, other devices get one copy
+
+    Returns:
+        state_dict
+    """
+    if path.endswith('.safetensors'):
+        from safetensors.torch import load_file
+        return load_file(path, device=str(device))
+    try:
+        state_dict = torch.load(path, map_location=device, weights_only=True, **({'mmap': True} if _LOAD_MMAP else {}))
+    except (RuntimeError, pickle.UnpicklingError):
+        # legacy (non-zip) files cannot be mapped, pickled objects need the full unpickler
+        state_dict = torch.load(path, map_location=device, weights_only=False)
+    return state_dict[param_key] if param_key in state_dict else state_dict
+
+
+def safetensors_path(model_path):
+    return os.path.splitext(model_path)[0] + '.safetensors'
+
+
+def fast_checkpoint_path(model_path):
+    """The .safetensors copy of model_path (main_export.py --format safetensors) if there is one not older than it, else model_path."""
+    path = safetensors_path(model_path)
+    if path != model_path and os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(model_path):
+        return path
+    return model_path
+
+
+def save_safetensors(state_dict, path):
+    """Save a state dict as one flat .safetensors buffer, the fastest format for load_checkpoint."""
+    from safetensors.torch import save_file
+    save_file(OrderedDict((k, v.detach().cpu().contiguous()) for k, v in state_dict.items()), path, metadata={'format': 'pt'})
+
+
+'''
+# --------------------------------------------
+# SwinFusion
+# --------------------------------------------
+'''
+
+
+def define_swinfusion(model_path=None, device='cpu', **kwargs):
+    '''
+    Build SwinFusion with the configuration used by app.py, for inputs of any size (img_size=None).
+
+    Args:
+        model_path: checkpoint to load, e.g. model/10000_E.pth or model/10000_E.safetensors. None keeps the random init.
+            The weights are read from its .safetensors copy if there is one (fast_checkpoint_path). With torch
+            >= 2.1 the model is built on the meta device, so the random init is skipped, and on the CPU the
+            parameters are the memory-mapped tensors of the file, so processes loading the same checkpoint
+            share its pages
+        device: torch.device or str
+        kwargs: overrides of the network options, e.g. attn_backend='sdpa', precision='bf16'.
+            precision='int8' (CPU only) loads the int8 checkpoint next to model_path (utils_quant.quantized_path)
+            if it was made from model_path, else quantizes the Linear layers dynamically
+
+    Returns:
+        model: SwinFusion in eval mode on device
+    '''
+    from models import network_swinfusion1
+    net = network_swinfusion1.SwinFusion
+    opt_net = dict(upscale=1, in_chans=1, img_size=None, window_size=8,
+                   img_range=1., depths=[6, 6, 6, 6], embed_dim=60, num_heads=[6, 6, 6, 6],
+                   mlp_ratio=2, upsampler=None, resi_connection='1conv')
+    opt_net.update(kwargs)
+    int8 = opt_net.get('precision') == 'int8'
+    if int8:
+        if torch.device(device).type != 'cpu':
+            raise ValueError('int8 inference runs on the CPU only.')
+        opt_net['precision'] = 'fp32'
+    if model_path is not None and _LOAD_ASSIGN:
+        # parameters on the meta device are not allocated nor initialized, load_state_dict assigns the loaded tensors
+        with torch.device('meta'):
+            model = net(**opt_net)
+        model.load_state_dict(load_checkpoint(fast_checkpoint_path(model_path), device), strict=True, assign=True)
+    elif model_path is not None:
+        model = net(**opt_net)
+        model.load_state_dict(load_checkpoint(fast_checkpoint_path(model_path), device), strict=True)
+    else:
+        model = net(**opt_net)
+    model.eval()
+    model = model.to(device)
+    if int8:
+        from utils import utils_quant
+        path = utils_quant.quantized_path(model_path) if model_path is not None else None
+        if path is None or not os.path.isfile(path) or utils_quant.load_quantized(model, path, model_path) is None:
+            utils_quant.quantize_swinfusion(model)
+    return model
+
+
 '''
 # ^_^-^_^-^_^-^_^-^_^-^_^-^_^-^_^-^_^-^_^-^_^-
 # _^_^-^_^-^_^-^_^-^_^-^_^-^_^-^_^-^_^-^_^-^_^
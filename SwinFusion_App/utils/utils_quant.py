@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import os
+import torch
+import torch.nn as nn
+from torch.ao import quantization as tq
+
+from utils import utils_cache
+
+
+'''
+# --------------------------------------------
+# post-training int8 quantization of SwinFusion
+# --------------------------------------------
+# Linear (qkv/q/kv/proj, Mlp fc1/fc2): dynamic int8,
+# weights quantized once, activation ranges per call
+# Conv2d (optional): static int8, activation ranges
+# from a calibration pass over sample pairs
+# CPU only (x86/fbgemm/qnnpack engines)
+# --------------------------------------------
+'''
+
+
+class QuantConv2d(nn.Module):
+    """Float in, float out wrapper of a Conv2d, int8 inside once converted."""
+
+    def __init__(self, conv):
+        super(QuantConv2d, self).__init__()
+        self.quant = tq.QuantStub()
+        self.conv = conv
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def _wrap_convs(module, qconfig):
+    for name, child in module.named_children():
+        if type(child) is nn.Conv2d:
+            wrapped = QuantConv2d(child)
+            wrapped.qconfig = qconfig
+            setattr(module, name, wrapped)
+        else:
+            _wrap_convs(child, qconfig)
+
+
+def calibrate(model, pairs):
+    """Run model over (A, B) pairs to record the activation ranges of the observers."""
+    with torch.no_grad():
+        for A, B in pairs:
+            model(A.cpu(), B.cpu())
+
+
+def quantize_swinfusion(model, conv=False, calibration=None):
+    """
+    Quantize a float SwinFusion in place.
+
+    Args:
+        model: SwinFusion on the CPU
+        conv (bool): also quantize the Conv2d layers (static int8)
+        calibration: iterable of (A, B) 1xCxHxW pairs for the conv activation ranges,
+            required when conv=True unless the ranges are loaded from a checkpoint afterwards
+
+    Returns:
+        model: the quantized model in eval mode
+    """
+    frozen_opt = model.frozen_opt if model.frozen else None
+    model.unfreeze().eval()
+    if conv:
+        _wrap_convs(model, tq.get_default_qconfig(torch.backends.quantized.engine))
+        tq.prepare(model, inplace=True)
+        if calibration is None:
+            # observers need one pass before convert, the ranges are replaced by load_quantized
+            calibration = [(torch.rand(1, model.conv_first1_A.conv.in_channels, model.window_size, model.window_size),) * 2]
+        calibrate(model, calibration)
+        tq.convert(model, inplace=True)
+    tq.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    model.quantization = dict(conv=conv, engine=torch.backends.quantized.engine)
+    if frozen_opt is not None:
+        model.freeze(**frozen_opt)
+    return model
+
+
+'''
+# --------------------------------------------
+# int8 checkpoints, stored next to the float
+# checkpoint: model/10000_E.pth -> model/10000_E.int8.pth
+# --------------------------------------------
+'''
+
+
+def quantized_path(model_path):
+    return os.path.splitext(model_path)[0] + '.int8.pth'
+
+
+def save_quantized(model, path, model_path=None):
+    """Save a quantized model, model_path records the float checkpoint it was made from."""
+    torch.save({'params': model.state_dict(), 'quantization': model.quantization,
+                'source': utils_cache.file_digest(model_path) if model_path is not None else None}, path)
+
+
+def load_quantized(model, path, model_path=None):
+    """
+    Quantize the float model like the checkpoint at path and load its int8 weights.
+
+    The int8 weights are packed for the quantized engine they were saved with, which has to be the current
+    torch.backends.quantized.engine.
+
+    Returns:
+        model, or None if model_path is given and the checkpoint was made from a different file
+    """
+    checkpoint = torch.load(path, map_location='cpu', weights_only=True)
+    if model_path is not None and checkpoint.get('source') not in (None, utils_cache.file_digest(model_path)):
+        return None
+    engine = checkpoint['quantization']['engine']
+    if engine not in torch.backends.quantized.supported_engines:
+        raise RuntimeError('{} was quantized for the {} engine, not supported here ({}).'.format(
+            path, engine, ', '.join(torch.backends.quantized.supported_engines)))
+    if engine != torch.backends.quantized.engine:
+        raise RuntimeError('{} was quantized for the {} engine, set torch.backends.quantized.engine = {!r} '
+                           'first (now {}).'.format(path, engine, engine, torch.backends.quantized.engine))
+    quantize_swinfusion(model, conv=checkpoint['quantization']['conv'])
+    model.load_state_dict(checkpoint['params'], strict=True)
+    return model
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+import os
+import contextlib
+import threading
+from collections import OrderedDict
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+'''
+# --------------------------------------------
+# Swin Transformer helpers shared by
+# network_swinfusion.py and network_swinfusion1.py
+# --------------------------------------------
+'''
+
+
+'''
+# --------------------------------------------
+# bounded LRU cache
+# --------------------------------------------
+'''
+
+
+class LRUCache(object):
+    """Thread-safe bounded LRU cache.
+
+    Args:
+        maxsize (int): Maximum number of entries kept. Default: 32
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_create(self, key, factory):
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def __getstate__(self):
+        # the lock does not pickle (e.g. a model sent to worker processes), the copy gets its own
+        with self._lock:
+            return {'maxsize': self.maxsize, '_data': OrderedDict(self._data)}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+'''
+# --------------------------------------------
+# SW-MSA attention mask
+# --------------------------------------------
+'''
+
+
+_ATTN_MASK_CACHE = LRUCache(maxsize=64)
+
+
+def build_attn_mask(H, W, window_size, shift_size):
+    """Build the (0/-100) SW-MSA mask of shape (nW, window_size*window_size, window_size*window_size)."""
+    if shift_size == 0:
+        nW = (H // window_size) * (W // window_size)
+        return torch.zeros((nW, window_size * window_size, window_size * window_size))
+
+    # region id along each axis: 0 for [0, L-window_size), 1 for [L-window_size, L-shift_size), 2 for the rest
+    h_ids = torch.arange(H)
+    h_ids = (h_ids >= H - window_size).float() + (h_ids >= H - shift_size).float()
+    w_ids = torch.arange(W)
+    w_ids = (w_ids >= W - window_size).float() + (w_ids >= W - shift_size).float()
+    img_mask = h_ids.view(H, 1) * 3 + w_ids.view(1, W)  # H W
+
+    mask_windows = img_mask.view(H // window_size, window_size, W // window_size, window_size)
+    mask_windows = mask_windows.permute(0, 2, 1, 3).reshape(-1, window_size * window_size)  # nW, window_size*window_size
+    # -100 between tokens of different regions, one fill instead of subtract + two masked_fill
+    attn_mask = torch.zeros(mask_windows.shape[0], window_size * window_size, window_size * window_size)
+    return attn_mask.masked_fill_(mask_windows.unsqueeze(1) != mask_windows.unsqueeze(2), float(-100.0))
+
+
+def is_exporting():
+    """True while torch.export (e.g. torch.onnx.export(dynamo=True)) traces the model with symbolic H/W."""
+    exporting = getattr(getattr(torch, 'compiler', None), 'is_exporting', None)
+    return exporting is not None and exporting()
+
+
+def get_attn_mask(x_size, window_size, shift_size, device=None, dtype=None):
+    """Return the SW-MSA mask for a feature map of size x_size, shared by every block.
+
+    Masks are kept in a bounded LRU cache keyed by (H, W, window_size, shift_size, device, dtype),
+    so the blocks of every model hold no mask of their own (and none in their state_dict) and
+    mask construction and the host-to-device copy are paid once per resolution and device.
+    The returned tensor is shared and must not be modified in place.
+    Returns None when shift_size is 0 (W-MSA needs no mask). While exporting, the mask is built
+    in the graph instead, symbolic sizes cannot be cache keys.
+    """
+    if shift_size == 0:
+        return None
+    H, W = x_size
+    device = torch.device(device) if device is not None else torch.device('cpu')
+    dtype = dtype or torch.get_default_dtype()
+    if is_exporting():
+        return build_attn_mask(H, W, window_size, shift_size).to(device=device, dtype=dtype)
+    key = (H, W, window_size, shift_size, device, dtype)
+    return _ATTN_MASK_CACHE.get_or_create(
+        key, lambda: build_attn_mask(H, W, window_size, shift_size).to(device=device, dtype=dtype))
+
+
+def clear_attn_mask_cache():
+    _ATTN_MASK_CACHE.clear()
+
+
+'''
+# --------------------------------------------
+# relative position bias
+# --------------------------------------------
+'''
+
+
+_RELATIVE_POSITION_INDEX_CACHE = LRUCache(maxsize=16)
+
+
+def build_relative_position_index(window_size):
+    """Pair-wise relative position index of the tokens of a (Wh, Ww) window, shape (Wh*Ww, Wh*Ww)."""
+    coords_h = torch.arange(window_size[0])
+    coords_w = torch.arange(window_size[1])
+    coords = torch.stack(torch.meshgrid([coords_h, coords_w], indexing='ij'))  # 2, Wh, Ww
+    coords_flatten = torch.flatten(coords, 1)  # 2, Wh*Ww
+    relative_coords = coords_flatten[:, :, None] - coords_flatten[:, None, :]  # 2, Wh*Ww, Wh*Ww
+    relative_coords = relative_coords.permute(1, 2, 0).contiguous()  # Wh*Ww, Wh*Ww, 2
+    relative_coords[:, :, 0] += window_size[0] - 1  # shift to start from 0
+    relative_coords[:, :, 1] += window_size[1] - 1
+    relative_coords[:, :, 0] *= 2 * window_size[1] - 1
+    return relative_coords.sum(-1)  # Wh*Ww, Wh*Ww
+
+
+def get_relative_position_index(window_size, device=None):
+    """Return the relative position index of a (Wh, Ww) window, one shared tensor per (window_size, device)."""
+    device = torch.device(device) if device is not None else torch.device('cpu')
+    key = (tuple(window_size), device)
+    return _RELATIVE_POSITION_INDEX_CACHE.get_or_create(key, lambda: build_relative_position_index(window_size).to(device))
+
+
+# buffers of checkpoints written before the masks and indices were shared, ignored when loading
+SHARED_BUFFERS = ('attn_mask', 'relative_position_index')
+
+
+def strip_shared_buffers(state_dict):
+    """state_dict without the per-block SHARED_BUFFERS entries of older checkpoints."""
+    return type(state_dict)((k, v) for k, v in state_dict.items() if k.rsplit('.', 1)[-1] not in SHARED_BUFFERS)
+
+
+def fuse_attn_mask(relative_position_bias, attn_mask):
+    """Pre-add the (nH, N, N) relative position bias to the (nW, N, N) SW-MSA mask.
+
+    Returns:
+        (nW, nH, N, N) additive attention bias
+    """
+    return attn_mask.unsqueeze(1) + relative_position_bias.to(attn_mask).unsqueeze(0)
+
+
+'''
+# --------------------------------------------
+# FLOPs
+# --------------------------------------------
+'''
+
+
+def conv2d_flops(module, H, W):
+    """Multiply-adds of the stride-1, 'same' padded Conv2d layers in module on an H x W feature map."""
+    flops = 0
+    for m in module.modules():
+        if isinstance(m, nn.Conv2d):
+            flops += H * W * m.in_channels * m.out_channels * m.kernel_size[0] * m.kernel_size[1] // m.groups
+    return flops
+
+
+'''
+# --------------------------------------------
+# attention backends
+# --------------------------------------------
+# 'math': explicit q @ k^T, bias add, softmax, @ v (reference)
+# 'sdpa': torch.nn.functional.scaled_dot_product_attention with the bias (+mask) as additive attn_mask
+# 'chunked': math path over chunks of windows, bounds the peak size of the attention matrix
+# --------------------------------------------
+'''
+
+
+ATTN_BACKENDS = ('math', 'sdpa', 'chunked')
+
+
+def _sdpa_takes_scale():
+    # the scale argument of scaled_dot_product_attention is new in torch 2.1
+    try:
+        F.scaled_dot_product_attention(*torch.zeros(3, 1, 1, 1), scale=1.)
+    except TypeError:
+        return False
+    return True
+
+
+_SDPA_SCALE = hasattr(F, 'scaled_dot_product_attention') and _sdpa_takes_scale()
+
+
+def resolve_attn_backend(backend):
+    if backend not in ATTN_BACKENDS:
+        raise ValueError('attention backend [{:s}] is not supported, choose from {}.'.format(str(backend), ATTN_BACKENDS))
+    if backend == 'sdpa' and not hasattr(F, 'scaled_dot_product_attention'):
+        # torch < 2.0
+        backend = 'chunked'
+    return backend
+
+
+def window_attention(q, k, v, attn_bias, scale, backend='sdpa', dropout_p=0., chunk_size=64):
+    """softmax(q @ k^T * scale + attn_bias) @ v for window attention.
+
+    Args:
+        q, k, v: (num_windows*B, nH, N, head_dim)
+        attn_bias: (nH, N, N) relative position bias, or (nW, nH, N, N) bias with the SW-MSA mask pre-added
+        scale (float): qk scale
+        backend (str): 'math', 'sdpa' or 'chunked'
+        dropout_p (float): attention dropout probability, 0 at inference
+        chunk_size (int): number of windows per chunk for the 'chunked' backend
+
+    Returns:
+        x: (num_windows*B, nH, N, head_dim)
+    """
+    B_, nH, N, D = q.shape
+    if attn_bias.dim() == 4:
+        # B_ = B*nW, windows of one image are contiguous
+        nW = attn_bias.shape[0]
+        q, k, v = q.view(B_ // nW, nW, nH, N, D), k.view(B_ // nW, nW, nH, N, D), v.view(B_ // nW, nW, nH, N, D)
+    if backend == 'sdpa' and _SDPA_SCALE:
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias.to(q.dtype), dropout_p=dropout_p, scale=scale)
+    elif backend == 'sdpa':
+        # torch 2.0 always scales by head_dim ** -0.5, fold the rest of the scale into q
+        x = F.scaled_dot_product_attention(q * (scale * D ** 0.5), k, v, attn_mask=attn_bias.to(q.dtype), dropout_p=dropout_p)
+    elif backend == 'chunked':
+        x = _chunked_attention(q, k, v, attn_bias, scale, dropout_p, chunk_size)
+    else:
+        x = _math_attention(q, k, v, attn_bias, scale, dropout_p)
+    return x.reshape(B_, nH, N, D)
+
+
+def _math_attention(q, k, v, attn_bias, scale, dropout_p):
+    attn = (q * scale) @ k.transpose(-2, -1)
+    if attn.dtype != attn_bias.dtype:
+        # reduced precision scores (autocast), bias and softmax in the precision of the bias
+        attn = attn.to(attn_bias.dtype)
+    attn += attn_bias
+    attn = attn.softmax(dim=-1)
+    if dropout_p > 0:
+        attn = F.dropout(attn, p=dropout_p)
+    return attn.to(v.dtype) @ v
+
+
+def _chunked_attention(q, k, v, attn_bias, scale, dropout_p, chunk_size):
+    # chunk along the window axis: dim 0 for (B_, nH, N, D), dim 1 for (B, nW, nH, N, D)
+    dim = q.dim() - 4
+    if q.shape[dim] <= chunk_size:
+        return _math_attention(q, k, v, attn_bias, scale, dropout_p)
+    out = torch.empty_like(q)
+    for start in range(0, q.shape[dim], chunk_size):
+        length = min(chunk_size, q.shape[dim] - start)
+        bias = attn_bias[start:start + length] if attn_bias.dim() == 4 else attn_bias
+        out.narrow(dim, start, length).copy_(_math_attention(
+            q.narrow(dim, start, length), k.narrow(dim, start, length), v.narrow(dim, start, length),
+            bias, scale, dropout_p))
+    return out
+
+
+'''
+# --------------------------------------------
+# concurrent branches
+# --------------------------------------------
+'''
+
+
+_BRANCH_EXECUTOR = None
+_BRANCH_EXECUTOR_LOCK = threading.Lock()
+
+
+def _branch_executor():
+    global _BRANCH_EXECUTOR
+    with _BRANCH_EXECUTOR_LOCK:
+        if _BRANCH_EXECUTOR is None:
+            _BRANCH_EXECUTOR = ThreadPoolExecutor(max_workers=max(2, os.cpu_count() or 1),
+                                                  thread_name_prefix='swin_branch')
+    return _BRANCH_EXECUTOR
+
+
+def _autocast_state():
+    """[(device_type, dtype)] of the autocast contexts enabled on the calling thread."""
+    if hasattr(torch, 'get_autocast_dtype'):
+        # torch >= 2.4, per device type
+        return [(device_type, torch.get_autocast_dtype(device_type)) for device_type in ('cpu', 'cuda')
+                if torch.is_autocast_enabled(device_type)]
+    state = []
+    if torch.is_autocast_cpu_enabled():
+        state.append(('cpu', torch.get_autocast_cpu_dtype()))
+    if torch.is_autocast_enabled():
+        state.append(('cuda', torch.get_autocast_gpu_dtype()))
+    return state
+
+
+def run_branches(fn_A, fn_B):
+    """Run fn_A on a worker thread while fn_B runs on the calling thread.
+
+    torch releases the GIL inside its ops, so two independent branches overlap on a multi-core CPU.
+    Grad mode, inference mode and autocast are thread-local, they are forwarded to the worker.
+
+    If fn_B raises, fn_A is still waited for and the error of fn_B is raised.
+
+    Returns:
+        (fn_A(), fn_B())
+    """
+    grad_enabled = torch.is_grad_enabled()
+    inference_mode = torch.is_inference_mode_enabled()
+    autocast = _autocast_state()
+
+    def run_A():
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(torch.inference_mode(inference_mode))
+            stack.enter_context(torch.set_grad_enabled(grad_enabled))
+            for device_type, dtype in autocast:
+                stack.enter_context(torch.autocast(device_type, dtype=dtype))
+            return fn_A()
+
+    future = _branch_executor().submit(run_A)
+    try:
+        out_B = fn_B()
+    except BaseException:
+        # fn_A shares the inputs, let it finish before unwinding, an error of fn_A would hide this one
+        futures.wait([future])
+        raise
+    out_A = future.result()
+    return out_A, out_B
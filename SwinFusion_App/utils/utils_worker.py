@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+import time
+import uuid
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import torch
+import torch.nn as nn
+import torch.multiprocessing
+
+
+'''
+# --------------------------------------------
+# background inference worker
+# --------------------------------------------
+# jobs are queued FIFO and run by a small pool of
+# threads sharing one model instance (forward is
+# re-entrant), callers poll Job.progress
+# --------------------------------------------
+'''
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+class Job(object):
+    """Handle of a submitted job, updated by the worker thread."""
+
+    def __init__(self, fn, args, kwargs, owner=None):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.status = 'queued'  # 'queued' / 'running' / 'done' / 'failed'
+        self.progress = 0.
+        self.message = 'Queued'
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._fn, self._args, self._kwargs = fn, args, kwargs
+        self._done = threading.Event()
+
+    def set_progress(self, progress, message=None):
+        self.progress = min(max(float(progress), 0.), 1.)
+        if message is not None:
+            self.message = message
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the job finished, returns True if it did within timeout."""
+        return self._done.wait(timeout)
+
+    def _run(self):
+        self.status, self.started = 'running', time.time()
+        self.set_progress(0., 'Running')
+        try:
+            self.result = self._fn(self, *self._args, **self._kwargs)
+            self.status = 'done'
+            self.set_progress(1., 'Complete')
+        except Exception as e:
+            self.error, self.status = e, 'failed'
+            self.message = 'Failed: {}'.format(e)
+        finally:
+            self.finished = time.time()
+            self._fn = self._args = self._kwargs = None
+            self._done.set()
+
+
+class InferenceWorker(object):
+    """FIFO job queue served by num_workers daemon threads.
+
+    Admission control: submit raises QueueFullError when max_queue jobs are already waiting,
+    or when owner (e.g. a UI session) still has an unfinished job.
+
+    Args:
+        num_workers (int): number of jobs run at the same time. Default: 1
+        max_queue (int): maximum number of waiting jobs. Default: 8
+    """
+
+    def __init__(self, num_workers=1, max_queue=8):
+        self.num_workers = num_workers
+        self.max_queue = max_queue
+        self._queue = deque()
+        self._active = {}  # owner -> unfinished job
+        self._running = 0
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def submit(self, fn, *args, owner=None, **kwargs):
+        """Queue fn(job, *args, **kwargs), returns the Job."""
+        job = Job(fn, args, kwargs, owner)
+        with self._cond:
+            if owner is not None and owner in self._active and not self._active[owner].done:
+                raise QueueFullError('a fusion job of this session is still running.')
+            if len(self._queue) >= self.max_queue:
+                raise QueueFullError('the server is busy ({:d} jobs waiting), please retry shortly.'.format(len(self._queue)))
+            if owner is not None:
+                self._active[owner] = job
+            self._queue.append(job)
+            if len(self._threads) < self.num_workers:
+                thread = threading.Thread(target=self._loop, name='inference_worker_{:d}'.format(len(self._threads)), daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._cond.notify()
+        return job
+
+    def position(self, job):
+        """Number of jobs ahead of job in the queue, 0 once it runs."""
+        with self._cond:
+            for i, queued in enumerate(self._queue):
+                if queued is job:
+                    return i + 1
+        return 0
+
+    def depth(self):
+        """(waiting, running) job counts."""
+        with self._cond:
+            return len(self._queue), self._running
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                job = self._queue.popleft()
+                self._running += 1
+            try:
+                job._run()
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    if self._active.get(job.owner) is job:
+                        del self._active[job.owner]
+
+
+'''
+# --------------------------------------------
+# inference processes sharing one copy of the model
+# --------------------------------------------
+# the threads above share one model but also the
+# GIL of the server, ModelProcessPool runs the
+# forward passes in worker processes instead: the
+# parameters and frozen biases of the model are
+# moved to shared memory once and every worker
+# maps the same pages (torch.multiprocessing),
+# N workers cost one copy of the weights
+# --------------------------------------------
+'''
+
+
+_pool_model = _pool_barrier = None  # globals of a worker process
+
+
+def _init_pool_worker(model, threads, barrier):
+    global _pool_model, _pool_barrier
+    torch.set_num_threads(threads)
+    _pool_barrier = barrier
+    # a module arrives as a view of the shared tensors, a factory builds a private copy
+    _pool_model = model if isinstance(model, nn.Module) else model()
+
+
+def _pool_ready():
+    # a worker waiting here takes no other task, so every worker passes once
+    _pool_barrier.wait()
+
+
+def _pool_forward(A, B):
+    with torch.no_grad():
+        return _pool_model(A, B)
+
+
+def process_memory(pid='self'):
+    """{'private': RssAnon, 'file': RssFile, 'shared': RssShmem} of a process in MB (Linux)."""
+    keys = {'RssAnon:': 'private', 'RssFile:': 'file', 'RssShmem:': 'shared'}
+    with open('/proc/{}/status'.format(pid)) as f:
+        return {keys[line.split()[0]]: int(line.split()[1]) / 2**10 for line in f if line.split()[0] in keys}
+
+
+class ModelProcessPool(nn.Module):
+    """
+    E = pool(A, B) runs model(A, B) in one of num_processes worker processes (CPU).
+
+    Calls from several threads (e.g. the threads of InferenceWorker) run in parallel, each in its
+    own process, so a pool of N processes served by N threads scales past the GIL. Workers are
+    spawned on first use, or all at once by start(), and keep their model until close().
+
+    Only the weights are shared: each worker builds its own attention masks and relative position
+    indices (the utils_swin caches) for every input size it serves, next to its activations.
+
+    Args:
+        model: frozen eager SwinFusion, shared by all workers without a copy;
+            or a picklable factory, e.g. functools.partial(utils_model.define_swinfusion, model_path),
+            called once per worker to load a private copy
+        num_processes (int): number of worker processes. Default: 2
+        threads (int): torch intra-op threads per worker. Default: torch.get_num_threads() // num_processes
+    """
+
+    def __init__(self, model, num_processes=2, threads=None):
+        super(ModelProcessPool, self).__init__()
+        if isinstance(model, nn.Module):
+            if any(t.device.type != 'cpu' for t in model.state_dict().values()):
+                raise ValueError('only a CPU model can be shared between processes.')
+            model.share_memory()  # frozen biases are plain attributes, the pickler moves them when the workers start
+            self.model = model
+            self.window_size, self.embed_dim, self.precision = model.window_size, model.embed_dim, model.precision
+        self.num_processes = num_processes
+        self.threads = threads or max(1, torch.get_num_threads() // num_processes)
+        context = torch.multiprocessing.get_context('spawn')
+        self.executor = ProcessPoolExecutor(num_processes, mp_context=context, initializer=_init_pool_worker,
+                                            initargs=(model, self.threads, context.Barrier(num_processes)))
+
+    def start(self):
+        """Start every worker and wait until all of them hold the model."""
+        for future in [self.executor.submit(_pool_ready) for _ in range(self.num_processes)]:
+            future.result()
+        return self
+
+    def submit(self, A, B):
+        """Future of model(A, B)."""
+        return self.executor.submit(_pool_forward, A.detach().cpu(), B.detach().cpu())
+
+    def forward(self, A, B):
+        return self.submit(A, B).result().to(A.device)
+
+    def pids(self):
+        """Process ids of the workers started so far."""
+        return list(self.executor._processes or ())
+
+    def close(self):
+        self.executor.shutdown()